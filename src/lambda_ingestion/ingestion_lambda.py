@@ -2,19 +2,163 @@ import boto3
 import logging
 import json
 import pg8000.native as pg8000
+import pyarrow as pa
+import pyarrow.parquet as pq
 import csv
+import io
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime as dt
+from datetime import timedelta
+from pipeline_common.config import config_cache, resolve_config
+from pipeline_common.connection import ConnectionManager
 
 
 logger = logging.getLogger('MyLogger')
 logger.setLevel(logging.INFO)
 
+# Number of rows the stream engine fetches from the database at a time.
+STREAM_CHUNK_ROWS = 10000
+
+# Size at which buffered data is sent to S3 as one part of a multipart upload,
+# S3 requires every part but the last to be at least 5MiB.
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+# Key of the object in the ingestion bucket that records, for each table, the
+# most recent last_updated value that has been ingested.
+WATERMARK_MANIFEST_KEY = 'watermarks.json'
+
+# Key of the object in the ingestion bucket that records the plan and
+# progress of a backfill, it only exists while a backfill is under way.
+BACKFILL_CHECKPOINT_KEY = 'backfill_checkpoint.json'
+
+# Width of the last_updated ranges a backfill splits the tables into, each
+# range is written under its own timestamp prefix.
+BACKFILL_WINDOW_DAYS = 30
+
+# A backfill stops starting new ranges once the invocation has less than this
+# long left to run, leaving them to be resumed by the next invocation. Kept
+# well under the Lambda timeout, and the first range of an invocation is
+# always started so that a backfill cannot stall.
+BACKFILL_TIME_MARGIN_SECONDS = 10
+
+# Compression codec used for parquet written by ingestion.
+PARQUET_COMPRESSION = 'zstd'
+
+# The columns of each source table that the transformation utils consume.
+# Only these are extracted, along with last_updated which ingestion needs for
+# its watermarks. Tables that are not listed, or that are named in the comma
+# separated INGESTION_FULL_TABLES environment variable ("*" for all tables),
+# are extracted in full for archiving.
+TABLE_COLUMNS = {
+    # dim_location.py and dim_counter_party.py
+    'address': [
+        'address_id',
+        'address_line_1',
+        'address_line_2',
+        'district',
+        'city',
+        'postal_code',
+        'country',
+        'phone',
+    ],
+    # dim_counter_party.py
+    'counterparty': [
+        'counterparty_id',
+        'counterparty_legal_name',
+        'legal_address_id',
+    ],
+    # dim_currency.py
+    'currency': [
+        'currency_id',
+        'currency_code',
+    ],
+    # dim_staff.py
+    'department': [
+        'department_id',
+        'department_name',
+        'location',
+    ],
+    # dim_design.py
+    'design': [
+        'design_id',
+        'design_name',
+        'file_location',
+        'file_name',
+    ],
+    # dim_fact_sales_order.py
+    'sales_order': [
+        'sales_order_id',
+        'created_at',
+        'design_id',
+        'staff_id',
+        'counterparty_id',
+        'units_sold',
+        'unit_price',
+        'currency_id',
+        'agreed_payment_date',
+        'agreed_delivery_date',
+        'agreed_delivery_location_id',
+    ],
+    # dim_staff.py
+    'staff': [
+        'staff_id',
+        'first_name',
+        'last_name',
+        'department_id',
+        'email_address',
+    ],
+}
+
+# Logical replication slot read by the cdc engine, which decodes changes with
+# the wal2json output plugin.
+REPLICATION_SLOT = 'totesys_ingestion'
+REPLICATION_PLUGIN = 'wal2json'
+
+# Maximum number of changes the cdc engine reads from the slot in one run,
+# whole transactions are always read so a run may slightly exceed this.
+REPLICATION_BATCH_CHANGES = 50000
+
+# Key of the object in the ingestion bucket that records the log sequence
+# number of the last transaction the cdc engine has written to the bucket.
+REPLICATION_CHECKPOINT_KEY = 'replication_checkpoint.json'
+
+# Key of the object in the ingestion bucket that records the rows deleted and
+# the tables truncated in the source database, which the warehouse cannot
+# apply, so that they can be removed from it by hand.
+REPLICATION_DELETES_KEY = 'replication_deletes.json'
+
+# Codecs that csvs written by ingestion can be compressed with, paired with
+# the suffix added to their keys.
+COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# Arrow types for the postgres type OIDs used by the totesys tables, numeric
+# is handled separately as its precision comes from the type modifier and any
+# type not listed here is written as a string.
+ARROW_TYPES = {
+    pg8000.BOOLEAN: pa.bool_(),
+    21: pa.int16(),
+    pg8000.INTEGER: pa.int32(),
+    pg8000.BIGINT: pa.int64(),
+    700: pa.float32(),
+    pg8000.FLOAT: pa.float64(),
+    pg8000.DATE: pa.date32(),
+    pg8000.TIME: pa.time64('us'),
+    pg8000.TIMESTAMP: pa.timestamp('us'),
+    pg8000.TIMESTAMPTZ: pa.timestamp('us', tz='UTC'),
+}
+
 
 def ingestion_lambda_handler(event, context):
     """ Will query the ingestion database at regular intervals and save the
-        results to csvs in an s3 bucket to await processing, using the s3
-        prefix system to only query that has been added or updated since the
-        last query.
+        results to csvs in an s3 bucket to await processing, using a manifest
+        of per-table watermarks to only query data that has been added or
+        updated since the last query.
     """
     try:
 
@@ -33,20 +177,64 @@ def ingestion_lambda_handler(event, context):
         bucket_name = get_ingestion_bucket_name()
         logger.info(f"Ingestion bucket established as {bucket_name}.")
 
-        # Uses the timestamp prefixes in s3 to determine when the most recent
-        # ingestion was.
-        last = get_last_ingestion_timestamp(bucket_name)
+        engine = os.environ.get('INGESTION_ENGINE', 'query')
+        output_format = os.environ.get('INGESTION_FORMAT', 'csv')
+        codec = os.environ.get('INGESTION_COMPRESSION') or None
+
+        # The cdc engine reads the changes made to every table from a
+        # logical replication slot, tracking its own checkpoint instead of
+        # the watermarks.
+        if engine == 'cdc':
+            replicate_changes_to_s3(
+                bucket_name, table_names, output_format, codec)
+            return
+
+        workers = int(os.environ.get('INGESTION_WORKERS', 1))
+        time_left = getattr(context, 'get_remaining_time_in_millis', None)
+
+        # A backfill was requested or one is still under way, so the tables
+        # are extracted in last_updated ranges across several prefixes
+        # instead of all at once. This is checked before the watermarks are
+        # read, as there are none until the first backfill completes.
+        requested = isinstance(event, dict) and event.get('backfill')
+        if requested or get_backfill_checkpoint(bucket_name) is not None:
+            backfill_tables_to_s3(
+                bucket_name, table_names, workers, engine, output_format,
+                codec, time_left)
+            return
+
+        # Uses the watermark manifest in s3 to determine the most recent
+        # update already ingested from each table.
+        watermarks = get_watermarks(bucket_name, table_names)
+        for table_name, last in watermarks.items():
+            logger.info(
+                f"Most recent {table_name} update ingested is "
+                f"{last.isoformat()}"
+            )
+
+        # Nothing has been ingested yet, so start a backfill.
+        if all(last == dt(1970, 1, 1) for last in watermarks.values()):
+            backfill_tables_to_s3(
+                bucket_name, table_names, workers, engine, output_format,
+                codec, time_left)
+            return
+
+        # Checks which tables have changed with one cheap query so the
+        # extraction queries are only run against those tables.
+        changed = changed_tables(table_names, watermarks)
+
+        # Queries each changed table for recent additions and writes its csv
+        # to a shared timestamp prefix, on a pool of workers if configured.
         logger.info(
-            f"Most recent timestamp saved to bucket is {last.isoformat()}"
+            f"Extracting tables to {output_format} with {workers} workers "
+            f"using the {engine} engine."
         )
+        written = extract_tables_to_s3(
+            bucket_name, changed, watermarks, workers, engine,
+            output_format, codec)
 
-        # Uses the most recent ingestion timestamp to query the database for
-        # recent additions.
-        csvs_to_update = extract_table_to_csv(table_names, last)
-
-        # Writes the returned query data to the s3 bucket in csv form under a
-        # new timestamp prefix.
-        csv_to_s3(bucket_name, csvs_to_update)
+        # Advances the watermark of each table that had new data.
+        update_watermarks(bucket_name, watermarks, written)
 
     except TableIngestionError as error:
         logger.error(f'Table Ingestion Error: {error.message}')
@@ -66,6 +254,14 @@ def ingestion_lambda_handler(event, context):
 
 
 def get_ingestion_bucket_name():
+    """ Gets the name of the bucket to store raw data in from the
+        INGESTION_BUCKET environment variable, falling back to looking it up
+        using the prefix. Lookups are cached across warm invocations."""
+    return os.environ.get('INGESTION_BUCKET') or resolve_config(
+        'ingestion_bucket', find_ingestion_bucket_name)
+
+
+def find_ingestion_bucket_name():
     """ Gets the name of the bucket to store raw data in using the prefix."""
     prefix = 'terrific-totes-ingestion-bucket'
     buckets = boto3.client("s3").list_buckets().get("Buckets")
@@ -94,7 +290,8 @@ class InvalidCredentialsError (Exception):
 
 
 def get_credentials(secret_name='Ingestion_credentials'):
-    """ Loads a set of DB credentials using a secret stored in AWS secrets.
+    """ Loads a set of DB credentials using a secret stored in AWS secrets,
+        cached across warm invocations.
 
         Args:
             secret_name: The name of the secret to extract credentials from,
@@ -114,6 +311,12 @@ def get_credentials(secret_name='Ingestion_credentials'):
         Raises:
             InvalidCredentialsError if the keys of the dictionary are invalid.
     """
+    return resolve_config(secret_name, lambda: fetch_credentials(secret_name))
+
+
+def fetch_credentials(secret_name):
+    """ Loads and validates a set of DB credentials from AWS secrets without
+        caching, see get_credentials."""
 
     secretsmanager = boto3.client('secretsmanager')
     credentials_response = secretsmanager.get_secret_value(
@@ -135,48 +338,250 @@ def get_credentials(secret_name='Ingestion_credentials'):
     return credentials
 
 
-def connect(db="ingestion"):
-    """ Will return a connection to the ingestion database. If passed the
+def open_connection(db="ingestion"):
+    """ Will return a new connection to the ingestion database. If passed the
         argument "warehouse", will instead establish a connection to the data
-        warehouse. To be used with context manager. """
+        warehouse. Prefer connect(), which reuses a warm connection. """
     if db == "warehouse":
-        credentials = get_credentials("Warehouse_credentials")
+        secret_name = "Warehouse_credentials"
+    else:
+        secret_name = "Ingestion_credentials"
+    credentials = get_credentials(secret_name)
+    if db == "warehouse":
+        database = 'postgres'
+    else:
+        database = credentials['db']
 
+    try:
         return pg8000.Connection(
             user=credentials['username'],
             password=credentials['password'],
             host=credentials['hostname'],
-            database='postgres',
+            database=database,
             port=credentials['port']
         )
-    else:
-        credentials = get_credentials()
+    except pg8000.DatabaseError:
+        # The secret may have been rotated, so fetch it again next time.
+        config_cache.pop(secret_name, None)
+        raise
 
-        return pg8000.Connection(
-            user=credentials['username'],
-            password=credentials['password'],
-            host=credentials['hostname'],
-            database=credentials['db'],
-            port=credentials['port']
+
+connection_manager = ConnectionManager(open_connection)
+
+
+def connect(db="ingestion", worker=0):
+    """ Will return a connection to the ingestion database. If passed the
+        argument "warehouse", will instead establish a connection to the data
+        warehouse. To be used with context manager, the connection is kept
+        open between uses and across warm invocations. Concurrent callers
+        should each pass their own worker number so they are not handed the
+        same connection. """
+    return connection_manager.lease(db, worker)
+
+
+class S3MultipartWriter:
+    """ A write-only file-like object that sends everything written to it to a
+        single S3 object using a multipart upload, so that the whole object
+        never has to be held in memory. Only up to part_size bytes are
+        buffered at a time.
+
+        To be used with context manager, the upload is completed on a clean
+        exit and aborted if an error is raised.
+    """
+
+    def __init__(self, s3_client, Bucket, key, part_size=MULTIPART_PART_SIZE,
+                 ContentType='application/text', Metadata=None):
+        self.s3_client = s3_client
+        self.bucket = Bucket
+        self.key = key
+        self.part_size = part_size
+        self.content_type = ContentType
+        self.metadata = Metadata or {}
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+        self.position = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer.extend(data)
+        self.position += len(data)
+        if len(self.buffer) >= self.part_size:
+            self.upload_part()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def upload_part(self):
+        """ Sends the buffered data to S3 as the next part of the upload."""
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                ContentType=self.content_type,
+                Metadata=self.metadata
+            )['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Body=bytes(self.buffer),
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self.upload_id
         )
+        self.parts.append(
+            {'ETag': response['ETag'], 'PartNumber': part_number}
+        )
+        self.buffer.clear()
 
+    def close(self):
+        """ Sends any remaining buffered data and completes the upload."""
+        if self.closed:
+            return
+        if self.buffer or not self.parts:
+            self.upload_part()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+        self.closed = True
 
-class CsvBuilder:
-    """ For creating CSV without writing to a file."""
+    def abort(self):
+        """ Abandons the upload, discarding any parts already sent."""
+        if self.upload_id is not None and not self.closed:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id
+            )
+        self.closed = True
+
+
+class CsvFormat:
+    """ Encodes chunks of query rows as one csv, written to a binary file-like
+        object."""
+
+    extension = '.csv'
+    content_type = 'application/text'
+    compressible = True
+
+    def __init__(self, fileobj, columns):
+        self.fileobj = fileobj
+        self.column_names = [column['name'] for column in columns]
+        self.header_written = False
+
+    def write_rows(self, rows):
+        chunk = io.StringIO()
+        csv_writer = csv.writer(chunk)
+        if not self.header_written:
+            csv_writer.writerow(self.column_names)
+            self.header_written = True
+        csv_writer.writerows(rows)
+        self.fileobj.write(chunk.getvalue().encode('utf-8'))
+
+    def close(self):
+        pass
+
+
+class ParquetFormat:
+    """ Encodes chunks of query rows as one compressed parquet file, written to
+        a binary file-like object. Each chunk becomes an Arrow record batch
+        typed from the postgres column types, so readers do not have to infer
+        types from strings."""
+
+    extension = '.parquet'
+    content_type = 'application/vnd.apache.parquet'
+    compressible = False
+
+    def __init__(self, fileobj, columns):
+        self.schema = arrow_schema(columns)
+        self.writer = pq.ParquetWriter(
+            fileobj, self.schema, compression=PARQUET_COMPRESSION)
+
+    def write_rows(self, rows):
+        self.writer.write_batch(rows_to_record_batch(self.schema, rows))
+
+    def close(self):
+        self.writer.close()
+
+
+FORMATS = {
+    'csv': CsvFormat,
+    'parquet': ParquetFormat,
+}
 
-    def __init__(self):
-        self.rows = []
 
-    def write(self, row):
-        self.rows.append(row)
+def compress_output(sink, codec=None):
+    """ Returns a stream that compresses everything written to it with the
+        passed codec before writing it on to sink, or sink itself if codec is
+        None. Closing the returned stream also closes sink."""
+    if codec is None:
+        return sink
+    return pa.CompressedOutputStream(sink, codec)
 
-    def as_txt(self):
-        return ''.join(self.rows)
+
+def object_metadata(codec=None):
+    """ Returns the S3 metadata recording which codec an object was compressed
+        with, read by the transformation lambda to decompress it."""
+    if codec is None:
+        return {}
+    return {'codec': codec}
+
+
+def arrow_type(column):
+    """ Returns the Arrow type for a column description from pg8000."""
+    if column['type_oid'] == pg8000.NUMERIC and column['type_modifier'] > 4:
+        modifier = column['type_modifier'] - 4
+        return pa.decimal128(modifier >> 16 & 0xFFFF, modifier & 0xFFFF)
+    return ARROW_TYPES.get(column['type_oid'], pa.string())
+
+
+def arrow_schema(columns):
+    """ Returns an Arrow schema for a list of column descriptions from pg8000.
+    """
+    return pa.schema(
+        [pa.field(column['name'], arrow_type(column)) for column in columns]
+    )
+
+
+def rows_to_record_batch(schema, rows):
+    """ Converts query rows to an Arrow record batch with the passed schema.
+        Values in string columns that pg8000 decoded to other Python types
+        are converted with str."""
+    arrays = []
+    for field, values in zip(schema, zip(*rows)):
+        if field.type == pa.string():
+            values = [None if value is None else str(value)
+                      for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.record_batch(arrays, schema=schema)
 
 
 def get_last_ingestion_timestamp(Bucket):
     """ Extracts the timestamp of the most recently added csv in the passed
-        bucket.
+        bucket, from the names of its timestamp prefixes. The listing is
+        paginated, and objects at the top of the bucket such as the
+        watermark manifest and the checkpoints are skipped.
 
     Args:
         Bucket: Name of the bucket to pull csvs from.
@@ -184,91 +589,936 @@ def get_last_ingestion_timestamp(Bucket):
     Returns:
         last_timestamp: The timestamp from the most recently added
         csv, defaults to 1st Jan 1970 if no csvs in file.
+
+    Raises:
+        NonTimestampedCSVError if a table's data sits at the top of the
+        bucket rather than under a timestamp prefix.
     """
     s3_client = boto3.client("s3")
+    data_suffixes = tuple(
+        extension + suffix
+        for extension in ('.csv', '.parquet')
+        for suffix in [''] + list(COMPRESSION_SUFFIXES.values())
+    )
+    last_timestamp = dt(1970, 1, 1)
+    pages = s3_client.get_paginator('list_objects_v2').paginate(
+        Bucket=Bucket, Delimiter='/')
+    for page in pages:
+        for item in page.get('Contents', []):
+            if item['Key'].endswith(data_suffixes):
+                raise NonTimestampedCSVError
+        for prefix in page.get('CommonPrefixes', []):
+            try:
+                timestamp = dt.fromisoformat(prefix['Prefix'].rstrip('/'))
+            except ValueError:
+                continue
+            last_timestamp = max(last_timestamp, timestamp)
+    return last_timestamp
+
+
+def extracted_columns(table_name):
+    """ Returns the list of columns to extract from the passed table, or None
+        if the whole table should be extracted. See TABLE_COLUMNS."""
+    full_tables = os.environ.get('INGESTION_FULL_TABLES', '').split(',')
+    if table_name not in TABLE_COLUMNS or '*' in full_tables:
+        return None
+    if table_name in full_tables:
+        return None
+    return TABLE_COLUMNS[table_name] + ['last_updated']
+
+
+def incremental_query(table_name, last_timestamp, until=None):
+    """ Builds the query for the rows of the passed table that have been
+        updated since last_timestamp, and no later than until if it is
+        passed, selecting only the columns given by extracted_columns."""
+    columns = extracted_columns(table_name)
+    if columns is None:
+        select_str = '*'
+    else:
+        select_str = ', '.join(pg8000.identifier(name) for name in columns)
+    f_tablename = pg8000.identifier(table_name)
+    f_timestamp = pg8000.literal(last_timestamp.isoformat())
+    query_str = f'SELECT {select_str} FROM {f_tablename} WHERE '
+    query_str += f'last_updated > {f_timestamp}'
+    if until is not None:
+        f_until = pg8000.literal(until.isoformat())
+        query_str += f' AND last_updated <= {f_until}'
+    return query_str
+
+
+def query_table(db, table_name, last_timestamp, until=None):
+    """ Runs the incremental query on a single table, returning the pg8000
+        column descriptions and a list of the rows that were returned."""
+    query_str = incremental_query(table_name, last_timestamp, until)
+    try:
+        result = db.run(f'{query_str};')
+    except Exception:
+        raise TableIngestionError(f"Error querying {table_name} table")
+    if result == []:
+        logger.debug(
+            f"No new data in {table_name} since last ingestion."
+        )
+    else:
+        logger.info(f"Compiling new data from {table_name}.")
+    return db.columns, result
+
+
+def high_water_mark(columns, rows, current=None):
+    """ Returns the most recent last_updated value in the passed rows, or
+        current if that is more recent."""
+    index = [column['name'] for column in columns].index('last_updated')
+    latest = max(row[index] for row in rows)
+    if current is not None and current > latest:
+        return current
+    return latest
+
+
+def upload_object(s3_client, Bucket, key, body,
+                  ContentType='application/text', Metadata=None):
+    """ Writes a single csv string or file body to the passed key in the
+        bucket."""
+    logger.info(f'Writing "{key}" to bucket.')
+    s3_client.put_object(
+        Body=body,
+        Bucket=Bucket,
+        Key=key,
+        ContentType=ContentType,
+        Metadata=Metadata or {}
+    )
+
+
+def query_table_to_s3(db, s3_client, Bucket, key, table_name,
+                      last_timestamp, output_format='csv', codec=None,
+                      until=None):
+    """ Query engine: pulls the whole result of the incremental query into
+        memory and uploads it as a single object in the passed format,
+        compressed with codec if one is passed.
+
+    Returns:
+        The most recent last_updated value written, or None if the table had
+        no new data and no object was written.
+    """
+    columns, rows = query_table(db, table_name, last_timestamp, until)
+    if rows == []:
+        return None
+    write_rows_to_s3(s3_client, Bucket, key, columns, rows, output_format,
+                     codec)
+    return high_water_mark(columns, rows)
+
+
+def write_rows_to_s3(s3_client, Bucket, key, columns, rows,
+                     output_format='csv', codec=None):
+    """ Encodes rows described by pg8000 style column descriptions in the
+        passed format, compressed with codec if one is passed, and uploads
+        them to the passed key in a single request."""
+    output_class = FORMATS[output_format]
+    body = pa.BufferOutputStream()
+    stream = compress_output(body, codec)
+    output = output_class(stream, columns)
+    output.write_rows(rows)
+    output.close()
+    stream.close()
+    upload_object(
+        s3_client, Bucket, key, body.getvalue().to_pybytes(),
+        output_class.content_type, object_metadata(codec)
+    )
+
+
+def stream_table_to_s3(db, s3_client, Bucket, key, table_name,
+                       last_timestamp, output_format='csv', codec=None,
+                       until=None, chunk_size=None):
+    """ Stream engine: reads the result of the incremental query through a
+        server-side cursor chunk_size rows at a time, encoding each chunk in
+        the passed format and passing it straight to an S3 multipart upload,
+        through codec if one is passed. Peak memory is bounded by the chunk
+        and part sizes rather than the table size.
+
+    Returns:
+        The most recent last_updated value written, or None if the table had
+        no new data and no object was written.
+    """
+    chunk_size = chunk_size or STREAM_CHUNK_ROWS
+    query_str = incremental_query(table_name, last_timestamp, until)
+    fetch_str = f'FETCH FORWARD {int(chunk_size)} FROM ingestion_cursor;'
+
     try:
-        res = s3_client.list_objects_v2(Bucket=Bucket)['Contents']
-    except KeyError:
-        return dt(1970, 1, 1)
-    names = [item['Key'] for item in res]
-    sorted_names = sorted(names, reverse=True)
-    last_timestamp = sorted_names[0].split("/")[0]
+        db.run('START TRANSACTION;')
+        db.run(f'DECLARE ingestion_cursor NO SCROLL CURSOR FOR {query_str};')
+        rows = db.run(fetch_str)
+    except Exception:
+        raise TableIngestionError(f"Error querying {table_name} table")
+    if rows == []:
+        logger.debug(f"No new data in {table_name} since last ingestion.")
+        db.run('COMMIT;')
+        return None
+
+    logger.info(f"Streaming new data from {table_name}.")
+    columns = db.columns
+    output_class = FORMATS[output_format]
+    latest = None
+    with S3MultipartWriter(s3_client, Bucket, key,
+                           ContentType=output_class.content_type,
+                           Metadata=object_metadata(codec)) as writer:
+        stream = compress_output(writer, codec)
+        output = output_class(stream, columns)
+        while rows != []:
+            output.write_rows(rows)
+            latest = high_water_mark(columns, rows, latest)
+            try:
+                rows = db.run(fetch_str)
+            except Exception:
+                raise TableIngestionError(
+                    f"Error querying {table_name} table")
+        output.close()
+        stream.close()
+    db.run('CLOSE ingestion_cursor;')
+    db.run('COMMIT;')
+    return latest
+
+
+def copy_table_to_s3(db, s3_client, Bucket, key, table_name,
+                     last_timestamp, output_format='csv', codec=None,
+                     until=None):
+    """ Copy engine: runs the incremental query through COPY ... TO STDOUT so
+        that postgres produces the csv itself, piping it straight into an S3
+        multipart upload, through codec if one is passed, without decoding
+        any rows in Python. The high-water
+        mark is read in the same repeatable read transaction, so it matches
+        the rows that were copied.
+
+        Only csv can be produced this way, other formats are handed to the
+        stream engine. If the COPY is refused by the database, the table is
+        extracted with the query engine instead.
+
+    Returns:
+        The most recent last_updated value written, or None if the table had
+        no new data and no object was written.
+    """
+    if output_format != 'csv':
+        return stream_table_to_s3(db, s3_client, Bucket, key, table_name,
+                                  last_timestamp, output_format, codec,
+                                  until)
+
+    query_str = incremental_query(table_name, last_timestamp, until)
+    copy_str = f'COPY ({query_str}) TO STDOUT WITH (FORMAT csv, HEADER true);'
+    max_str = f'SELECT max(last_updated) FROM ({query_str}) AS copied;'
+
     try:
-        last_timestamp = dt.fromisoformat(last_timestamp)
-    except ValueError:
-        raise NonTimestampedCSVError
-    return last_timestamp
+        db.run('START TRANSACTION ISOLATION LEVEL REPEATABLE READ;')
+        with S3MultipartWriter(s3_client, Bucket, key,
+                               Metadata=object_metadata(codec)) as writer:
+            stream = compress_output(writer, codec)
+            db.run(copy_str, stream=stream)
+            if db.row_count == 0:
+                writer.abort()
+            stream.close()
+    except pg8000.DatabaseError as error:
+        db.run('ROLLBACK;')
+        logger.warning(
+            f"COPY failed for {table_name} table, falling back to the query "
+            f"engine: {error}"
+        )
+        return query_table_to_s3(db, s3_client, Bucket, key, table_name,
+                                 last_timestamp, output_format, codec,
+                                 until)
+
+    if db.row_count == 0:
+        logger.debug(f"No new data in {table_name} since last ingestion.")
+        db.run('COMMIT;')
+        return None
+    logger.info(f"Copied {db.row_count} rows from {table_name}.")
+    try:
+        latest = db.run(max_str)[0][0]
+    except Exception:
+        raise TableIngestionError(f"Error querying {table_name} table")
+    db.run('COMMIT;')
+    return latest
+
 
+ENGINES = {
+    'query': query_table_to_s3,
+    'stream': stream_table_to_s3,
+    'copy': copy_table_to_s3,
+}
 
-def extract_table_to_csv(table_list, last_timestamp):
-    """ Runs a query on the given tables filtered by the given timestamp to
-        return only newly added data.
+
+def extract_tables_to_s3(Bucket, table_list, watermarks, max_workers=1,
+                         engine='query', output_format='csv', codec=None):
+    """ Queries each table for rows updated since its watermark and uploads
+        them as csvs under a single new timestamp prefix. Each table is
+        handled by a worker in a bounded thread pool, each worker using its
+        own database connection, so with several workers the run takes
+        roughly as long as the slowest table rather than the sum of them all.
 
     Args:
+        Bucket: Name of the bucket to add csvs to.
+
         table_list: The list of table names to query.
 
-        last_timestamp: A datetime.datetime object, all entries with a
-        last_updated key more recent than this will be pulled from the table.
+        watermarks: A dict of table names paired with a datetime.datetime
+        object, all entries with a last_updated key more recent than this
+        will be pulled from that table.
+
+        max_workers: The maximum number of tables to process at once,
+        defaults to 1.
+
+        engine: The name of the entry in ENGINES used to move each table from
+        the database to S3, defaults to query.
+
+        output_format: The name of the entry in FORMATS each table is written
+        in, defaults to csv.
+
+        codec: The name of the entry in COMPRESSION_SUFFIXES to compress each
+        table with, defaults to None for no compression. Ignored for formats
+        that compress themselves, such as parquet.
 
     Returns:
-        updated_tables: A dict of each table name that had a return from the
-        postgres query as keys and the return formatted to a csv as the value.
+        written: A dict of each table name that had new data, paired with a
+        dict of:
+            "Key": the key the table was written to, all keys share a single
+            timestamp prefix.
+            "LastUpdated": the most recent last_updated value written.
+
+    Raises:
+        TableIngestionError if any table fails. Any csvs already written
+        during the run are deleted first, so a failed run leaves no partial
+        timestamp prefix behind.
     """
-    updated_tables = {}
+    current_timestamp = dt.now()
+    s3_client = boto3.client("s3")
+
+    # Each worker number maps to its own cached connection, a worker number
+    # is checked out for the duration of a task so no two threads share one.
+    free_workers = queue.Queue()
+    for worker in range(max_workers):
+        free_workers.put(worker)
+
+    extract = ENGINES[engine]
+    extension = FORMATS[output_format].extension
+    if not FORMATS[output_format].compressible:
+        codec = None
+    if codec is not None:
+        extension += COMPRESSION_SUFFIXES[codec]
+
+    def extract_and_upload(table_name):
+        key = f'{current_timestamp.isoformat()}/{table_name}{extension}'
+        worker = free_workers.get()
+        try:
+            with connect(worker=worker) as db:
+                latest = extract(
+                    db, s3_client, Bucket, key, table_name,
+                    watermarks[table_name], output_format, codec
+                )
+        except TableIngestionError:
+            raise
+        except Exception:
+            raise TableIngestionError(f"Error uploading {table_name} table")
+        finally:
+            free_workers.put(worker)
+        if latest is None:
+            return None
+        return {'Key': key, 'LastUpdated': latest}
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {
+        pool.submit(extract_and_upload, table_name): table_name
+        for table_name in table_list
+    }
+    try:
+        for future in as_completed(futures):
+            future.result()
+    except Exception:
+        pool.shutdown(wait=True, cancel_futures=True)
+        written_keys = [
+            future.result()['Key'] for future in futures
+            if not future.cancelled() and future.exception() is None
+            and future.result() is not None
+        ]
+        for key in written_keys:
+            logger.info(f'Removing "{key}" from failed run.')
+            s3_client.delete_object(Bucket=Bucket, Key=key)
+        raise
+    finally:
+        pool.shutdown()
+
+    return {
+        table_name: future.result() for future, table_name in futures.items()
+        if future.result() is not None
+    }
+
+
+def get_watermarks(Bucket, table_list):
+    """ Reads the per-table high-water marks from the watermark manifest in
+        the passed bucket with a single GET.
+
+    Args:
+        Bucket: Name of the bucket holding the manifest.
+
+        table_list: The list of table names to return watermarks for.
+
+    Returns:
+        watermarks: A dict of each table name paired with the most recent
+        last_updated value already ingested from it, as a datetime.datetime.
+        Tables missing from the manifest default to 1st Jan 1970. If there is
+        no manifest yet, every table falls back to the most recent timestamp
+        prefix in the bucket.
+    """
+    s3_client = boto3.client("s3")
+    try:
+        manifest = json.loads(s3_client.get_object(
+            Bucket=Bucket, Key=WATERMARK_MANIFEST_KEY
+        )['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        logger.info("No watermark manifest found, using timestamp prefixes.")
+        last = get_last_ingestion_timestamp(Bucket)
+        return {table_name: last for table_name in table_list}
+    return {
+        table_name: dt.fromisoformat(
+            manifest[table_name]['last_updated']
+        ) if table_name in manifest else dt(1970, 1, 1)
+        for table_name in table_list
+    }
+
+
+def changed_tables(table_list, watermarks):
+    """ Finds the tables that have been updated since their watermark, using
+        a single query for the most recent last_updated value of every table
+        rather than running each table's full incremental query. The decision
+        made for each table is logged.
+
+    Args:
+        table_list: The list of table names to check.
+
+        watermarks: A dict of table names paired with a datetime.datetime
+        object, as returned by get_watermarks.
+
+    Returns:
+        changed: The list of table names, in their original order, that have
+        rows with a last_updated more recent than their watermark. If the
+        check itself fails every table is returned, so the run falls back to
+        querying them all.
+    """
+    query_str = ' UNION ALL '.join(
+        f'SELECT {pg8000.literal(table_name)}, max(last_updated) '
+        f'FROM {pg8000.identifier(table_name)}'
+        for table_name in table_list
+    )
+    try:
+        with connect() as db:
+            latest = dict(db.run(f'{query_str};'))
+    except Exception as error:
+        logger.warning(
+            f"Change detection failed, extracting every table: {error}"
+        )
+        return list(table_list)
+
+    changed = []
     for table_name in table_list:
-        f_tablename = pg8000.identifier(table_name)
-        f_timestamp = pg8000.literal(last_timestamp.isoformat())
+        last_updated = latest.get(table_name)
+        if last_updated is None or last_updated <= watermarks[table_name]:
+            logger.info(f"Skipping {table_name}, unchanged since "
+                        f"{watermarks[table_name].isoformat()}.")
+        else:
+            logger.info(f"Extracting {table_name}, updated at "
+                        f"{last_updated.isoformat()}.")
+            changed.append(table_name)
+    logger.info(
+        f"{len(table_list) - len(changed)} of {len(table_list)} tables "
+        f"unchanged, skipped their extraction queries."
+    )
+    return changed
+
+
+def update_watermarks(Bucket, watermarks, written):
+    """ Writes the watermark manifest back to the passed bucket with a single
+        PUT, advancing the watermark of each table that had new data.
+
+    Args:
+        Bucket: Name of the bucket holding the manifest.
+
+        watermarks: The dict of table names and watermarks the run started
+        from, as returned by get_watermarks.
+
+        written: The dict returned by extract_tables_to_s3.
+
+    Returns:
+        None
+    """
+    manifest = {
+        table_name: {'last_updated': last_updated.isoformat()}
+        for table_name, last_updated in watermarks.items()
+    }
+    for table_name, output in written.items():
+        manifest[table_name] = {
+            'last_updated': output['LastUpdated'].isoformat()
+        }
+    boto3.client("s3").put_object(
+        Body=json.dumps(manifest, indent=2),
+        Bucket=Bucket,
+        Key=WATERMARK_MANIFEST_KEY,
+        ContentType='application/json'
+    )
+
+
+def get_backfill_checkpoint(Bucket):
+    """ Reads the backfill checkpoint from the passed bucket, returning None
+        if no backfill is under way."""
+    s3_client = boto3.client("s3")
+    try:
+        return json.loads(s3_client.get_object(
+            Bucket=Bucket, Key=BACKFILL_CHECKPOINT_KEY
+        )['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+
+def put_backfill_checkpoint(Bucket, checkpoint):
+    """ Writes the backfill checkpoint to the passed bucket."""
+    boto3.client("s3").put_object(
+        Body=json.dumps(checkpoint, indent=2),
+        Bucket=Bucket,
+        Key=BACKFILL_CHECKPOINT_KEY,
+        ContentType='application/json'
+    )
+
+
+def plan_backfill(table_list, window_days=None):
+    """ Splits the passed tables into last_updated ranges of window_days,
+        using a single query for the oldest and newest last_updated value
+        across every table.
+
+    Args:
+        table_list: The list of table names to backfill.
+
+        window_days: The width of each range in days, defaults to
+        BACKFILL_WINDOW_DAYS.
+
+    Returns:
+        windows: A list of the datetime.datetime end of each range, oldest
+        first. Each range runs from the end of the previous one, exclusive,
+        to its own end, inclusive, the first starting at 1st Jan 1970. The
+        list is empty if every table is empty.
+    """
+    window = timedelta(days=window_days or BACKFILL_WINDOW_DAYS)
+    bounds_str = ' UNION ALL '.join(
+        'SELECT min(last_updated) AS oldest, max(last_updated) AS newest '
+        f'FROM {pg8000.identifier(table_name)}'
+        for table_name in table_list
+    )
+    try:
         with connect() as db:
-            try:
-                query_str = f'SELECT * FROM {f_tablename} WHERE '
-                query_str += f'last_updated > {f_timestamp};'
-                result = db.run(query_str)
-            except Exception:
-                raise TableIngestionError(f"Error querying {table_name} table")
-            if result == []:
-                logger.debug(
-                    f"No new data in {table_name} since last ingestion."
+            oldest, newest = db.run(
+                f'SELECT min(oldest), max(newest) FROM ({bounds_str}) '
+                'AS bounds;'
+            )[0]
+    except Exception:
+        raise TableIngestionError("Error planning backfill")
+    if newest is None:
+        return []
+    windows = []
+    end = oldest + window
+    while end < newest:
+        windows.append(end)
+        end += window
+    windows.append(newest)
+    return windows
+
+
+def backfill_tables_to_s3(Bucket, table_list, max_workers=1, engine='query',
+                          output_format='csv', codec=None, time_left=None):
+    """ Extracts the whole of each table in last_updated ranges, writing each
+        range of every table under a timestamp prefix named after the end of
+        the range so downstream stages process them oldest first. The ranges
+        are spread across a bounded thread pool, each worker using its own
+        database connection.
+
+        Progress is checkpointed in the ingestion bucket after every range of
+        every table, so an invocation that runs out of time or fails is
+        resumed by the next one rather than restarted. Once every range is
+        written the watermark of each table is set to the end of the last
+        range and the checkpoint is removed.
+
+    Args:
+        Bucket: Name of the bucket to add tables to.
+
+        table_list: The list of table names to backfill.
+
+        max_workers: The maximum number of ranges to process at once,
+        defaults to 1.
+
+        engine, output_format, codec: As for extract_tables_to_s3.
+
+        time_left: A callable returning the milliseconds left in the
+        invocation, such as context.get_remaining_time_in_millis. No new
+        ranges are started within BACKFILL_TIME_MARGIN_SECONDS of the end,
+        other than the first range of the invocation. Defaults to None for
+        no limit.
+
+    Returns:
+        finished: True if every range has been written, False if some were
+        left for the next invocation.
+
+    Raises:
+        TableIngestionError if any range fails, after checkpointing the
+        ranges that were written.
+    """
+    s3_client = boto3.client("s3")
+    checkpoint = get_backfill_checkpoint(Bucket)
+    if checkpoint is None:
+        windows = plan_backfill(table_list)
+        checkpoint = {
+            'windows': [
+                end.isoformat(timespec='microseconds') for end in windows
+            ],
+            'completed': [],
+        }
+        put_backfill_checkpoint(Bucket, checkpoint)
+        logger.info(f"Planned backfill of {len(windows)} ranges.")
+    else:
+        logger.info(
+            f"Resuming backfill, {len(checkpoint['completed'])} ranges "
+            f"already written."
+        )
+
+    free_workers = queue.Queue()
+    for worker in range(max_workers):
+        free_workers.put(worker)
+
+    extract = ENGINES[engine]
+    extension = FORMATS[output_format].extension
+    if not FORMATS[output_format].compressible:
+        codec = None
+    if codec is not None:
+        extension += COMPRESSION_SUFFIXES[codec]
+
+    started = []
+    started_lock = threading.Lock()
+
+    def extract_range(start, end, table_name):
+        with started_lock:
+            if started and time_left is not None and \
+                    time_left() < BACKFILL_TIME_MARGIN_SECONDS * 1000:
+                return False
+            started.append(f'{end}/{table_name}')
+        key = f'{end}/{table_name}{extension}'
+        worker = free_workers.get()
+        try:
+            with connect(worker=worker) as db:
+                extract(
+                    db, s3_client, Bucket, key, table_name,
+                    dt.fromisoformat(start), output_format, codec,
+                    until=dt.fromisoformat(end)
                 )
+        except TableIngestionError:
+            raise
+        except Exception:
+            raise TableIngestionError(
+                f"Error uploading {table_name} table up to {end}")
+        finally:
+            free_workers.put(worker)
+        return True
+
+    starts = [dt(1970, 1, 1).isoformat()] + checkpoint['windows'][:-1]
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {
+        pool.submit(extract_range, start, end, table_name):
+            f'{end}/{table_name}'
+        for start, end in zip(starts, checkpoint['windows'])
+        for table_name in table_list
+        if f'{end}/{table_name}' not in checkpoint['completed']
+    }
+    total = len(futures) + len(checkpoint['completed'])
+    finished = True
+    try:
+        for future in as_completed(futures):
+            if future.result():
+                checkpoint['completed'].append(futures[future])
+                put_backfill_checkpoint(Bucket, checkpoint)
             else:
-                logger.info(f"Compiling new data from {table_name} to csv.")
-            column_names = [column['name'] for column in db.columns]
-            rows = [dict(zip(column_names, row)) for row in result]
-            csv_builder = CsvBuilder()
-            csv_writer = csv.DictWriter(
-                csv_builder, fieldnames=column_names)
-            if rows != []:
-                csv_writer.writeheader()
-                csv_writer.writerows(rows)
-                csv_text = csv_builder.as_txt()
-                updated_tables[table_name] = csv_text
-    return updated_tables
-
-
-def csv_to_s3(Bucket, updated_table_list):
-    """ Extracts new csv data from each table and saves to timestamped files in
-        the bucket.
+                finished = False
+    except Exception:
+        pool.shutdown(wait=True, cancel_futures=True)
+        for future, name in futures.items():
+            if not future.cancelled() and future.exception() is None \
+                    and future.result() and \
+                    name not in checkpoint['completed']:
+                checkpoint['completed'].append(name)
+        put_backfill_checkpoint(Bucket, checkpoint)
+        raise
+    finally:
+        pool.shutdown()
+
+    if not finished:
+        logger.info(
+            f"Backfill paused with {len(checkpoint['completed'])} of "
+            f"{total} ranges written."
+        )
+        return False
+
+    if checkpoint['windows']:
+        end = dt.fromisoformat(checkpoint['windows'][-1])
+        update_watermarks(
+            Bucket, {table_name: end for table_name in table_list}, {})
+    s3_client.delete_object(Bucket=Bucket, Key=BACKFILL_CHECKPOINT_KEY)
+    logger.info("Backfill complete.")
+    return True
+
+
+def lsn_to_int(lsn):
+    """ Converts a postgres log sequence number such as "16/B374D848" into an
+        int that can be compared with other log sequence numbers."""
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def get_replication_checkpoint(Bucket):
+    """ Returns the log sequence number of the last transaction the cdc engine
+        wrote to the passed bucket, or None if it has not run before."""
+    s3_client = boto3.client("s3")
+    try:
+        checkpoint = json.loads(s3_client.get_object(
+            Bucket=Bucket, Key=REPLICATION_CHECKPOINT_KEY
+        )['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return checkpoint['confirmed_lsn']
+
+
+def put_replication_checkpoint(Bucket, slot, lsn):
+    """ Records the log sequence number of the last transaction the cdc engine
+        wrote to the passed bucket."""
+    boto3.client("s3").put_object(
+        Body=json.dumps({'slot': slot, 'confirmed_lsn': lsn}, indent=2),
+        Bucket=Bucket,
+        Key=REPLICATION_CHECKPOINT_KEY,
+        ContentType='application/json'
+    )
+
+
+def peek_transactions(db, slot, table_list, max_changes):
+    """ Reads decoded changes to the passed tables from a logical replication
+        slot without consuming them, creating the slot if it does not exist.
+
+    Returns:
+        transactions: A list of (commit_lsn, changes) tuples in commit order,
+        where changes is a list of the wal2json (format-version 2) change
+        dicts made by that transaction.
+    """
+    exists = db.run(
+        'SELECT 1 FROM pg_replication_slots WHERE slot_name = :slot;',
+        slot=slot
+    )
+    if exists == []:
+        logger.info(f"Creating replication slot {slot}.")
+        db.run(
+            'SELECT pg_create_logical_replication_slot(:slot, :plugin);',
+            slot=slot, plugin=REPLICATION_PLUGIN
+        )
+        logger.warning(
+            f"Replication slot {slot} only sees changes made from now on, "
+            "rows that already exist must be ingested with a backfill.")
+    add_tables = ','.join(f'public.{table_name}' for table_name in table_list)
+    rows = db.run(
+        "SELECT lsn::text, data FROM pg_logical_slot_peek_changes("
+        ":slot, NULL, :max_changes, 'format-version', '2', "
+        "'include-transaction', 'true', 'add-tables', :add_tables);",
+        slot=slot, max_changes=max_changes, add_tables=add_tables
+    )
+    transactions = []
+    changes = []
+    for lsn, data in rows:
+        change = json.loads(data)
+        if change['action'] == 'B':
+            changes = []
+        elif change['action'] == 'C':
+            transactions.append((lsn, changes))
+        else:
+            changes.append(change)
+    return transactions
+
+
+def collect_changes(transactions, checkpoint=None):
+    """ Folds the changes of transactions committed after checkpoint into the
+        latest version of each row, so a row changed several times in the
+        batch is only written once. Rows are keyed by their first column,
+        the primary key of every totesys table.
+
+    Returns:
+        upserts: A dict of each table name paired with a dict of the latest
+        inserted or updated version of each row, keyed by primary key, with
+        each row a dict of column name to value.
+
+        deletes: A dict of each table name paired with a dict of the identity
+        columns of each deleted row, keyed by primary key. A row deleted and
+        then inserted again in the batch is only an upsert.
+
+        truncated: A dict of each truncated table name paired with the commit
+        lsn of the transaction that last truncated it. Rows inserted after
+        the truncate are still upserts.
+    """
+    upserts = {}
+    deletes = {}
+    truncated = {}
+    for commit_lsn, changes in transactions:
+        if checkpoint and lsn_to_int(commit_lsn) <= lsn_to_int(checkpoint):
+            continue
+        for change in changes:
+            table_name = change['table']
+            if change['action'] == 'T':
+                upserts.pop(table_name, None)
+                deletes.pop(table_name, None)
+                truncated[table_name] = commit_lsn
+            elif change['action'] == 'D':
+                values = {column['name']: column['value']
+                          for column in change['identity']}
+                row_key = next(iter(values.values()))
+                upserts.get(table_name, {}).pop(row_key, None)
+                deletes.setdefault(table_name, {})[row_key] = values
+            elif change['action'] in ('I', 'U'):
+                values = {column['name']: column['value']
+                          for column in change['columns']}
+                row_key = next(iter(values.values()))
+                deletes.get(table_name, {}).pop(row_key, None)
+                upserts.setdefault(table_name, {})[row_key] = values
+    return upserts, deletes, truncated
+
+
+def replicate_changes_to_s3(Bucket, table_list, output_format='csv',
+                            codec=None, slot=REPLICATION_SLOT,
+                            max_changes=REPLICATION_BATCH_CHANGES):
+    """ CDC engine: reads the changes made to the passed tables from a logical
+        replication slot and writes the latest version of each inserted or
+        updated row to <table> under a single new timestamp prefix. Unlike
+        polling on last_updated this costs nothing for tables that did not
+        change.
+
+        The slot is created on the first run and only sees changes made after
+        that, there is no initial snapshot. Rows that already exist must be
+        ingested with a backfill of the query engine once the slot exists.
+
+        The transformation and the warehouse only ever add or update rows, so
+        deleted rows and truncated tables cannot be applied. They are
+        appended to REPLICATION_DELETES_KEY and logged as an Unreplicated
+        Delete Error, which raises an alarm, so that they can be removed from
+        the warehouse by hand. The upserts are still written and the slot
+        advanced, so one delete does not stop the replication of every table.
+
+        The slot is only advanced after the objects and the checkpoint have
+        been written. Transactions at or before the checkpoint are skipped,
+        so a run that fails between the two does not write them twice.
 
     Args:
-        Bucket: Name of the bucket to add csvs to.
+        Bucket: Name of the bucket to write to.
 
-        updated_table_list: A dict of the table names to perform the function
-        on, paired with the csv data to write.
+        table_list: The list of table names to replicate.
+
+        output_format: The name of the entry in FORMATS to write in, defaults
+        to csv. Column types are not known from the changes, so all columns
+        are written as strings.
+
+        codec: The name of the entry in COMPRESSION_SUFFIXES to compress csvs
+        with, defaults to None for no compression.
+
+        slot: The name of the replication slot to read.
+
+        max_changes: The approximate maximum number of changes to read.
 
     Returns:
-        None
+        written: A list of the keys that were written.
 
-    Side-effects:
-        Uploads the timestamped csvs with new data to S3.
+    Raises:
+        TableIngestionError if the slot cannot be read or the changes cannot
+        be written.
     """
-    current_timestamp = dt.now()
+    checkpoint = get_replication_checkpoint(Bucket)
+    logger.info(f"Replication checkpoint is {checkpoint}.")
+    with connect() as db:
+        try:
+            transactions = peek_transactions(
+                db, slot, table_list, max_changes)
+        except Exception:
+            raise TableIngestionError(f"Error reading replication slot {slot}")
+    if transactions == []:
+        logger.info("No new changes in replication slot.")
+        return []
+
+    upserts, deletes, truncated = collect_changes(transactions, checkpoint)
+    current_timestamp = dt.now().isoformat()
+    extension = FORMATS[output_format].extension
+    if codec is not None and FORMATS[output_format].compressible:
+        extension += COMPRESSION_SUFFIXES[codec]
+    else:
+        codec = None
+
     s3_client = boto3.client("s3")
-    for table in updated_table_list.keys():
-        key = f'{current_timestamp.isoformat()}/{table}.csv'
-        logger.info(f'Writing "{key}" to bucket.')
-        output_csv = updated_table_list[table]
-        s3_client.put_object(
-            Body=output_csv,
-            Bucket=Bucket,
-            Key=key,
-            ContentType='application/text'
+    written = []
+    try:
+        for table_name, rows_by_key in upserts.items():
+            rows = list(rows_by_key.values())
+            column_names = extracted_columns(table_name) or list(rows[0])
+            column_names = [name for name in column_names if name in rows[0]]
+            columns = [{'name': name, 'type_oid': pg8000.TEXT,
+                        'type_modifier': -1} for name in column_names]
+            key = f'{current_timestamp}/{table_name}{extension}'
+            logger.info(f"Writing {len(rows)} changed rows from {table_name}.")
+            write_rows_to_s3(
+                s3_client, Bucket, key, columns,
+                [[row.get(name) for name in column_names] for row in rows],
+                output_format, codec
+            )
+            written.append(key)
+    except Exception:
+        for key in written:
+            logger.info(f'Removing "{key}" from failed run.')
+            s3_client.delete_object(Bucket=Bucket, Key=key)
+        raise TableIngestionError("Error writing replicated changes")
+
+    confirmed_lsn = transactions[-1][0]
+    if deletes or truncated:
+        record_deletes(Bucket, confirmed_lsn, deletes, truncated)
+
+    # Checkpoint before advancing the slot, if advancing fails the next run
+    # reads the same transactions again and skips them.
+    put_replication_checkpoint(Bucket, slot, confirmed_lsn)
+    with connect() as db:
+        db.run(
+            'SELECT pg_replication_slot_advance(:slot, :lsn::pg_lsn);',
+            slot=slot, lsn=confirmed_lsn
         )
+    logger.info(f"Replication slot {slot} advanced to {confirmed_lsn}.")
+    return written
+
+
+def record_deletes(Bucket, lsn, deletes, truncated):
+    """ Appends the primary keys of the passed deleted rows and the names of
+        the passed truncated tables, as returned by collect_changes, to
+        REPLICATION_DELETES_KEY in the passed bucket, and logs them as an
+        Unreplicated Delete Error so that the alarm on it is raised."""
+    s3_client = boto3.client("s3")
+    try:
+        records = json.loads(s3_client.get_object(
+            Bucket=Bucket, Key=REPLICATION_DELETES_KEY
+        )['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        records = []
+    records.append({
+        'lsn': lsn,
+        'deleted': {
+            table_name: list(rows) for table_name, rows in deletes.items()
+        },
+        'truncated': sorted(truncated),
+    })
+    s3_client.put_object(
+        Body=json.dumps(records, indent=2),
+        Bucket=Bucket,
+        Key=REPLICATION_DELETES_KEY,
+        ContentType='application/json'
+    )
+    summary = [
+        f"{len(rows)} deleted from {table_name}"
+        for table_name, rows in sorted(deletes.items())
+    ] + [f"{table_name} truncated" for table_name in sorted(truncated)]
+    logger.error(
+        f"Unreplicated Delete Error: {', '.join(summary)} up to {lsn}, "
+        f"recorded in {REPLICATION_DELETES_KEY} to be removed from the "
+        "warehouse by hand.")
@@ -1,19 +1,43 @@
 import boto3
 import logging
+import pyarrow as pa
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 from pyarrow import fs
 import pg8000.native as pg
 import json
+import os
+from pipeline_common.compaction import compact_if_due
+from pipeline_common.config import config_cache, resolve_config
+from pipeline_common.connection import ConnectionManager
+from pipeline_common.warehouse_schemas import (
+    WAREHOUSE_SCHEMAS,
+    conform_to_schema,
+)
 
 
 logger = logging.getLogger('MyLogger')
 logger.setLevel(logging.INFO)
 
+# Partitioning of the hive layout written when PROCESSED_LAYOUT is hive,
+# table=<table>/ingest_date=<YYYY-MM-DD>/<timestamp>.parquet.
+HIVE_PARTITIONING = ds.partitioning(
+    pa.schema([('ingest_date', pa.string())]), flavor='hive')
+
+# Tables read from the hive layout, dimensions before facts. dim_date stays
+# at the root of the bucket in either layout.
+HIVE_TABLES = sorted(name for name in WAREHOUSE_SCHEMAS if name != 'dim_date')
+
+# Columns that order the versions of a warehouse row when coalescing, only
+# fact_sales_order has them.
+LAST_UPDATED_COLUMNS = ['last_updated_date', 'last_updated_time']
+
 
 def loading_lambda_handler(event, context):
     """ Reads parquet files from an s3 bucket and inserts the data contained
         within them into the data warehouse, using a cache file to ensure the
-        same entry is not inserted more than once.
+        same entry is not inserted more than once. The small parquets of
+        the bucket are then compacted when due, see compact_if_due.
     """
 
     # Define a boto3 s3 client.
@@ -46,8 +70,11 @@ def loading_lambda_handler(event, context):
     # Create a list of timestamp folders that exist in the parquet bucket.
     parquet_timestamps = list_timestamps(s3_boto, parquet_bucket)
 
-    # Compare the cache list with the timestamps that exist in the bucket.
-    diff_list = [item for item in parquet_timestamps if item not in cache_txt]
+    # Compare the cache list with the timestamps that exist in the bucket,
+    # ignoring the table partitions of the hive layout.
+    diff_list = [
+        item for item in parquet_timestamps
+        if item not in cache_txt and not item.startswith('table=')]
 
     # If there is no diffeence: there is no new data to insert.
     if diff_list == []:
@@ -67,17 +94,48 @@ def loading_lambda_handler(event, context):
             file = s3_py.get_file_info(parquet_bucket+"/dim_date.parquet")
             insert_data(s3_py, file)
 
+    coalesce = os.environ.get('LOADING_COALESCE', '').lower() == 'true'
+    hive = os.environ.get('PROCESSED_LAYOUT', 'timestamp') == 'hive'
+
+    # In the hive layout the timestamp prefixes only hold markers, so each
+    # table's pending partitions are read instead.
+    if hive and diff_list != []:
+        logger.info(f"Reading {len(diff_list)} pending timestamps by table.")
+        list_tables = (
+            (table, list_table) for table in HIVE_TABLES
+            for list_table in read_hive_table(
+                s3_py, parquet_bucket, table, diff_list)
+        )
+        if coalesce:
+            coalesced = coalesce_list_tables(list_tables)
+            for table in sorted(coalesced):
+                headers, rows = coalesced[table]
+                insert_rows(table, headers, rows)
+        else:
+            for table, list_table in list_tables:
+                insert_rows(table, list_table[0], list_table[1:])
+        cache_txt.extend(diff_list)
+        diff_list_to_load = []
+
+    # When several timestamps are pending, merge each table across all of
+    # them, keeping the latest version of each row, and insert it once.
+    elif coalesce and len(diff_list) > 1:
+        logger.info(f"Coalescing {len(diff_list)} pending timestamps.")
+        coalesced = coalesce_timestamps(s3_py, parquet_bucket, diff_list)
+        for table in sorted(coalesced):
+            headers, rows = coalesced[table]
+            insert_rows(table, headers, rows)
+        cache_txt.extend(diff_list)
+        diff_list_to_load = []
+    else:
+        diff_list_to_load = diff_list
+
     # For each timestamp that has yet to be processed:
-    for timestamp in diff_list:
+    for timestamp in diff_list_to_load:
         logger.info(f"Populating with data from {timestamp}.")
 
-        # List all files that belong to this timestamp.
-        folder_contents = s3_py.get_file_info(
-            fs.FileSelector(parquet_bucket + '/' + timestamp, recursive=False)
-        )
-
         # For each parquet file under this timestamp:
-        for file in folder_contents:
+        for file in list_parquet_files(s3_py, parquet_bucket, timestamp):
 
             # Insert the file's data into the appropriate table.
             insert_data(s3_py, file)
@@ -95,22 +153,160 @@ def loading_lambda_handler(event, context):
             Bucket=parquet_bucket, Key='cache.txt', Body='\n'.join(cache_txt)
         )
 
+    # Compact the small parquets once the load is done, rather than
+    # alongside it, as compaction rewrites cache.txt and deletes parquets.
+    compact_if_due(s3_py, parquet_bucket)
+
 
 def read_parquet(s3, file):
     """ Takes a pyarrow FileInfo object that points to a parquet file on s3 and
         returns the parquet file contents as a list of lists, one for each row
-        including column names.
+        including column names. Warehouse tables are conformed to their
+        schema in WAREHOUSE_SCHEMAS. The unnamed pandas index column that
+        older parquets converted from csvs by stage 2 start with is dropped.
         """
     fh = s3.open_input_file(file.path)
-    list_of_dicts = pq.read_table(fh).to_pylist()
-    list_table = [
-        list(list_of_dicts[0].keys())[1:]
-    ] + [
-        list(item.values())[1:] for item in list_of_dicts
+    table = conform_to_schema(pq.read_table(fh), file.base_name[:-8])
+    return to_list_table(table)
+
+
+def to_list_table(table):
+    """ Returns the contents of a pyarrow table as a list of lists, one for
+        each row including column names, without any unnamed column."""
+    columns = [name for name in table.column_names if name != '']
+    list_of_dicts = table.select(columns).to_pylist()
+    list_table = [columns] + [
+        list(item.values()) for item in list_of_dicts
     ]
     return list_table
 
 
+def read_hive_table(s3_py, bucket_name, table_name, timestamps):
+    """ Reads the parquets of one table written under the passed timestamps
+        in the hive layout, table=<table>/ingest_date=<YYYY-MM-DD>/
+        <timestamp>.parquet, using a pyarrow dataset of the table's
+        partitions. Only the ingest_date partitions of the timestamps are
+        listed, so neither the rest of the table's history nor any other
+        table or timestamp prefix is listed.
+
+        Args:
+            s3_py: A pyarrow s3 client.
+
+            bucket_name: The name of the parquet bucket.
+
+            table_name: The name of the warehouse table to read.
+
+            timestamps: The list of timestamp prefixes to read, oldest first.
+
+        Returns:
+            A list of the table's contents under each timestamp that has a
+            file, oldest first, each a list of lists as from read_parquet.
+    """
+    timestamps = [timestamp.rstrip('/') for timestamp in timestamps]
+    table_dir = f"{bucket_name}/table={table_name}"
+    dates = sorted({timestamp[:10] for timestamp in timestamps})
+    paths = [
+        file.path
+        for date in dates
+        for file in s3_py.get_file_info(fs.FileSelector(
+            f"{table_dir}/ingest_date={date}", allow_not_found=True))
+        if file.is_file and file.base_name[:-8] in timestamps
+    ]
+    if paths == []:
+        return []
+    dataset = ds.dataset(
+        paths, filesystem=s3_py, format='parquet',
+        partitioning=HIVE_PARTITIONING, partition_base_dir=table_dir)
+    fragments = {
+        fragment.path.split('/')[-1][:-8]: fragment
+        for fragment in dataset.get_fragments()
+    }
+    return [
+        to_list_table(conform_to_schema(
+            fragments[timestamp].to_table(), table_name))
+        for timestamp in timestamps if timestamp in fragments
+    ]
+
+
+def list_parquet_files(s3_py, bucket_name, timestamp):
+    """ Lists the parquet files under the passed timestamp prefix, skipping
+        any other files such as coalesced markers."""
+    folder_contents = s3_py.get_file_info(
+        fs.FileSelector(bucket_name + '/' + timestamp, recursive=False)
+    )
+    return [
+        file for file in folder_contents
+        if file.is_file and file.extension == 'parquet'
+    ]
+
+
+def coalesce_timestamps(s3_py, bucket_name, timestamps):
+    """ Reads the parquet files under each of the passed timestamp prefixes
+        and merges them per table, so that a row changed under several
+        timestamps is only inserted once.
+
+        Args:
+            s3_py: A pyarrow s3 client.
+
+            bucket_name: The name of the parquet bucket.
+
+            timestamps: The list of timestamp prefixes to merge, oldest first.
+
+        Returns:
+            coalesced: A dict of table names paired with a tuple of the
+            table's column headings and its rows, one for each primary key
+            (the first column) holding its newest version, see
+            coalesce_list_tables. The headings are those of the latest file.
+    """
+    return coalesce_list_tables(
+        (file.base_name[:-8], read_parquet(s3_py, file))
+        for timestamp in timestamps
+        for file in list_parquet_files(s3_py, bucket_name, timestamp)
+    )
+
+
+def coalesce_list_tables(list_tables):
+    """ Merges the contents of several files per table, keeping the newest
+        version of each primary key (the first column). Versions are ordered
+        by LAST_UPDATED_COLUMNS where both rows have them, and otherwise by
+        file, the row from the latest file winning.
+
+        Args:
+            list_tables: An iterable of pairs of a table name and its
+            contents as from read_parquet, oldest first.
+
+        Returns:
+            coalesced: A dict as returned by coalesce_timestamps.
+    """
+    merged = {}
+    for table, list_table in list_tables:
+        headers, rows = list_table[0], list_table[1:]
+        table_headers, table_rows = merged.setdefault(table, ([], {}))
+        table_headers[:] = headers
+        for row in rows:
+            values = dict(zip(headers, row))
+            current = table_rows.get(row[0])
+            if current is None or is_newer_version(values, current):
+                table_rows[row[0]] = values
+    return {
+        table: (headers, [
+            [row.get(header) for header in headers] for row in rows.values()
+        ])
+        for table, (headers, rows) in merged.items()
+    }
+
+
+def is_newer_version(row, current):
+    """ Bool for whether row, from a later file than current, is a newer
+        version of the same warehouse row. Rows without LAST_UPDATED_COLUMNS
+        values are taken to be newer."""
+    version = [row.get(column) for column in LAST_UPDATED_COLUMNS]
+    current_version = [current.get(column) for column in LAST_UPDATED_COLUMNS]
+    if None in version or None in current_version:
+        return True
+    return version >= current_version
+
+
 def list_timestamps(s3, bucket_name):
     """ Lists out all prefixes that exist in the passed bucket."""
     timestamps = s3.list_objects_v2(
@@ -121,6 +317,14 @@ def list_timestamps(s3, bucket_name):
 
 
 def get_parquet_bucket_name():
+    """ Gets the name of the bucket of processed data from the
+        PROCESSED_BUCKET environment variable, falling back to looking it up
+        using the prefix. Lookups are cached across warm invocations."""
+    return os.environ.get('PROCESSED_BUCKET') or resolve_config(
+        'parquet_bucket', find_parquet_bucket_name)
+
+
+def find_parquet_bucket_name():
     """ Gets the name of the bucket of processed data using the prefix."""
     prefix = 'terrific-totes-processed-bucket'
     buckets = boto3.client("s3").list_buckets().get("Buckets")
@@ -158,11 +362,27 @@ def insert_data(s3_py, file):
 
     # Reads the table name from the file's name.
     table = file.base_name[:-8]
-    logger.info(f"Populating {table}.")
 
     # Separates the column headings from the data.
-    headers = list_table[0]
-    list_table = list_table[1:]
+    insert_rows(table, list_table[0], list_table[1:])
+
+
+def insert_rows(table, headers, list_table):
+    """ Writes rows to the passed warehouse table using UPDATE or INSERT as
+        needed.
+
+        Args:
+            table: The name of the warehouse table.
+
+            headers: The list of column headings of the rows.
+
+            list_table: A list of rows, each a list of values in the order of
+            headers. The first value of each row is its primary key.
+
+        Returns:
+            None.
+    """
+    logger.info(f"Populating {table}.")
 
     with connect() as db:
 
@@ -228,7 +448,13 @@ def insert_data(s3_py, file):
 
 
 def get_credentials():
-    """ Loads a set of DB credentials using a secret stored in AWS secrets."""
+    """ Loads a set of DB credentials using a secret stored in AWS secrets,
+        cached across warm invocations."""
+    return resolve_config('Warehouse_credentials', fetch_credentials)
+
+
+def fetch_credentials():
+    """ Loads a set of DB credentials from AWS secrets without caching."""
 
     secretsmanager = boto3.client('secretsmanager')
     credentials_response = secretsmanager.get_secret_value(
@@ -238,18 +464,35 @@ def get_credentials():
     return credentials
 
 
-def connect():
-    """ Will return a connection to the DB, to be used with context manager."""
+def open_connection(db="warehouse"):
+    """ Will return a new connection to the DB. Prefer connect(), which reuses
+        a warm connection. Takes the name of the database for the
+        ConnectionManager, the loader only connects to the warehouse."""
 
     credentials = get_credentials()
 
-    return pg.Connection(
-        user=credentials['username'],
-        password=credentials['password'],
-        host=credentials['hostname'],
-        database='postgres',
-        port=credentials['port']
-    )
+    try:
+        return pg.Connection(
+            user=credentials['username'],
+            password=credentials['password'],
+            host=credentials['hostname'],
+            database='postgres',
+            port=credentials['port']
+        )
+    except pg.DatabaseError:
+        # The secret may have been rotated, so fetch it again next time.
+        config_cache.pop('Warehouse_credentials', None)
+        raise
+
+
+connection_manager = ConnectionManager(open_connection)
+
+
+def connect():
+    """ Will return a connection to the DB, to be used with context manager.
+        The connection is kept open between uses and across warm invocations.
+    """
+    return connection_manager.lease("warehouse")
 
 
 class MissingBucketError(Exception):
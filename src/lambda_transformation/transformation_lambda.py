@@ -1,7 +1,13 @@
 import boto3
 import logging
+import os
 import pandas as pd
-import csv
+import io
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from pipeline_common.config import resolve_config
 from utils.dim_counter_party import (
     counter_party_address_to_dim_counterparty as cpatdc
 )
@@ -13,27 +19,135 @@ from utils.dim_fact_sales_order import (
 )
 from utils.dim_location import address_to_dim_location as atdl
 from utils.dim_staff import staff_department_to_dim_staff as sdtds
+from utils.coalesce import coalesce_groups
+from utils.snapshot_store import SnapshotStore, join_with_snapshots
+from utils.warehouse_dtypes import apply_warehouse_dtypes
+from pipeline_common.parquet_writer import open_parquet_writer, writer_profile
+from pipeline_common.warehouse_schemas import WAREHOUSE_SCHEMAS
 
 
 logger = logging.getLogger('MyLogger')
 logger.setLevel(logging.INFO)
 
+# Default number of raw objects downloaded and parsed at once, overridden by
+# the TRANSFORMATION_FETCH_WORKERS environment variable to stay within S3
+# request rates.
+FETCH_WORKERS = 8
+
+# Name of the marker written under a timestamp prefix of the processed bucket
+# when its raw data was coalesced into a later prefix, so that the prefix is
+# counted as processed.
+COALESCED_MARKER = 'coalesced.txt'
+
+# Name of the marker written under a timestamp prefix of the processed bucket
+# when PROCESSED_LAYOUT is hive, as its tables are written to the partitions
+# of each table instead, so that the prefix is counted as processed.
+PROCESSED_MARKER = 'processed.txt'
+
+# The first bytes of every parquet file, used to tell them apart from csvs.
+PARQUET_MAGIC = b'PAR1'
+
+# Arrow types of the columns of each raw table, used to read their csvs into
+# typed DataFrames. Matches the totesys schema, so that columns such as phone
+# numbers are never inferred as numbers. Columns not listed are inferred.
+TIMESTAMPS = {
+    'created_at': pa.timestamp('us'),
+    'last_updated': pa.timestamp('us'),
+}
+TABLE_COLUMN_TYPES = {
+    'address': {
+        'address_id': pa.int32(),
+        'address_line_1': pa.string(),
+        'address_line_2': pa.string(),
+        'district': pa.string(),
+        'city': pa.string(),
+        'postal_code': pa.string(),
+        'country': pa.string(),
+        'phone': pa.string(),
+        **TIMESTAMPS,
+    },
+    'counterparty': {
+        'counterparty_id': pa.int32(),
+        'counterparty_legal_name': pa.string(),
+        'legal_address_id': pa.int32(),
+        'commercial_contact': pa.string(),
+        'delivery_contact': pa.string(),
+        **TIMESTAMPS,
+    },
+    'currency': {
+        'currency_id': pa.int32(),
+        'currency_code': pa.string(),
+        **TIMESTAMPS,
+    },
+    'department': {
+        'department_id': pa.int32(),
+        'department_name': pa.string(),
+        'location': pa.string(),
+        'manager': pa.string(),
+        **TIMESTAMPS,
+    },
+    'design': {
+        'design_id': pa.int32(),
+        'design_name': pa.string(),
+        'file_location': pa.string(),
+        'file_name': pa.string(),
+        **TIMESTAMPS,
+    },
+    'sales_order': {
+        'sales_order_id': pa.int32(),
+        'design_id': pa.int32(),
+        'staff_id': pa.int32(),
+        'counterparty_id': pa.int32(),
+        'units_sold': pa.int32(),
+        'unit_price': pa.decimal128(10, 2),
+        'currency_id': pa.int32(),
+        'agreed_delivery_date': pa.string(),
+        'agreed_payment_date': pa.string(),
+        'agreed_delivery_location_id': pa.int32(),
+        **TIMESTAMPS,
+    },
+    'staff': {
+        'staff_id': pa.int32(),
+        'first_name': pa.string(),
+        'last_name': pa.string(),
+        'department_id': pa.int32(),
+        'email_address': pa.string(),
+        **TIMESTAMPS,
+    },
+}
+
 
 def transformation_lambda_handler(event, context):
     """ Reads csv files from an s3 bucket, transforms them into the schema of
-        the data warehouse and saves them as csvs in another s3 bucket.
+        the data warehouse and saves them to another s3 bucket, as csvs for
+        stage 2 to convert or, if PROCESSED_FORMAT is parquet, directly as
+        parquets ready for loading.
     """
-    s3 = boto3.client('s3', region_name='eu-west-2')
+    fetch_workers = int(
+        os.environ.get('TRANSFORMATION_FETCH_WORKERS', FETCH_WORKERS))
+    s3 = boto3.client('s3', region_name='eu-west-2', config=Config(
+        max_pool_connections=max(fetch_workers, 10)))
+    output_format = os.environ.get('PROCESSED_FORMAT', 'csv')
+    write_output = OUTPUT_WRITERS[output_format]
+    coalesce = os.environ.get('TRANSFORMATION_COALESCE', '').lower() == 'true'
+
+    # The hive layout is only read by the loading lambda, so the tables must
+    # already be parquets.
+    hive = os.environ.get('PROCESSED_LAYOUT', 'timestamp') == 'hive'
+    if hive and output_format != 'parquet':
+        message = "PROCESSED_LAYOUT hive needs PROCESSED_FORMAT parquet"
+        logger.critical(f"{message}.")
+        raise ValueError(message)
 
     # List of all tables names that are needed for transformation.
     table_names = [
-        'address.csv',
-        'counterparty.csv',
-        'currency.csv',
-        'department.csv',
-        'design.csv',
-        'sales_order.csv',
-        'staff.csv',
+        'address',
+        'counterparty',
+        'currency',
+        'department',
+        'design',
+        'sales_order',
+        'staff',
     ]
 
     # Ensure that our buckets exists.
@@ -51,7 +165,8 @@ def transformation_lambda_handler(event, context):
     if not dim_date_exists(s3, parquet_bucket):
         logger.info("dim_date file does not exist, generating it")
         dim_date = gdd()
-        csv_name, csv_body = back_to_csv(dim_date)
+        dim_date['Body'] = apply_warehouse_dtypes('dim_date', dim_date['Body'])
+        csv_name, csv_body = write_output(dim_date)
         s3.put_object(Bucket=parquet_bucket,
                       Key=csv_name, Body=csv_body)
 
@@ -71,31 +186,102 @@ def transformation_lambda_handler(event, context):
         # keys under that timestamp.
         keys_to_process = [get_keys_by_prefix(
             s3, raw_bucket, timestamp) for timestamp in prefixes_to_process]
+        check_raw_keys(keys_to_process, table_names)
         processed_csvs = []
 
-        # For each timestamp group in keys_to_process:
-        for csv_group in keys_to_process:
-
-            # Apply the relevant transformations to each group based on the
-            # table name contained in the key.
-            output_block = apply_transformations_to_group(
-                s3, csv_group, table_names)
-
-            # Append all output dicts from output_block to processed_csvs.
-            processed_csvs.extend([output_block[key]
-                                  for key in list(output_block)])
+        # The latest rows of the tables the joins look up, kept between runs.
+        # A table's first snapshot is seeded from the raw prefixes that were
+        # already transformed, the pending ones are merged in as they are.
+        processed_prefixes = [
+            item for item in raw_timestamps if item in parquet_timestamps]
+        snapshots = SnapshotStore(s3, parquet_bucket, seed=snapshot_seed(
+            s3, raw_bucket, processed_prefixes))
+
+        # Prefixes whose data was coalesced into the newest prefix.
+        coalesced_prefixes = []
+
+        with ThreadPoolExecutor(max_workers=fetch_workers) as pool:
+
+            # When coalescing several pending prefixes, download them all and
+            # transform only the newest version of each row, once, under the
+            # newest prefix.
+            if coalesce and len(keys_to_process) > 1:
+                logger.info(
+                    f"Coalescing {len(keys_to_process)} pending prefixes.")
+                groups = [
+                    fetch_group(pool, s3, raw_bucket, csv_group, table_names)
+                    for csv_group in keys_to_process
+                ]
+                process_block = coalesce_groups(
+                    [
+                        {table_name: future.result()
+                         for table_name, future in group.items()}
+                        for group in groups
+                    ],
+                    prefixes_to_process[-1].rstrip('/')
+                )
+                output_block = transform_block(process_block, snapshots)
+                processed_csvs.extend(output_block.values())
+                coalesced_prefixes = prefixes_to_process[:-1]
+                keys_to_process = []
+
+            # Start downloading the first group.
+            if keys_to_process:
+                fetched = fetch_group(
+                    pool, s3, raw_bucket, keys_to_process[0], table_names)
+
+            # For each timestamp group in keys_to_process:
+            for index, csv_group in enumerate(keys_to_process):
+
+                # Start downloading the next group while this one is
+                # transformed.
+                current, fetched = fetched, None
+                if index + 1 < len(keys_to_process):
+                    fetched = fetch_group(
+                        pool, s3, raw_bucket, keys_to_process[index + 1],
+                        table_names)
+
+                # Apply the relevant transformations to each group based on
+                # the table name contained in the key.
+                output_block = apply_transformations_to_group(
+                    s3, csv_group, table_names, current, snapshots)
+
+                # Append all output dicts from output_block to
+                # processed_csvs.
+                processed_csvs.extend([output_block[key]
+                                      for key in list(output_block)])
 
         # For each csv that has been through the transformation process:
         if processed_csvs != []:
-            logger.info("Writing processed csvs to processed bucket.")
+            logger.info("Writing processed tables to processed bucket.")
         for csv_dict in processed_csvs:
 
-            # Convert the body and key to parquet format.
-            csv_name, csv_body = back_to_csv(csv_dict)
+            # Convert the body and key to the output format.
+            csv_name, csv_body = write_output(csv_dict)
+            if hive:
+                csv_name = hive_key(csv_name)
 
             # Save the resulting parquet file to the correct s3 bucket.
             s3.put_object(Bucket=parquet_bucket,
                           Key=csv_name, Body=csv_body)
+
+        # Mark the coalesced prefixes as processed.
+        for prefix in coalesced_prefixes:
+            s3.put_object(
+                Bucket=parquet_bucket, Key=prefix + COALESCED_MARKER,
+                Body=f"Coalesced into {prefixes_to_process[-1]}")
+
+        # Mark the written prefixes as processed, as the hive layout does not
+        # create them.
+        if hive:
+            for prefix in prefixes_to_process:
+                if prefix not in coalesced_prefixes:
+                    s3.put_object(
+                        Bucket=parquet_bucket, Key=prefix + PROCESSED_MARKER,
+                        Body="Written to the table partitions")
+
+        # Save the snapshots now that their rows have been written out.
+        snapshots.save()
     else:
         logger.info("No new data to process.")
 
@@ -118,6 +304,14 @@ def dim_date_exists(s3, bucket_name):
 
 
 def get_ingestion_bucket_name():
+    """ Gets the name of the bucket of raw data from the INGESTION_BUCKET
+        environment variable, falling back to looking it up using the prefix.
+        Lookups are cached across warm invocations."""
+    return os.environ.get('INGESTION_BUCKET') or resolve_config(
+        'ingestion_bucket', find_ingestion_bucket_name)
+
+
+def find_ingestion_bucket_name():
     """ Gets the name of the bucket of raw data using the prefix."""
     prefix = 'terrific-totes-ingestion-bucket'
     buckets = boto3.client("s3").list_buckets().get("Buckets")
@@ -132,6 +326,14 @@ def get_ingestion_bucket_name():
 
 
 def get_parquet_bucket_name():
+    """ Gets the name of the bucket of processed data from the
+        PROCESSED_BUCKET environment variable, falling back to looking it up
+        using the prefix. Lookups are cached across warm invocations."""
+    return os.environ.get('PROCESSED_BUCKET') or resolve_config(
+        'parquet_bucket', find_parquet_bucket_name)
+
+
+def find_parquet_bucket_name():
     """ Gets the name of the bucket of processed data using the prefix."""
     prefix = 'terrific-totes-processed-bucket'
     buckets = boto3.client("s3").list_buckets().get("Buckets")
@@ -168,7 +370,7 @@ def s3_obj_to_dict(s3, bucket_name, key):
         a useable format.
     """
     obj = s3.get_object(Bucket=bucket_name, Key=key)
-    body = response_to_data_frame(obj)
+    body = response_to_data_frame(obj, table_name_from_key(key))
     timestamp = key.split("/")[0]
     formatted_obj = {
         'Key': key,
@@ -178,29 +380,108 @@ def s3_obj_to_dict(s3, bucket_name, key):
     return formatted_obj
 
 
-def response_to_data_frame(response):
-    """ This funtion will convert a get_object response for a CSV file into a
-        Pandas DataFrame.
+def response_to_data_frame(response, table_name=None):
+    """ This funtion will convert a get_object response for a CSV or parquet
+        file into a Pandas DataFrame. The format is detected from the parquet
+        magic bytes at the start of the body, after decompressing the body if
+        its metadata names the codec it was compressed with. CSVs are parsed
+        straight from the bytes by the multithreaded arrow reader, using the
+        column types of the table in TABLE_COLUMN_TYPES.
 
         Args:
             response: The response from a boto3 s3 get_object function.
 
+            table_name: The name of the raw table the body holds, defaults to
+            None to infer every column type.
+
         Returns:
             dataframe: The response body converted to a pandas DataFrame.
     """
 
     body_reader = response['Body']
-    body = body_reader.read().decode('utf-8').splitlines()
-    csv_reader = csv.DictReader(body)
-    rows = []
+    body = body_reader.read()
+    codec = response.get('Metadata', {}).get('codec')
+    if codec:
+        body = pa.CompressedInputStream(
+            pa.BufferReader(body), codec).read()
+    if body[:4] == PARQUET_MAGIC:
+        return pd.read_parquet(io.BytesIO(body))
+    if not body:
+        return pd.DataFrame()
+    table = pa_csv.read_csv(
+        pa.BufferReader(body),
+        read_options=pa_csv.ReadOptions(use_threads=True),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=TABLE_COLUMN_TYPES.get(table_name, {}),
+            strings_can_be_null=True,
+        ),
+    )
+    return table.to_pandas()
+
+
+def snapshot_seed(s3, bucket_name, prefixes):
+    """ Returns a seed for the SnapshotStore that reads every raw object of a
+        table under the passed timestamp prefixes, oldest first, into one
+        DataFrame, which holds the table's full extract followed by each
+        later change. The bucket is listed once, when a table is first
+        seeded, as this only happens the first time a snapshot is used.
+    """
+    prefixes = set(prefixes)
+    listed = {}
+
+    def seed(table_name):
+        if 'keys' not in listed:
+            pages = s3.get_paginator('list_objects_v2').paginate(
+                Bucket=bucket_name)
+            listed['keys'] = sorted(
+                item['Key'] for page in pages
+                for item in page.get('Contents', [])
+                if item['Key'].split('/')[0] + '/' in prefixes)
+        bodies = [
+            s3_obj_to_dict(s3, bucket_name, key)['Body']
+            for key in listed['keys'] if table_name_from_key(key) == table_name
+        ]
+        bodies = [body for body in bodies if not body.empty]
+        if not bodies:
+            return pd.DataFrame()
+        logger.info(
+            f"Seeding the {table_name} snapshot from {len(bodies)} objects.")
+        return pd.concat(bodies, ignore_index=True)
+
+    return seed
+
+
+def table_name_from_key(key):
+    """ Gets the table name from a raw data key, ignoring the extension."""
+    return key.split("/")[1].split(".")[0]
+
+
+def check_raw_keys(keys_to_process, table_names):
+    """ Logs a warning for every raw key that is not one of the passed
+        tables, as it is skipped rather than transformed.
+    """
+    for key in (key for csv_group in keys_to_process for key in csv_group):
+        if table_name_from_key(key) not in table_names:
+            logger.warning(f"Skipping {key}, it is not a transformed table.")
 
-    for data in csv_reader:
-        rows.append(data)
-    dataframe = pd.DataFrame.from_dict(rows)
-    return dataframe
 
+def fetch_group(pool, s3, bucket_name, csv_group, table_names):
+    """ Starts downloading and parsing every object in the passed group that
+        belongs to one of the passed tables, on the passed thread pool.
 
-def apply_transformations_to_group(s3, csv_group, table_names):
+        Returns:
+            fetched: A dict of table names paired with a future of the csv
+            dict of that table's object, see s3_obj_to_dict.
+    """
+    return {
+        table_name_from_key(key): pool.submit(
+            s3_obj_to_dict, s3, bucket_name, key)
+        for key in csv_group if table_name_from_key(key) in table_names
+    }
+
+
+def apply_transformations_to_group(s3, csv_group, table_names, fetched=None,
+                                   snapshots=None):
     """Applies the correct transformation to each csv dict in the passed group
        and outputs them on a new dict.
 
@@ -212,32 +493,67 @@ def apply_transformations_to_group(s3, csv_group, table_names):
             table_names: A list of table names that need transformations
             applied to them.
 
+            fetched: The dict returned by fetch_group for this group, if its
+            objects are already being downloaded. Defaults to None to download
+            them one at a time.
+
+            snapshots: A SnapshotStore to update with the group and to look
+            up joined rows from, see join_with_snapshots. Defaults to None to
+            only join tables that arrived in the same group.
+
+        Returns:
+            output_block: A dict of transformed csv_dicts, each on the key of
+            the appropriate transformed table name.
+    """
+
+    if fetched is not None:
+        process_block = {
+            table_name: future.result()
+            for table_name, future in fetched.items()
+        }
+    else:
+        process_block = {table_name_from_key(key): s3_obj_to_dict(
+            s3,
+            get_ingestion_bucket_name(),
+            key
+        )
+            for key in csv_group if table_name_from_key(key) in table_names}
+    return transform_block(process_block, snapshots)
+
+
+def transform_block(process_block, snapshots=None):
+    """ Applies the correct transformation to each csv dict in the passed
+        block and outputs them on a new dict.
+
+        Args:
+            process_block: A dict of csv dicts on their raw table names.
+
+            snapshots: As for apply_transformations_to_group.
+
         Returns:
             output_block: A dict of transformed csv_dicts, each on the key of
             the appropriate transformed table name.
     """
 
     output_block = {}
-    process_block = {key.split("/")[1][:-4]: s3_obj_to_dict(
-        s3,
-        get_ingestion_bucket_name(),
-        key
-    )
-        for key in csv_group if key.split("/")[1] in table_names}
+    if snapshots is not None:
+        join_block = join_with_snapshots(snapshots, process_block)
+    else:
+        join_block = process_block
     if process_block.get("address"):
         logger.info("Creating dim_location.csv.")
         output_block["dim_location"] = atdl(process_block['address'])
-        if process_block.get("counterparty"):
-            logger.info("Creating dim_location.csv.")
-            output_block["dim_counterparty"] = cpatdc(
-                process_block['counterparty'], process_block['address'])
+    if join_block.get("address") and join_block.get("counterparty"):
+        logger.info("Creating dim_counterparty.csv.")
+        output_block["dim_counterparty"] = cpatdc(
+            join_block['counterparty'], join_block['address'])
     if process_block.get('currency'):
         logger.info("Creating dim_currency.csv.")
         output_block["dim_currency"] = ctdc(process_block['currency'])
-    if process_block.get('department') and process_block.get('staff'):
+    if join_block.get('department') and join_block.get('staff'):
         logger.info("Creating dim_staff.csv.")
         output_block["dim_staff"] = sdtds(
-            process_block['staff'], process_block['department'])
+            join_block['staff'], join_block['department'])
     if process_block.get('design'):
         logger.info("Creating dim_design.csv.")
         output_block["dim_design"] = dtdd(process_block['design'])
@@ -245,6 +561,11 @@ def apply_transformations_to_group(s3, csv_group, table_names):
         logger.info("Creating fact_sales_order.csv.")
         output_block["fact_sales_order"] = sotfso(process_block['sales_order'])
 
+    # Cast every output to the compact dtypes of its warehouse table.
+    for table_name, output_dict in output_block.items():
+        output_dict['Body'] = apply_warehouse_dtypes(
+            table_name, output_dict['Body'])
+
     return output_block
 
 
@@ -255,3 +576,46 @@ def back_to_csv(csv_dict):
 
     csv_body = csv_dict['Body'].to_csv()
     return csv_dict['Key'], csv_body
+
+
+def back_to_parquet(csv_dict):
+    """ Processes the Pandas DataFrame on a csv dict's Body key into parquet
+        bytes, returning the Key with its extension changed to .parquet and
+        the new Body. Warehouse tables are written with their schema in
+        WAREHOUSE_SCHEMAS, other tables keep the DataFrame's column types.
+        Every table is written with the settings of writer_profile().
+    """
+
+    table_name = os.path.basename(os.path.splitext(csv_dict['Key'])[0])
+    table = pa.Table.from_pandas(
+        csv_dict['Body'],
+        schema=WAREHOUSE_SCHEMAS.get(table_name),
+        preserve_index=False)
+    profile = writer_profile()
+    sink = pa.BufferOutputStream()
+    writer = open_parquet_writer(sink, table.schema, profile)
+    writer.write_table(table, row_group_size=profile['row_group_rows'])
+    writer.close()
+    parquet_name = os.path.splitext(csv_dict['Key'])[0] + '.parquet'
+    return parquet_name, sink.getvalue().to_pybytes()
+
+
+def hive_key(key):
+    """ Moves a <timestamp>/<table>.parquet key to the hive partitioned
+        layout, table=<table>/ingest_date=<YYYY-MM-DD>/<timestamp>.parquet,
+        so that one table's history can be read without listing every
+        timestamp prefix.
+    """
+
+    timestamp, file_name = key.split('/')
+    table_name, extension = os.path.splitext(file_name)
+    return (f"table={table_name}/ingest_date={timestamp[:10]}/"
+            f"{timestamp}{extension}")
+
+
+# Functions that encode a transformed table for the processed bucket, keyed by
+# the PROCESSED_FORMAT they write.
+OUTPUT_WRITERS = {
+    'csv': back_to_csv,
+    'parquet': back_to_parquet,
+}
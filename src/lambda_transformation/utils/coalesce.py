@@ -0,0 +1,39 @@
+import pandas as pd
+
+
+def coalesce_groups(groups, timestamp):
+    '''Combines several timestamp groups into one latest-wins group, so that
+       a row changed in many of them is only transformed once.
+
+    Args:
+        groups: a list of dicts of csv dicts on their table names, one for
+        each timestamp group, oldest first.
+
+        timestamp: the timestamp the combined group is keyed under, normally
+        that of the newest group.
+
+    Returns:
+        coalesced: a dict of csv dicts on their table names, each holding
+        only the newest version of every row of that table across the
+        groups, by last_updated and then by group order. Rows are matched on
+        the table's <table_name>_id column.
+    '''
+    bodies = {}
+    for group in groups:
+        for table_name, csv_dict in group.items():
+            bodies.setdefault(table_name, []).append(csv_dict['Body'])
+
+    coalesced = {}
+    for table_name, frames in bodies.items():
+        body = pd.concat(frames, ignore_index=True)
+        if 'last_updated' in body:
+            body = body.sort_values('last_updated', kind='stable')
+        id_column = f'{table_name}_id'
+        if id_column in body:
+            body = body.drop_duplicates(id_column, keep='last')
+        coalesced[table_name] = {
+            'Key': f'{timestamp}/{table_name}.csv',
+            'Body': body.reset_index(drop=True),
+            'Timestamp': timestamp,
+        }
+    return coalesced
@@ -2,6 +2,13 @@ import ccy
 import pandas as pd
 
 
+# ISO 4217 code to currency name, built from ccy once per container so that
+# rows are looked up with a single vectorised map rather than a ccy call each.
+CURRENCY_NAMES = {
+    code: currency.name for code, currency in ccy.currencydb().items()
+}
+
+
 def currency_to_dim_currency(currency_dict):
     '''Takes currencies from currency csv and remaps to dim_currency schema.
 
@@ -17,15 +24,13 @@ def currency_to_dim_currency(currency_dict):
     '''
     key = currency_dict['Key']
     currency = currency_dict['Body']
-    currency_codes = currency['currency_code']
-    currency_names = []
-    # map currency name to id, using ccy module
-    for currency_code in currency_codes:
-        try:
-            currency_name = ccy.currency(currency_code).name
-        except ccy.UnknownCurrency:
-            currency_name = None
-        currency_names.append(currency_name)
+    # map currency name to code, unknown codes have no name
+    currency_names = currency['currency_code'].str.upper().map(
+        CURRENCY_NAMES
+    )
+    currency_names = currency_names.astype(object).where(
+        currency_names.notna(), None
+    )
 
     dim_currency = currency[['currency_id',
                              'currency_code']].copy()
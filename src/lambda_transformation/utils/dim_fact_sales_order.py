@@ -1,4 +1,5 @@
 import pandas as pd
+import pyarrow as pa
 
 
 def sales_order_to_fact_sales_order(sales_order_dict):
@@ -31,17 +32,11 @@ def sales_order_to_fact_sales_order(sales_order_dict):
                               'agreed_delivery_date',
                               'agreed_delivery_location_id']]
 
-    created_date = fact_sales_order.created_at.apply(
-        lambda x: x.split(' ')[0]
-    )
-    created_time = fact_sales_order.created_at.apply(
-        lambda x: x.split(' ')[1]
-    )
-    last_updated_date = fact_sales_order.created_at.apply(
-        lambda x: x.split(' ')[0]
-    )
-    last_updated_time = fact_sales_order.created_at.apply(
-        lambda x: x.split(' ')[1]
+    # Each timestamp column is parsed once, whether it arrived as strings or
+    # already typed, then split into its date and time.
+    created_date, created_time = split_timestamps(fact_sales_order.created_at)
+    last_updated_date, last_updated_time = split_timestamps(
+        fact_sales_order.last_updated
     )
     adl_id = fact_sales_order.agreed_delivery_location_id
 
@@ -65,3 +60,26 @@ def sales_order_to_fact_sales_order(sales_order_dict):
     new_key = key.split('/')[0]+"/fact_sales_order.csv"
     fact_sales_order_dict = {"Key": new_key, "Body": fact_sales_order}
     return fact_sales_order_dict
+
+
+def split_timestamps(timestamps):
+    '''Parses a column of timestamps and splits it into a column of dates
+       and a column of times, formatted as they are loaded into the
+       warehouse, YYYY-MM-DD and HH:MM:SS.ffffff. The split is done with
+       arrow casts over the whole column rather than formatting each value.
+
+    Args:
+        timestamps: a pandas series of timestamps, as strings or datetimes.
+
+    Returns:
+        dates, times: pandas series of the date and time of each timestamp,
+        None where the timestamp is missing.
+    '''
+    parsed = pd.to_datetime(timestamps, format='ISO8601')
+    array = pa.array(parsed, from_pandas=True).cast(
+        pa.timestamp('us'), safe=False)
+    dates = array.cast(pa.date32()).cast(pa.string())
+    times = array.cast(pa.time64('us')).cast(pa.string())
+    index = timestamps.index
+    return (pd.Series(dates.to_numpy(zero_copy_only=False), index=index),
+            pd.Series(times.to_numpy(zero_copy_only=False), index=index))
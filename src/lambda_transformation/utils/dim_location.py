@@ -1,6 +1,3 @@
-import pandas as pd
-
-
 def address_to_dim_location(address_dict):
     '''Takes all addresses from address csv and remaps to dim_location schema.
 
@@ -31,9 +28,6 @@ def address_to_dim_location(address_dict):
             'address_id': 'location_id'},
         inplace=True)
 
-    # Replace the "NaN"s with "None"s
-    dim_location = dim_location.where(pd.notnull(dim_location), None)
-
     # Put everything together and return
     new_key = key.split("/")[0]+"/dim_location.csv"
     dim_location_dict = {"Key": new_key, "Body": dim_location}
@@ -0,0 +1,204 @@
+import io
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+
+
+# The tables kept in the snapshot store, paired with their id column.
+# address and department are looked up by the dim_counterparty and dim_staff
+# joins, counterparty and staff are kept so that a change to an address or
+# department can be applied to the rows that reference it.
+SNAPSHOT_ID_COLUMNS = {
+    'address': 'address_id',
+    'counterparty': 'counterparty_id',
+    'department': 'department_id',
+    'staff': 'staff_id',
+}
+
+
+class SnapshotStore:
+    '''Holds the latest version of every row of the snapshot tables, so that
+       joins can look up rows that did not arrive in the same batch.
+
+       Each table is stored as a parquet keyed by its id column in the
+       processed bucket, at <table>_snapshot.parquet, and cached in cache_dir
+       along with its ETag so that a warm container only downloads it again
+       if it has changed. Tables are loaded when first used and only written
+       back by save if they were changed.
+
+       A table with no snapshot in the bucket yet is seeded by calling seed
+       with its name, which returns every existing row of the table, oldest
+       version first, so that joins see rows ingested before the store was
+       first used. Without a seed such a table starts empty.
+    '''
+
+    def __init__(self, s3, bucket_name, cache_dir='/tmp', seed=None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.cache_dir = cache_dir
+        self.seed = seed
+        self.tables = {}
+        self.changed = set()
+
+    @staticmethod
+    def key(table_name):
+        '''The key of the passed table's snapshot in the bucket.'''
+        return f'{table_name}_snapshot.parquet'
+
+    def get(self, table_name):
+        '''Returns the snapshot of the passed table as a DataFrame, empty if
+           no snapshot has been saved yet.'''
+        if table_name not in self.tables:
+            self.tables[table_name] = self.load(table_name)
+        return self.tables[table_name]
+
+    def load(self, table_name):
+        '''Reads the snapshot of the passed table, from the cache if the
+           cached copy is still current, otherwise from the bucket.'''
+        path = os.path.join(self.cache_dir, self.key(table_name))
+        kwargs = {}
+        if os.path.exists(path) and os.path.exists(path + '.etag'):
+            with open(path + '.etag') as etag_file:
+                kwargs['IfNoneMatch'] = etag_file.read()
+        try:
+            response = self.s3.get_object(
+                Bucket=self.bucket_name, Key=self.key(table_name), **kwargs)
+        except ClientError as error:
+            code = error.response['Error']['Code']
+            if code in ('304', 'NotModified'):
+                return pd.read_parquet(path)
+            if code in ('404', 'NoSuchKey'):
+                return self.seed_table(table_name)
+            raise
+        body = response['Body'].read()
+        self.cache(table_name, body, response['ETag'])
+        return pd.read_parquet(io.BytesIO(body))
+
+    def seed_table(self, table_name):
+        '''Builds the first snapshot of the passed table from the seed,
+           keeping the latest version of each id, and marks it as changed so
+           that save writes it. Empty if there is no seed or no rows.'''
+        if self.seed is None:
+            return pd.DataFrame()
+        rows = self.seed(table_name)
+        if rows.empty:
+            return rows
+        id_column = SNAPSHOT_ID_COLUMNS[table_name]
+        self.changed.add(table_name)
+        return rows.drop_duplicates(
+            id_column, keep='last').reset_index(drop=True)
+
+    def cache(self, table_name, body, etag):
+        '''Writes a snapshot body and its ETag to the cache.'''
+        path = os.path.join(self.cache_dir, self.key(table_name))
+        with open(path, 'wb') as body_file:
+            body_file.write(body)
+        with open(path + '.etag', 'w') as etag_file:
+            etag_file.write(etag)
+
+    def upsert(self, table_name, rows):
+        '''Merges a batch of rows into the passed table's snapshot, the batch
+           replacing any row with the same id.
+
+        Args:
+            table_name: the name of a table in SNAPSHOT_ID_COLUMNS.
+
+            rows: a pandas dataframe of the batch's rows.
+
+        Returns:
+            ids: a pandas series of the ids of the rows in the batch.
+        '''
+        id_column = SNAPSHOT_ID_COLUMNS[table_name]
+        snapshot = self.get(table_name)
+        if snapshot.empty:
+            merged = rows
+        else:
+            merged = pd.concat([
+                snapshot[~snapshot[id_column].isin(rows[id_column])],
+                rows,
+            ], ignore_index=True)
+        self.tables[table_name] = merged.reset_index(drop=True)
+        self.changed.add(table_name)
+        return rows[id_column]
+
+    def select(self, table_name, **matches):
+        '''Returns the rows of the passed table's snapshot where any of the
+           passed columns holds one of the values paired with it.'''
+        snapshot = self.get(table_name)
+        if snapshot.empty:
+            return snapshot
+        mask = pd.Series(False, index=snapshot.index)
+        for column, values in matches.items():
+            if values is not None:
+                mask |= snapshot[column].isin(values)
+        return snapshot[mask]
+
+    def save(self):
+        '''Writes every changed table back to the bucket and the cache.'''
+        for table_name in sorted(self.changed):
+            table = pa.Table.from_pandas(
+                self.tables[table_name], preserve_index=False)
+            sink = pa.BufferOutputStream()
+            pq.write_table(table, sink)
+            body = sink.getvalue().to_pybytes()
+            response = self.s3.put_object(
+                Bucket=self.bucket_name, Key=self.key(table_name), Body=body)
+            self.cache(table_name, body, response['ETag'])
+        self.changed = set()
+
+
+def join_with_snapshots(snapshots, process_block):
+    '''Merges the group's rows into the snapshot store, then builds the csv
+       dicts for the dim_counterparty and dim_staff joins from it. Each join
+       gets the rows of its main table that are in the group or that
+       reference an address or department in the group, paired with the full
+       snapshot of the table it looks up, so a change to either side of a
+       join is applied without the other side arriving with it.
+
+    Args:
+        snapshots: a SnapshotStore.
+
+        process_block: a dict of the group's csv dicts on their table names.
+
+    Returns:
+        join_block: a dict of csv dicts on the table names address,
+        counterparty, department and staff, holding only the joins that have
+        rows to write. The csv dicts carry the group's Key and Timestamp.
+    '''
+    ids = {
+        table_name: snapshots.upsert(
+            table_name, process_block[table_name]['Body'])
+        for table_name in SNAPSHOT_ID_COLUMNS
+        if process_block.get(table_name)
+    }
+    if not ids:
+        return {}
+    group_dict = process_block[next(iter(ids))]
+
+    def with_group_key(body):
+        return {
+            'Key': group_dict['Key'],
+            'Body': body,
+            'Timestamp': group_dict['Timestamp'],
+        }
+
+    join_block = {}
+    joins = [
+        ('counterparty', 'address', 'legal_address_id'),
+        ('staff', 'department', 'department_id'),
+    ]
+    for table_name, lookup_name, reference_column in joins:
+        if table_name not in ids and lookup_name not in ids:
+            continue
+        rows = snapshots.select(table_name, **{
+            SNAPSHOT_ID_COLUMNS[table_name]: ids.get(table_name),
+            reference_column: ids.get(lookup_name),
+        })
+        lookup = snapshots.get(lookup_name)
+        if rows.empty or lookup.empty:
+            continue
+        join_block[table_name] = with_group_key(rows)
+        join_block[lookup_name] = with_group_key(lookup)
+    return join_block
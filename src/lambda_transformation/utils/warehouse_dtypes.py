@@ -0,0 +1,74 @@
+import pandas as pd
+import pyarrow as pa
+from pipeline_common.warehouse_schemas import WAREHOUSE_SCHEMAS
+
+
+# Compact pandas dtypes for the columns of each warehouse table, derived
+# from WAREHOUSE_SCHEMAS so that both are kept in one place. Ids are nullable
+# integers, text is stored in arrow string arrays, the dictionary encoded
+# columns are categoricals and dates and times are arrow date32 and time64
+# arrays.
+TEXT = 'string[pyarrow]'
+CATEGORY = 'category'
+DATE = pd.ArrowDtype(pa.date32())
+TIME = pd.ArrowDtype(pa.time64('us'))
+
+
+def to_pandas_dtype(arrow_type):
+    '''Returns the compact pandas dtype for a column of the passed arrow
+       type in WAREHOUSE_SCHEMAS.'''
+    if pa.types.is_dictionary(arrow_type):
+        return CATEGORY
+    if pa.types.is_string(arrow_type):
+        return TEXT
+    if pa.types.is_temporal(arrow_type):
+        return pd.ArrowDtype(arrow_type)
+    dtype = str(pd.api.types.pandas_dtype(arrow_type.to_pandas_dtype()))
+    if pa.types.is_integer(arrow_type):
+        return dtype.capitalize()
+    return dtype
+
+
+WAREHOUSE_DTYPES = {
+    table_name: {
+        field.name: to_pandas_dtype(field.type) for field in schema
+    }
+    for table_name, schema in WAREHOUSE_SCHEMAS.items()
+}
+
+
+def apply_warehouse_dtypes(table_name, dataframe):
+    '''Casts the columns of a transformed table to the compact dtypes in
+       WAREHOUSE_DTYPES. Columns without an entry are left as they are.
+
+    Args:
+        table_name: the name of the warehouse table, such as dim_location.
+
+        dataframe: a pandas dataframe of the table's contents.
+
+    Returns:
+        dataframe: a new pandas dataframe with the columns cast.
+    '''
+    dtypes = WAREHOUSE_DTYPES.get(table_name, {})
+    columns = {}
+    for column, dtype in dtypes.items():
+        if column not in dataframe:
+            continue
+        if dtype == DATE:
+            columns[column] = to_arrow_temporal(dataframe[column], DATE)
+        elif dtype == TIME:
+            columns[column] = to_arrow_temporal(
+                dataframe[column], TIME, format='%H:%M:%S.%f')
+        else:
+            columns[column] = dataframe[column].astype(dtype)
+    return dataframe.assign(**columns)
+
+
+def to_arrow_temporal(values, dtype, format='ISO8601'):
+    '''Parses a series of date or time strings, or timestamps, into an arrow
+       backed series of the passed ArrowDtype.'''
+    if not pd.api.types.is_datetime64_any_dtype(values):
+        values = pd.to_datetime(values, format=format)
+    array = pa.array(values, from_pandas=True).cast(dtype.pyarrow_dtype)
+    return pd.Series(
+        pd.arrays.ArrowExtensionArray(array), index=values.index)
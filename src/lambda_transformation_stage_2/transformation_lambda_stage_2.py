@@ -1,12 +1,35 @@
 import boto3
 import logging
+import os
+import time
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from statistics import median
 import pyarrow.csv as pv
 import pyarrow.parquet as pq
 from pyarrow import fs
+from pipeline_common.config import resolve_config
+from pipeline_common.parquet_writer import (
+    open_parquet_writer,
+    writer_profile,
+)
+from pipeline_common.warehouse_schemas import WAREHOUSE_SCHEMAS
 
 logger = logging.getLogger('MyLogger')
 logger.setLevel(logging.INFO)
 
+# Size of the blocks the csv reader parses at a time.
+CSV_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Number of folders listed and csvs converted at once, overridden by the
+# STAGE_2_WORKERS environment variable.
+CONVERSION_WORKERS = 4
+
+# Object at the top of the processed bucket listing the timestamp folders
+# whose csvs have all been converted, one per line, so that later runs skip
+# them without listing their contents again.
+CONVERTED_KEY = 'converted.txt'
+
 
 def transformation_lambda_handler_stage_2(event, context):
     """ Stage 2 of the transformation process.
@@ -15,6 +38,12 @@ def transformation_lambda_handler_stage_2(event, context):
         processed bucket, finishes the transform stage by converting them to
         parquets, writing them to the same prefix in the same bucket and then
         deleting the csvs.
+
+        Folders are listed and csvs converted by a pool of STAGE_2_WORKERS
+        threads. Folders recorded in CONVERTED_KEY are skipped without being
+        listed. A folder is only added to it once it has held csvs and all of
+        them converted, folders without csvs are checked again next run in
+        case csvs are still being written to them.
     """
     s3 = fs.S3FileSystem(region='eu-west-2')
 
@@ -28,42 +57,62 @@ def transformation_lambda_handler_stage_2(event, context):
     bucket_contents = s3.get_file_info(fs.FileSelector(
         parquet_bucket, recursive=False))
 
-    folder_names = [file.base_name for file in bucket_contents]
+    # Only timestamp folders hold csvs to convert, files at the top of the
+    # bucket such as cache.txt and the snapshots are ignored.
+    folder_names = [
+        file.base_name for file in bucket_contents
+        if file.type == fs.FileType.Directory]
 
-    # Ignore dim_date.parquet.
-    if folder_names[-1] == "dim_date.parquet":
-        folder_names = folder_names[:-1]
+    converted = get_converted_folders(s3, parquet_bucket)
+    pending = [folder for folder in folder_names if folder not in converted]
+    logger.info(
+        f"Skipping {len(folder_names) - len(pending)} converted folders, "
+        f"checking {len(pending)}.")
 
-    # Process dim_date.csv to dim_date.parquet, then ignore.
-    elif folder_names[-1] == "dim_date.csv":
-        file = bucket_contents[-1]
-        process_file_to_parquet(s3, file)
-        folder_names = folder_names[:-1]
+    # dim_date.csv sits at the top of the bucket rather than in a folder.
+    to_convert = [
+        (None, file) for file in bucket_contents
+        if file.base_name == "dim_date.csv"]
 
-    # Ignore cache.txt.
-    if folder_names[-1] == "cache.txt":
-        folder_names = folder_names[:-1]
+    workers = int(os.environ.get('STAGE_2_WORKERS') or CONVERSION_WORKERS)
+    stats = []
+    failed = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # List the pending folders, then convert every csv found in them.
+        listings = pool.map(
+            lambda folder: list_folder_csvs(s3, parquet_bucket, folder),
+            pending)
+        for folder, folder_csvs in zip(pending, listings):
+            to_convert += [(folder, file) for file in folder_csvs]
 
-    files_to_convert = False
+        futures = {
+            pool.submit(process_file_to_parquet, s3, file): (folder, file)
+            for folder, file in to_convert}
+        for future in as_completed(futures):
+            folder, file = futures[future]
+            try:
+                stats.append(future.result())
+            except Exception as err:
+                logger.error(f"Failed to convert {file.path} : {err}")
+                failed.add(folder)
 
-    # For each folder in the processed bucket:
-    for folder in folder_names:
-
-        # Get a FileInfo object for each itme in the folder.
-        folder_contents = s3.get_file_info(fs.FileSelector(
-            parquet_bucket+"/"+folder, recursive=False))
-
-        # Filter out any files that are not csvs.
-        folder_csvs = [
-            file for file in folder_contents
-            if file.is_file and file.extension == "csv"]
-
-        if folder_csvs != []:
-            files_to_convert = True
-        for file in folder_csvs:
-            process_file_to_parquet(s3, file)
-    if not files_to_convert:
+    if not to_convert:
         logger.info("No csvs to convert to to parquet.")
+    else:
+        log_conversion_summary(stats)
+
+    # Folders with a failed csv, or without any csvs yet, are left to be
+    # checked again next run.
+    held_csvs = {folder for folder, _ in to_convert}
+    newly_converted = [
+        folder for folder in pending
+        if folder in held_csvs and folder not in failed]
+    if newly_converted:
+        put_converted_folders(
+            s3, parquet_bucket, converted + newly_converted)
+    if failed:
+        raise ConversionError(
+            f"{len(to_convert) - len(stats)} csvs failed to convert.")
 
 
 class MissingBucketError(Exception):
@@ -74,29 +123,137 @@ class MissingBucketError(Exception):
         self.message = message
 
 
-def process_file_to_parquet(s3, file):
+class ConversionError(Exception):
+    """ An error for when some of the csvs could not be converted."""
+
+
+def get_converted_folders(s3, bucket):
+    """ Returns the list of folders recorded in CONVERTED_KEY as fully
+        converted, or an empty list if nothing has been recorded yet."""
+    try:
+        with s3.open_input_stream(f"{bucket}/{CONVERTED_KEY}") as fh:
+            return [line for line in fh.read().decode().split("\n") if line]
+    except FileNotFoundError:
+        return []
+
+
+def put_converted_folders(s3, bucket, folders):
+    """ Overwrites CONVERTED_KEY with the passed list of folders."""
+    with s3.open_output_stream(f"{bucket}/{CONVERTED_KEY}") as fh:
+        fh.write("\n".join(folders).encode())
+
+
+def list_folder_csvs(s3, bucket, folder):
+    """ Returns a FileInfo object for each csv in the passed folder."""
+    folder_contents = s3.get_file_info(fs.FileSelector(
+        f"{bucket}/{folder}", recursive=False))
+    return [
+        file for file in folder_contents
+        if file.is_file and file.extension == "csv"]
+
+
+def log_conversion_summary(stats):
+    """ Logs the number of csvs converted, the bytes read and written and
+        the median and slowest conversion times, from the stats returned by
+        process_file_to_parquet."""
+    if not stats:
+        return
+    bytes_in = sum(stat['bytes_in'] for stat in stats)
+    bytes_out = sum(stat['bytes_out'] for stat in stats)
+    seconds = [stat['seconds'] for stat in stats]
+    logger.info(
+        f"Converted {len(stats)} csvs, {bytes_in} bytes in, {bytes_out} "
+        f"bytes out, {median(seconds):.2f}s median and "
+        f"{max(seconds):.2f}s slowest.")
+
+
+def process_file_to_parquet(s3, file, profile=None):
+    """ Converts a csv on the passed pyarrow filesystem to a parquet in the
+        same folder, changing .csv to .parquet, then deletes the csv.
+
+        The csv is read a block at a time and each block's record batch is
+        passed to the parquet writer as soon as a row group's worth of rows
+        has been read, so peak memory is bounded by the row group size rather
+        than the size of the file.
+
+        Args:
+            s3: A pyarrow filesystem, normally S3FileSystem.
+
+            file: A pyarrow FileInfo object that points to the csv.
+
+            profile: The writer settings to use, see PARQUET_PROFILE.
+            Defaults to writer_profile().
+
+        Returns:
+            A dict of the csv's path, its size in bytes, the size of the
+            parquet written in bytes and the seconds taken to convert it.
+    """
+    start = time.monotonic()
+    profile = profile or writer_profile()
     fh = s3.open_input_stream(file.path)
 
-    # Read the csv contents.
-    reader = pv.open_csv(fh)
+    # Warehouse tables are read with their registered schema, skipping type
+    # inference, anything else is inferred.
+    schema = WAREHOUSE_SCHEMAS.get(file.base_name[:-4])
+    if schema is not None:
+        convert_options = pv.ConvertOptions(
+            column_types=dict(zip(schema.names, schema.types)),
+            include_columns=schema.names,
+            strings_can_be_null=True)
+    else:
+        convert_options = None
+
+    # Read the csv contents a block at a time.
+    reader = pv.open_csv(
+        fh,
+        read_options=pv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=convert_options)
+    schema = reader.schema
 
     # Convert to parquet and write to the same bucket and folder,
     # changing .csv to .parquet.
     logger.info(f"Writing to {file.base_name[:-4]}.parquet.")
-    writer = pq.ParquetWriter(
-        f"s3://{file.path[:-4]}.parquet",
-        schema=reader.schema,
-        use_dictionary=False
-    )
-    writer.write_table(reader.read_all())
+    sink = s3.open_output_stream(f"{file.path[:-4]}.parquet")
+    writer = open_parquet_writer(sink, schema, profile)
+    row_group_rows = profile['row_group_rows']
+    batches = []
+    buffered = 0
+    for batch in reader:
+        batches.append(batch)
+        buffered += batch.num_rows
+        # Write whole row groups, carrying the remaining rows over.
+        if buffered >= row_group_rows:
+            table = pa.Table.from_batches(batches, schema)
+            full = buffered - buffered % row_group_rows
+            writer.write_table(
+                table.slice(0, full), row_group_size=row_group_rows)
+            batches = table.slice(full).to_batches()
+            buffered -= full
+    if batches:
+        writer.write_table(
+            pa.Table.from_batches(batches, schema),
+            row_group_size=row_group_rows)
 
     writer.close()
+    bytes_out = sink.tell()
+    sink.close()
     reader.close()
 
     # Delete the interim csv now that it has been fully processed.
     logger.info(f"Deleting {file.base_name}.")
     s3.delete_file(file.path)
 
+    seconds = time.monotonic() - start
+    logger.info(
+        f"Converted {file.path} : {file.size} bytes to {bytes_out} bytes "
+        f"in {seconds:.2f}s.")
+    return {
+        'path': file.path,
+        'bytes_in': file.size,
+        'bytes_out': bytes_out,
+        'seconds': seconds,
+    }
+
 
 def read_parquet(s3, file):
     """ Takes a pyarrow FileInfo object that points to a parquet file on s3 and
@@ -111,6 +268,14 @@ def read_parquet(s3, file):
 
 
 def get_parquet_bucket_name():
+    """ Gets the name of the bucket of processed data from the
+        PROCESSED_BUCKET environment variable, falling back to looking it up
+        using the prefix. Lookups are cached across warm invocations."""
+    return os.environ.get('PROCESSED_BUCKET') or resolve_config(
+        'parquet_bucket', find_parquet_bucket_name)
+
+
+def find_parquet_bucket_name():
     """ Gets the name of the bucket of processed data using the prefix."""
     prefix = 'terrific-totes-processed-bucket'
     buckets = boto3.client("s3").list_buckets().get("Buckets")
@@ -0,0 +1,286 @@
+import logging
+import os
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import groupby
+from pyarrow import fs
+from pipeline_common.parquet_writer import open_parquet_writer, writer_profile
+from pipeline_common.warehouse_schemas import (
+    WAREHOUSE_SCHEMAS,
+    conform_to_schema,
+)
+
+
+logger = logging.getLogger('MyLogger')
+logger.setLevel(logging.INFO)
+
+# Minimum number of minutes between compaction runs, overridden by the
+# COMPACTION_INTERVAL_MINUTES environment variable.
+COMPACTION_INTERVAL_MINUTES = 60
+
+# Object at the top of the processed bucket holding the time of the last
+# compaction run, used to tell whether the next one is due.
+COMPACTION_RUN_KEY = 'compaction.txt'
+
+# Timestamps are only compacted once they are older than this many minutes,
+# so that the loading lambda has normally loaded them first. Overridden by
+# the COMPACTION_MIN_AGE_MINUTES environment variable.
+COMPACTION_MIN_AGE_MINUTES = 60
+
+# Number of days of settled timestamps each compaction run looks back over,
+# overridden by the COMPACTION_WINDOW_DAYS environment variable. Older days
+# were compacted by earlier runs.
+COMPACTION_WINDOW_DAYS = 2
+
+# Number of files read at once when merging a table, overridden by the
+# COMPACTION_WORKERS environment variable.
+COMPACTION_WORKERS = 4
+
+# Name of the marker written under a timestamp prefix whose parquets were
+# compacted into a later timestamp, so that the prefix still counts as
+# processed.
+COMPACTED_MARKER = 'compacted.txt'
+
+# Tables whose files are compacted, dim_date is written once and never
+# changes.
+COMPACTED_TABLES = sorted(
+    name for name in WAREHOUSE_SCHEMAS if name != 'dim_date')
+
+
+def compact_if_due(s3, bucket, now=None):
+    """ Compacts the processed bucket if COMPACTION_INTERVAL_MINUTES have
+        passed since the time recorded in COMPACTION_RUN_KEY, or if it has
+        never been compacted, then records the time of this run.
+
+        Compaction rewrites cache.txt and deletes parquets, so it is only
+        run by the loading lambda once it has finished loading, and the
+        loading lambda is limited to one concurrent execution.
+
+        Returns:
+            The list of compacted timestamps, or None if compaction was not
+            due.
+    """
+    now = now or datetime.now()
+    interval = timedelta(minutes=int(
+        os.environ.get('COMPACTION_INTERVAL_MINUTES')
+        or COMPACTION_INTERVAL_MINUTES))
+    try:
+        with s3.open_input_stream(f"{bucket}/{COMPACTION_RUN_KEY}") as fh:
+            last_run = datetime.fromisoformat(fh.read().decode().strip())
+    except FileNotFoundError:
+        last_run = None
+    if last_run is not None and now - last_run < interval:
+        logger.info(f"Compaction not due until {last_run + interval}.")
+        return None
+    compacted = compact_processed_bucket(s3, bucket, now=now)
+    with s3.open_output_stream(f"{bucket}/{COMPACTION_RUN_KEY}") as fh:
+        fh.write(now.isoformat().encode())
+    return compacted
+
+
+def compact_processed_bucket(s3, bucket, window_days=None, now=None):
+    """ Merges the small per-timestamp parquets of each table into one
+        larger file per table, day and load state, sorted by primary key and
+        holding only the newest version of each key.
+
+        Timestamps older than COMPACTION_MIN_AGE_MINUTES from the last
+        window_days days are grouped by day, separately for those already
+        loaded (listed in the loading lambda's cache.txt) and those still
+        pending, in runs of consecutive timestamps. Each table's files in a
+        run are merged into the file of the newest timestamp with that
+        table, the older files are deleted and a COMPACTED_MARKER is left
+        under the prefixes left without files. Works on either
+        PROCESSED_LAYOUT.
+
+        A merged loaded run lands on a timestamp already in cache.txt, so it
+        is not loaded again. For a pending run, the emptied timestamps are
+        added to cache.txt and the newer ones holding their rows are loaded
+        once. Must not run alongside a load, see compact_if_due.
+
+        Args:
+            s3: A pyarrow filesystem, normally S3FileSystem.
+
+            bucket: The name of the processed bucket.
+
+            window_days: The number of days to look back over, defaults to
+            COMPACTION_WINDOW_DAYS.
+
+            now: The current time, defaults to datetime.now().
+
+        Returns:
+            compacted: A list of the older timestamps whose files were
+            merged into a later timestamp.
+    """
+    layout = os.environ.get('PROCESSED_LAYOUT', 'timestamp')
+    min_age = timedelta(minutes=int(
+        os.environ.get('COMPACTION_MIN_AGE_MINUTES')
+        or COMPACTION_MIN_AGE_MINUTES))
+    window_days = int(
+        window_days or os.environ.get('COMPACTION_WINDOW_DAYS')
+        or COMPACTION_WINDOW_DAYS)
+    cutoff = (now or datetime.now()) - min_age
+    first_day = (cutoff - timedelta(days=window_days)).date()
+
+    loaded = set(get_cache(s3, bucket))
+    settled = []
+    for timestamp in list_timestamps(s3, bucket):
+        try:
+            when = datetime.fromisoformat(timestamp)
+        except ValueError:
+            continue
+        if first_day <= when.date() and when < cutoff:
+            settled.append(timestamp)
+
+    # Only runs of consecutive timestamps are merged, so rows never move past
+    # a timestamp of the other load state.
+    compacted = []
+    newly_loaded = []
+    for (_, is_loaded), run in groupby(
+            settled, key=lambda ts: (ts[:10], f"{ts}/" in loaded)):
+        emptied = compact_group(s3, bucket, layout, list(run))
+        compacted += emptied
+        if not is_loaded:
+            newly_loaded += emptied
+
+    # Older pending timestamps now have no rows of their own to load.
+    if newly_loaded:
+        cache = get_cache(s3, bucket)
+        put_cache(s3, bucket, cache + [
+            f"{timestamp}/" for timestamp in newly_loaded
+            if f"{timestamp}/" not in cache])
+    logger.info(f"Compacted {len(compacted)} timestamps.")
+    return compacted
+
+
+def compact_group(s3, bucket, layout, timestamps):
+    """ Merges each table's files under the passed timestamps, oldest first
+        and all from one day, into the file of the newest timestamp with
+        that table, then deletes the older files and marks the prefixes left
+        without files with COMPACTED_MARKER.
+
+        Returns:
+            A list of the timestamps whose files were all merged away.
+    """
+    workers = int(os.environ.get('COMPACTION_WORKERS') or COMPACTION_WORKERS)
+    had_files = set()
+    kept = set()
+    for table_name, files in find_table_files(
+            s3, bucket, layout, timestamps).items():
+        newest, destination = files[-1]
+        had_files.update(timestamp for timestamp, _ in files)
+        kept.add(newest)
+        if len(files) < 2:
+            continue
+        start = time.monotonic()
+        schema = WAREHOUSE_SCHEMAS[table_name]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            tables = list(pool.map(
+                lambda path: read_conformed(s3, path, table_name),
+                [path for _, path in files]))
+        table = latest_by_key(pa.concat_tables(tables))
+
+        profile = writer_profile()
+        with s3.open_output_stream(destination) as sink:
+            writer = open_parquet_writer(sink, schema, profile)
+            writer.write_table(table, row_group_size=profile['row_group_rows'])
+            writer.close()
+        for _, path in files[:-1]:
+            s3.delete_file(path)
+        logger.info(
+            f"Compacted {len(files)} {table_name} files into {destination} : "
+            f"{table.num_rows} rows in {time.monotonic() - start:.2f}s.")
+
+    emptied = sorted(had_files - kept)
+    for timestamp in emptied:
+        with s3.open_output_stream(
+                f"{bucket}/{timestamp}/{COMPACTED_MARKER}") as fh:
+            fh.write(b"Compacted into later timestamps")
+    return emptied
+
+
+def find_table_files(s3, bucket, layout, timestamps):
+    """ Returns a dict of the names of the COMPACTED_TABLES paired with a
+        list of (timestamp, path) tuples, oldest first, one for each of the
+        passed timestamps of one day that has a parquet of that table."""
+    files = {}
+    if layout == 'hive':
+        day = timestamps[0][:10]
+        for table_name in COMPACTED_TABLES:
+            names = {
+                file.base_name for file in s3.get_file_info(fs.FileSelector(
+                    f"{bucket}/table={table_name}/ingest_date={day}",
+                    allow_not_found=True))}
+            found = [
+                (timestamp, table_path(bucket, layout, table_name, timestamp))
+                for timestamp in timestamps
+                if f"{timestamp}.parquet" in names]
+            if found:
+                files[table_name] = found
+    else:
+        for timestamp in timestamps:
+            for file in s3.get_file_info(fs.FileSelector(
+                    f"{bucket}/{timestamp}", allow_not_found=True)):
+                table_name = file.base_name[:-8]
+                if file.extension == 'parquet' and (
+                        table_name in COMPACTED_TABLES):
+                    files.setdefault(table_name, []).append(
+                        (timestamp, file.path))
+    return files
+
+
+def table_path(bucket, layout, table_name, timestamp):
+    """ Returns the path of a table's parquet under a timestamp, in the
+        passed PROCESSED_LAYOUT."""
+    if layout == 'hive':
+        return (f"{bucket}/table={table_name}/ingest_date={timestamp[:10]}/"
+                f"{timestamp}.parquet")
+    return f"{bucket}/{timestamp}/{table_name}.parquet"
+
+
+def read_conformed(s3, path, table_name):
+    """ Reads a parquet of the passed warehouse table into a pyarrow table
+        conformed to its schema, dropping any other columns such as an
+        unnamed index column."""
+    schema = WAREHOUSE_SCHEMAS[table_name]
+    with s3.open_input_file(path) as fh:
+        return conform_to_schema(
+            pq.read_table(fh, columns=schema.names), table_name)
+
+
+def latest_by_key(table):
+    """ Keeps the last row of a pyarrow table for each value of its first
+        column, its primary key, and sorts the rows by that key."""
+    key = table.column_names[0]
+    table = table.append_column(
+        '__row', pa.array(range(table.num_rows), pa.int64()))
+    latest = table.group_by(key).aggregate([('__row', 'max')])['__row_max']
+    return table.take(latest).drop(['__row']).sort_by(key)
+
+
+def list_timestamps(s3, bucket):
+    """ Lists the names of the timestamp folders of the passed bucket,
+        leaving out the table partitions of the hive layout."""
+    return sorted(
+        file.base_name for file in s3.get_file_info(
+            fs.FileSelector(bucket, recursive=False))
+        if file.type == fs.FileType.Directory
+        and not file.base_name.startswith('table='))
+
+
+def get_cache(s3, bucket):
+    """ Returns the timestamp prefixes the loading lambda has recorded in
+        cache.txt as loaded, or an empty list if it has not run yet."""
+    try:
+        with s3.open_input_stream(f"{bucket}/cache.txt") as fh:
+            return [line for line in fh.read().decode().split("\n") if line]
+    except FileNotFoundError:
+        return []
+
+
+def put_cache(s3, bucket, cache):
+    """ Overwrites the loading lambda's cache.txt with the passed list."""
+    with s3.open_output_stream(f"{bucket}/cache.txt") as fh:
+        fh.write("\n".join(cache).encode())
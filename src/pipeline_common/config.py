@@ -0,0 +1,23 @@
+import time
+
+
+# How long resolved bucket names and secrets are reused across warm
+# invocations before they are looked up again.
+CONFIG_CACHE_TTL_SECONDS = 900
+
+# Values resolved by resolve_config, keyed by name and paired with the time
+# they were resolved. Module level so that it lives as long as the container.
+config_cache = {}
+
+
+def resolve_config(name, lookup, ttl=CONFIG_CACHE_TTL_SECONDS):
+    """ Returns the value cached under name if it was resolved less than ttl
+        seconds ago, otherwise calls lookup to resolve it and caches the
+        result, so that warm invocations skip repeated control-plane calls.
+        Nothing is cached if lookup raises."""
+    cached = config_cache.get(name)
+    if cached is not None and time.monotonic() - cached[1] < ttl:
+        return cached[0]
+    value = lookup()
+    config_cache[name] = (value, time.monotonic())
+    return value
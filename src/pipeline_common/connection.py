@@ -0,0 +1,83 @@
+import logging
+import pg8000.native as pg8000
+import time
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('MyLogger')
+logger.setLevel(logging.INFO)
+
+# How long a cached database connection may sit unused before it is assumed
+# to have been dropped by the server and is replaced rather than reused.
+CONNECTION_MAX_IDLE_SECONDS = 300
+
+
+class ConnectionManager:
+    """ Keeps one open connection per database and worker for as long as the
+        Lambda container stays warm, so that each query does not pay for a
+        secrets lookup and a full TLS/auth handshake.
+
+        A cached connection is health-checked before it is handed out, and is
+        replaced if the check fails or if it has been idle for longer than
+        max_idle seconds, as the server may have dropped it in the meantime.
+
+        Shared by the lambdas through the lambda layer, each passes an opener
+        that takes the name of the database and returns a new connection.
+    """
+
+    def __init__(self, opener, max_idle=CONNECTION_MAX_IDLE_SECONDS):
+        self.opener = opener
+        self.max_idle = max_idle
+        self.connections = {}
+        self.last_used = {}
+
+    def get(self, db, worker=0):
+        """ Returns a healthy connection to the passed database for the passed
+            worker, opening a new one if there is no usable cached connection.
+        """
+        key = (db, worker)
+        conn = self.connections.get(key)
+        if conn is not None:
+            idle = time.monotonic() - self.last_used[key]
+            if idle > self.max_idle or not self.is_healthy(conn):
+                logger.info(f"Cached {db} connection is stale, reconnecting.")
+                self.discard(db, worker)
+                conn = None
+        if conn is None:
+            conn = self.opener(db)
+            self.connections[key] = conn
+        self.last_used[key] = time.monotonic()
+        return conn
+
+    @staticmethod
+    def is_healthy(conn):
+        """ Bool for whether the passed connection can still run a query."""
+        try:
+            conn.run("SELECT 1;")
+        except (pg8000.Error, OSError):
+            return False
+        return True
+
+    def discard(self, db, worker=0):
+        """ Closes and forgets the cached connection to the passed database."""
+        conn = self.connections.pop((db, worker), None)
+        self.last_used.pop((db, worker), None)
+        if conn is not None:
+            try:
+                conn.close()
+            except (pg8000.Error, OSError):
+                pass
+
+    @contextmanager
+    def lease(self, db, worker=0):
+        """ Context manager that yields a connection to the passed database.
+            The connection stays open on exit so it can be reused, unless an
+            error was raised while it was in use, in which case it is
+            discarded."""
+        conn = self.get(db, worker)
+        try:
+            yield conn
+        except Exception:
+            self.discard(db, worker)
+            raise
+        self.last_used[(db, worker)] = time.monotonic()
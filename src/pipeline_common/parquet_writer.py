@@ -0,0 +1,67 @@
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# Default settings of the parquet writer, each can be overridden by the
+# environment variable named alongside it. Used by the transformation lambda
+# to write parquet output, by stage 2 to convert the csvs and by the loading
+# lambda to write compacted files.
+PARQUET_PROFILE = {
+    # PARQUET_WRITER_CODEC: snappy, zstd, gzip or none.
+    'codec': 'zstd',
+    # PARQUET_WRITER_LEVEL: the codec's compression level, blank for its
+    # default.
+    'level': None,
+    # PARQUET_WRITER_DICTIONARY: dictionary encode string columns.
+    'dictionary': True,
+    # PARQUET_WRITER_ROW_GROUP_ROWS: rows buffered into each row group,
+    # which bounds the memory used by a conversion.
+    'row_group_rows': 131072,
+    # PARQUET_WRITER_STATISTICS: write min/max statistics for each column.
+    'statistics': True,
+}
+
+
+def writer_profile():
+    """ Returns the parquet writer settings, PARQUET_PROFILE overridden by
+        any of its environment variables that are set."""
+    profile = dict(PARQUET_PROFILE)
+    codec = os.environ.get('PARQUET_WRITER_CODEC')
+    if codec:
+        profile['codec'] = codec
+    level = os.environ.get('PARQUET_WRITER_LEVEL')
+    if level:
+        profile['level'] = int(level)
+    dictionary = os.environ.get('PARQUET_WRITER_DICTIONARY')
+    if dictionary:
+        profile['dictionary'] = dictionary.lower() == 'true'
+    row_group_rows = os.environ.get('PARQUET_WRITER_ROW_GROUP_ROWS')
+    if row_group_rows:
+        profile['row_group_rows'] = int(row_group_rows)
+    statistics = os.environ.get('PARQUET_WRITER_STATISTICS')
+    if statistics:
+        profile['statistics'] = statistics.lower() == 'true'
+    return profile
+
+
+def open_parquet_writer(sink, schema, profile):
+    """ Returns a pyarrow ParquetWriter of the passed schema writing to sink,
+        with the writer settings in profile, see PARQUET_PROFILE."""
+    if profile['dictionary']:
+        use_dictionary = [
+            field.name for field in schema
+            if pa.types.is_string(field.type)
+            or pa.types.is_large_string(field.type)
+        ]
+    else:
+        use_dictionary = False
+    codec = profile['codec']
+    return pq.ParquetWriter(
+        sink,
+        schema=schema,
+        compression=None if codec == 'none' else codec,
+        compression_level=profile['level'],
+        use_dictionary=use_dictionary,
+        write_statistics=profile['statistics'],
+    )
@@ -0,0 +1,116 @@
+import logging
+import pyarrow as pa
+
+
+logger = logging.getLogger('MyLogger')
+logger.setLevel(logging.INFO)
+
+# Arrow schemas of the warehouse tables, used to write every parquet of a
+# table with the same column order and types whatever its contents, so that
+# an all-null column is still a string and ids are always int32. Columns
+# with few distinct values are dictionary encoded. This is the single
+# registry of warehouse column types, the transformation lambda derives its
+# pandas dtypes from it. Shared by every lambda through the lambda layer.
+ARROW_ID = pa.int32()
+ARROW_TEXT = pa.string()
+ARROW_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+ARROW_DATE = pa.date32()
+ARROW_TIME = pa.time64('us')
+
+WAREHOUSE_SCHEMAS = {
+    'dim_counterparty': pa.schema([
+        ('counterparty_id', ARROW_ID),
+        ('counterparty_legal_name', ARROW_TEXT),
+        ('counterparty_legal_address_line_1', ARROW_TEXT),
+        ('counterparty_legal_address_line_2', ARROW_TEXT),
+        ('counterparty_legal_district', ARROW_TEXT),
+        ('counterparty_legal_city', ARROW_CATEGORY),
+        ('counterparty_legal_postal_code', ARROW_TEXT),
+        ('counterparty_legal_country', ARROW_CATEGORY),
+        ('counterparty_legal_phone_number', ARROW_TEXT),
+    ]),
+    'dim_currency': pa.schema([
+        ('currency_id', ARROW_ID),
+        ('currency_code', ARROW_CATEGORY),
+        ('currency_name', ARROW_CATEGORY),
+    ]),
+    'dim_date': pa.schema([
+        ('date_id', ARROW_DATE),
+        ('year', pa.int16()),
+        ('month', pa.int8()),
+        ('day', pa.int8()),
+        ('day_of_week', pa.int8()),
+        ('day_name', ARROW_CATEGORY),
+        ('month_name', ARROW_CATEGORY),
+        ('quarter', pa.int8()),
+    ]),
+    'dim_design': pa.schema([
+        ('design_id', ARROW_ID),
+        ('design_name', ARROW_TEXT),
+        ('file_location', ARROW_TEXT),
+        ('file_name', ARROW_TEXT),
+    ]),
+    'dim_location': pa.schema([
+        ('location_id', ARROW_ID),
+        ('address_line_1', ARROW_TEXT),
+        ('address_line_2', ARROW_TEXT),
+        ('district', ARROW_TEXT),
+        ('city', ARROW_CATEGORY),
+        ('postal_code', ARROW_TEXT),
+        ('country', ARROW_CATEGORY),
+        ('phone', ARROW_TEXT),
+    ]),
+    'dim_staff': pa.schema([
+        ('staff_id', ARROW_ID),
+        ('first_name', ARROW_TEXT),
+        ('last_name', ARROW_TEXT),
+        ('department_name', ARROW_CATEGORY),
+        ('location', ARROW_CATEGORY),
+        ('email_address', ARROW_TEXT),
+    ]),
+    'fact_sales_order': pa.schema([
+        ('sales_order_id', ARROW_ID),
+        ('created_date', ARROW_DATE),
+        ('created_time', ARROW_TIME),
+        ('last_updated_date', ARROW_DATE),
+        ('last_updated_time', ARROW_TIME),
+        ('sales_staff_id', ARROW_ID),
+        ('counterparty_id', ARROW_ID),
+        ('units_sold', ARROW_ID),
+        ('unit_price', pa.float64()),
+        ('currency_id', ARROW_ID),
+        ('design_id', ARROW_ID),
+        ('agreed_payment_date', ARROW_DATE),
+        ('agreed_delivery_date', ARROW_DATE),
+        ('agreed_delivery_location_id', ARROW_ID),
+    ]),
+}
+
+
+def conform_to_schema(table, table_name):
+    """ Selects and casts the columns of a pyarrow table to the passed
+        warehouse table's schema in WAREHOUSE_SCHEMAS, leaving tables without
+        a schema as they are. Schema columns missing from the file are
+        skipped, and columns whose values cannot be cast keep their type."""
+    schema = WAREHOUSE_SCHEMAS.get(table_name)
+    if schema is None:
+        return table
+    columns = {}
+    for field in schema:
+        if field.name not in table.column_names:
+            continue
+        column = table.column(field.name)
+        try:
+            # Arrow cannot cast plain values to a dictionary type, so they
+            # are cast to its value type and dictionary encoded instead.
+            if (pa.types.is_dictionary(field.type)
+                    and not pa.types.is_dictionary(column.type)):
+                column = column.cast(
+                    field.type.value_type).dictionary_encode()
+            column = column.cast(field.type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            logger.warning(
+                f"{table_name}.{field.name} could not be cast to "
+                f"{field.type}, keeping {column.type}.")
+        columns[field.name] = column
+    return pa.table(columns)
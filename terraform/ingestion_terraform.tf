@@ -106,9 +106,14 @@ resource "aws_lambda_function" "ingestion_lambda" {
   role             = aws_iam_role.ingestion_lambda_role.arn
   handler          = "ingestion_lambda.ingestion_lambda_handler"
   runtime          = "python3.10"
-  timeout          = "60"
+  timeout          = "180"
   source_code_hash = data.archive_file.ingestion_lambda_zip.output_base64sha256
   layers           = [aws_lambda_layer_version.lambda_requirements_layer.arn]
+  environment {
+    variables = {
+      INGESTION_BUCKET = aws_s3_bucket.raw_csv_data_bucket.bucket
+    }
+  }
   tags = {
     Repo       = "https://github.com/SpinyKarma/de-AWS-pipeline-project"
     Managed_by = "Terraform"
@@ -246,6 +251,36 @@ resource "aws_cloudwatch_metric_alarm" "no_timestamp_error_alarm" {
 }
 
 
+resource "aws_cloudwatch_log_metric_filter" "unreplicated_delete_error_metric" {
+  name           = "unreplicated_delete_error_metric"
+  pattern        = "\"Unreplicated Delete Error\""
+  log_group_name = aws_cloudwatch_log_group.ingestion_log_group.name
+
+  metric_transformation {
+    name      = "unreplicated_delete_error_metric"
+    namespace = "unreplicated_delete_error_metric"
+    value     = "1"
+  }
+}
+
+resource "aws_cloudwatch_metric_alarm" "unreplicated_delete_error_alarm" {
+  alarm_name          = "unreplicated_delete_error_alarm"
+  comparison_operator = "GreaterThanOrEqualToThreshold"
+  evaluation_periods  = 1
+  metric_name         = aws_cloudwatch_log_metric_filter.unreplicated_delete_error_metric.metric_transformation[0].name
+  namespace           = aws_cloudwatch_log_metric_filter.unreplicated_delete_error_metric.metric_transformation[0].namespace
+  period              = 60
+  statistic           = "Sum"
+  threshold           = "1"
+  alarm_actions       = [aws_sns_topic.notification_topic.arn]
+  tags = {
+    Repo       = "https://github.com/SpinyKarma/de-AWS-pipeline-project"
+    Managed_by = "Terraform"
+    Project    = "Northcoders-AWS-ETL-pipeline"
+    Lambda     = "Ingestion"
+  }
+}
+
 resource "aws_cloudwatch_log_metric_filter" "exception_error_metric" {
   name           = "exception_error_metric"
   pattern        = "Exception"
@@ -105,9 +105,19 @@ resource "aws_lambda_function" "loading_lambda" {
   role             = aws_iam_role.loading_lambda_role.arn
   handler          = "loading_lambda.loading_lambda_handler"
   runtime          = "python3.10"
-  timeout          = "60"
+  timeout          = "300"
   source_code_hash = data.archive_file.loading_lambda_zip.output_base64sha256
-  layers           = [aws_lambda_layer_version.lambda_requirements_layer_2.arn]
+  layers           = [aws_lambda_layer_version.lambda_requirements_layer.arn]
+
+  # One load at a time, as each run rewrites cache.txt and compacts the
+  # processed bucket after loading.
+  reserved_concurrent_executions = 1
+
+  environment {
+    variables = {
+      PROCESSED_BUCKET = aws_s3_bucket.processed-parquet-data.bucket
+    }
+  }
   tags = {
     Repo       = "https://github.com/SpinyKarma/de-AWS-pipeline-project"
     Managed_by = "Terraform"
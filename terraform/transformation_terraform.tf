@@ -103,6 +103,12 @@ resource "aws_lambda_function" "transformation_lambda" {
   timeout          = "60"
   source_code_hash = data.archive_file.transformation_lambda_zip.output_base64sha256
   layers           = [aws_lambda_layer_version.lambda_requirements_layer.arn]
+  environment {
+    variables = {
+      INGESTION_BUCKET = aws_s3_bucket.raw_csv_data_bucket.bucket
+      PROCESSED_BUCKET = aws_s3_bucket.processed-parquet-data.bucket
+    }
+  }
   tags = {
     Repo       = "https://github.com/SpinyKarma/de-AWS-pipeline-project"
     Managed_by = "Terraform"
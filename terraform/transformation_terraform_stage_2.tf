@@ -102,7 +102,13 @@ resource "aws_lambda_function" "transformation_stage_2_lambda" {
   runtime          = "python3.10"
   timeout          = "60"
   source_code_hash = data.archive_file.transformation_stage_2_lambda_zip.output_base64sha256
-  layers           = [aws_lambda_layer_version.lambda_requirements_layer_2.arn]
+  layers           = [aws_lambda_layer_version.lambda_requirements_layer.arn]
+  environment {
+    variables = {
+      PROCESSED_BUCKET = aws_s3_bucket.processed-parquet-data.bucket
+      STAGE_2_WORKERS  = "4"
+    }
+  }
   tags = {
     Repo       = "https://github.com/SpinyKarma/de-AWS-pipeline-project"
     Managed_by = "Terraform"
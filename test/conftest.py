@@ -0,0 +1,129 @@
+import boto3
+import io
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import requests
+import socket
+from collections import namedtuple
+from moto.server import ThreadedMotoServer
+from pyarrow import fs
+from unittest.mock import patch
+from pipeline_common.config import config_cache
+
+
+class S3Server(namedtuple('S3Server', ['client', 'filesystem'])):
+    '''
+        A boto3 client and a pyarrow filesystem on the same moto S3 server.
+    '''
+
+    def keys(self, bucket='processed'):
+        '''
+            Lists the keys of the passed bucket, leaving out the folder
+            markers pyarrow writes when it deletes a folder's last file.
+        '''
+
+        contents = self.client.list_objects_v2(Bucket=bucket).get(
+            'Contents', [])
+        return sorted(item['Key'] for item in contents
+                      if not item['Key'].endswith('/'))
+
+    def read_text(self, key, bucket='processed'):
+        '''
+            Returns the decoded body of the passed object.
+        '''
+
+        return self.client.get_object(
+            Bucket=bucket, Key=key)['Body'].read().decode()
+
+    def read_parquet(self, key, bucket='processed'):
+        '''
+            Returns the passed parquet object as a pyarrow table.
+        '''
+
+        body = self.client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        return pq.read_table(io.BytesIO(body))
+
+
+@pytest.fixture(autouse=True)
+def reset_config_cache():
+    '''
+        Clears the config cache shared by the lambdas around every test, so
+        that bucket names and credentials resolved by one test are never
+        reused by another.
+    '''
+
+    config_cache.clear()
+    yield
+    config_cache.clear()
+
+
+@pytest.fixture(scope='session')
+def moto_server_endpoint():
+    '''
+        Runs a moto server for the whole session, as pyarrow's S3FileSystem
+        does not go through botocore and so cannot be mocked in process.
+    '''
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port,
+                                verbose=False)
+    server.start()
+    yield f'127.0.0.1:{port}'
+    server.stop()
+
+
+@pytest.fixture
+def s3_server(moto_server_endpoint, monkeypatch):
+    '''
+        Empties the moto server and returns an S3Server on it, for testing
+        code that reads and writes S3 through pyarrow.
+    '''
+
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    requests.post(f'http://{moto_server_endpoint}/moto-api/reset')
+    return S3Server(
+        boto3.client('s3', region_name='eu-west-2',
+                     endpoint_url=f'http://{moto_server_endpoint}'),
+        fs.S3FileSystem(region='eu-west-2', scheme='http',
+                        endpoint_override=moto_server_endpoint,
+                        access_key='testing', secret_key='testing'))
+
+
+@pytest.fixture
+def processed_bucket(s3_server, monkeypatch):
+    '''
+        Creates the processed bucket on the moto server, names it in
+        PROCESSED_BUCKET and makes the lambdas' pyarrow S3FileSystem use the
+        server.
+    '''
+
+    s3_server.client.create_bucket(
+        Bucket='processed',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    monkeypatch.setenv('PROCESSED_BUCKET', 'processed')
+    with patch.object(fs, 'S3FileSystem',
+                      return_value=s3_server.filesystem):
+        yield s3_server
+
+
+@pytest.fixture
+def currency_parquet():
+    '''
+        Returns a function that builds a dim_currency parquet body from
+        (currency_id, currency_code) pairs.
+    '''
+
+    def build(rows):
+        table = pa.table({
+            'currency_id': [currency_id for currency_id, _ in rows],
+            'currency_code': [code for _, code in rows],
+            'currency_name': ['Name'] * len(rows),
+        })
+        sink = io.BytesIO()
+        pq.write_table(table, sink)
+        return sink.getvalue()
+    return build
@@ -0,0 +1,65 @@
+import pandas as pd
+from src.lambda_transformation.utils.coalesce import coalesce_groups
+
+
+def sales_order_dict(timestamp, *rows):
+    return {
+        'Key': f'{timestamp}/sales_order.csv',
+        'Body': pd.DataFrame([
+            {'sales_order_id': sales_order_id,
+             'units_sold': units_sold,
+             'last_updated': pd.Timestamp(last_updated)}
+            for sales_order_id, units_sold, last_updated in rows
+        ]),
+        'Timestamp': timestamp,
+    }
+
+
+def test_coalesce_groups_keeps_newest_version_of_each_row():
+    """ Test whether 'coalesce_groups' keeps only the row with the latest
+        last_updated for each id across every group.
+    """
+    groups = [
+        {'sales_order': sales_order_dict(
+            't1', (1, 10, '2023-01-01'), (2, 20, '2023-01-01'))},
+        {'sales_order': sales_order_dict(
+            't2', (1, 11, '2023-01-02'))},
+        {'sales_order': sales_order_dict(
+            't3', (1, 12, '2023-01-03'), (3, 30, '2023-01-03'))},
+    ]
+    coalesced = coalesce_groups(groups, 't3')['sales_order']
+    assert coalesced['Key'] == 't3/sales_order.csv'
+    assert coalesced['Timestamp'] == 't3'
+    body = coalesced['Body'].sort_values('sales_order_id')
+    assert body['sales_order_id'].tolist() == [1, 2, 3]
+    assert body['units_sold'].tolist() == [12, 20, 30]
+
+
+def test_coalesce_groups_prefers_later_group_on_equal_last_updated():
+    """ Test whether 'coalesce_groups' falls back to group order when two
+        versions of a row share a last_updated.
+    """
+    groups = [
+        {'sales_order': sales_order_dict('t1', (1, 10, '2023-01-01'))},
+        {'sales_order': sales_order_dict('t2', (1, 11, '2023-01-01'))},
+    ]
+    body = coalesce_groups(groups, 't2')['sales_order']['Body']
+    assert body['units_sold'].tolist() == [11]
+
+
+def test_coalesce_groups_keeps_tables_from_any_group():
+    """ Test whether 'coalesce_groups' includes tables that only appear in
+        some of the groups.
+    """
+    currency = {
+        'Key': 't1/currency.csv',
+        'Body': pd.DataFrame({'currency_id': [1], 'currency_code': ['GBP']}),
+        'Timestamp': 't1',
+    }
+    groups = [
+        {'currency': currency},
+        {'sales_order': sales_order_dict('t2', (1, 10, '2023-01-01'))},
+    ]
+    coalesced = coalesce_groups(groups, 't2')
+    assert sorted(coalesced) == ['currency', 'sales_order']
+    assert coalesced['currency']['Key'] == 't2/currency.csv'
@@ -44,3 +44,17 @@ def test_output_body_has_expected_transformation_applied():
         })
     }
     assert output['Body'].equals(test_output['Body'])
+
+
+def test_unknown_currency_codes_have_no_name():
+    """ Test whether the function 'currency_to_dim_currency' names lower case
+        codes and leaves the name of unknown codes as None.
+    """
+    output = dcy({
+        'Key': '2023-07-31T12:24:11.422525/currency.csv',
+        'Body': pd.DataFrame({
+            'currency_id': [1, 2],
+            'currency_code': ['gbp', 'XYZ'],
+        })
+    })
+    assert list(output['Body']['currency_name']) == ['British Pound', None]
@@ -62,3 +62,51 @@ def test_sales_order_to_fact_sales_order_empty_dataframe():
 
     with pytest.raises(KeyError):
         dim_sales.sales_order_to_fact_sales_order(sales_order_dict)
+
+
+def test_sales_order_to_fact_sales_order_splits_both_timestamps():
+    '''Test that the created and last updated columns are split from their
+       own timestamps, whether passed as strings or datetimes.'''
+    for created_at, last_updated in [
+        ('2023-08-02 09:10:09.786000', '2023-08-03 10:11:12'),
+        (pd.Timestamp('2023-08-02 09:10:09.786'),
+         pd.Timestamp('2023-08-03 10:11:12')),
+    ]:
+        sales_order_dict = {
+            'Key': 'sales_order.csv',
+            'Body': pd.DataFrame({
+                'sales_order_id': [3539],
+                'created_at': [created_at],
+                'last_updated': [last_updated],
+                'design_id': [85],
+                'staff_id': [13],
+                'counterparty_id': [8],
+                'units_sold': [33289],
+                'unit_price': [3.25],
+                'currency_id': [11],
+                'agreed_payment_date': ['2023-08-06'],
+                'agreed_delivery_date': ['2023-08-04'],
+                'agreed_delivery_location_id': [19]
+            })
+        }
+
+        body = dim_sales.sales_order_to_fact_sales_order(
+            sales_order_dict)['Body']
+
+        assert body['created_date'][0] == '2023-08-02'
+        assert body['created_time'][0] == '09:10:09.786000'
+        assert body['last_updated_date'][0] == '2023-08-03'
+        assert body['last_updated_time'][0] == '10:11:12.000000'
+
+
+def test_split_timestamps_keeps_index_and_missing_values():
+    '''Test that the split columns keep the index of the timestamps, so they
+       line up with the other columns, and that a missing timestamp gives a
+       missing date and time.'''
+    timestamps = pd.Series(
+        ['2023-08-02 09:10:09.786000', None, '2023-08-03 10:11:12'],
+        index=[7, 8, 9])
+    dates, times = dim_sales.split_timestamps(timestamps)
+    assert dates.index.tolist() == [7, 8, 9]
+    assert dates.tolist() == ['2023-08-02', None, '2023-08-03']
+    assert times.tolist() == ['09:10:09.786000', None, '10:11:12.000000']
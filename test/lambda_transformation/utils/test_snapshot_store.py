@@ -0,0 +1,146 @@
+import boto3
+import pandas as pd
+from moto import mock_s3
+from unittest.mock import Mock
+from src.lambda_transformation.utils.snapshot_store import (
+    SnapshotStore,
+    join_with_snapshots,
+)
+
+
+def address_rows(*rows):
+    return pd.DataFrame(
+        [{'address_id': address_id, 'city': city} for address_id, city in rows]
+    )
+
+
+def counterparty_rows(*rows):
+    return pd.DataFrame([
+        {'counterparty_id': counterparty_id,
+         'counterparty_legal_name': name,
+         'legal_address_id': address_id}
+        for counterparty_id, name, address_id in rows
+    ])
+
+
+def csv_dict(table_name, body, timestamp='2023-08-02T13:10:09.556000'):
+    return {
+        'Key': f'{timestamp}/{table_name}.csv',
+        'Body': body,
+        'Timestamp': timestamp,
+    }
+
+
+@mock_s3
+def test_snapshot_is_saved_to_bucket_and_read_back(tmp_path):
+    """ Test whether a saved snapshot, with the batch replacing rows of the
+        same id, is read back by a new store.
+    """
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='processed')
+    store = SnapshotStore(s3, 'processed', str(tmp_path))
+    assert store.get('address').empty
+    store.upsert('address', address_rows((1, 'Leeds'), (2, 'York')))
+    store.upsert('address', address_rows((2, 'Hull')))
+    store.save()
+
+    (tmp_path / 'empty').mkdir()
+    read_back = SnapshotStore(s3, 'processed', str(tmp_path / 'empty'))
+    assert read_back.get('address').to_dict('records') == [
+        {'address_id': 1, 'city': 'Leeds'},
+        {'address_id': 2, 'city': 'Hull'},
+    ]
+
+
+@mock_s3
+def test_cached_snapshot_is_not_downloaded_again(tmp_path):
+    """ Test whether a store reads an unchanged snapshot from the cache,
+        only revalidating it against the bucket.
+    """
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='processed')
+    store = SnapshotStore(s3, 'processed', str(tmp_path))
+    store.upsert('address', address_rows((1, 'Leeds')))
+    store.save()
+
+    spy = Mock(wraps=s3)
+    cached = SnapshotStore(spy, 'processed', str(tmp_path))
+    assert list(cached.get('address')['city']) == ['Leeds']
+    assert 'IfNoneMatch' in spy.get_object.call_args.kwargs
+
+
+def test_counterparty_is_joined_to_address_from_earlier_group(tmp_path):
+    """ Test whether a group holding only counterparty rows is joined with
+        addresses that arrived in an earlier group.
+    """
+    s3 = Mock()
+    store = SnapshotStore(s3, 'processed', str(tmp_path))
+    store.tables = {
+        'address': address_rows((1, 'Leeds')),
+        'counterparty': pd.DataFrame(),
+    }
+    join_block = join_with_snapshots(store, {
+        'counterparty': csv_dict(
+            'counterparty', counterparty_rows((7, 'Acme', 1))),
+    })
+    assert list(join_block['counterparty']['Body']['counterparty_id']) == [7]
+    assert list(join_block['address']['Body']['city']) == ['Leeds']
+    assert join_block['address']['Key'].startswith('2023-08-02')
+
+
+def test_address_change_is_applied_to_referencing_counterparties(tmp_path):
+    """ Test whether a group holding only address rows rejoins the
+        counterparties that reference the changed addresses.
+    """
+    s3 = Mock()
+    store = SnapshotStore(s3, 'processed', str(tmp_path))
+    store.tables = {
+        'address': address_rows((1, 'Leeds'), (2, 'York')),
+        'counterparty': counterparty_rows((7, 'Acme', 1), (8, 'Bolt', 2)),
+    }
+    join_block = join_with_snapshots(store, {
+        'address': csv_dict('address', address_rows((2, 'Hull'))),
+    })
+    assert list(join_block['counterparty']['Body']['counterparty_id']) == [8]
+    assert list(join_block['address']['Body']['city']) == ['Leeds', 'Hull']
+    assert 'staff' not in join_block
+
+
+@mock_s3
+def test_missing_snapshot_is_seeded_with_latest_rows(tmp_path):
+    """ Test whether a table with no snapshot in the bucket is seeded with
+        the latest version of each row from the seed, and is saved.
+    """
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='processed')
+    seed = Mock(return_value=address_rows(
+        (1, 'Leeds'), (2, 'York'), (1, 'Hull')))
+    store = SnapshotStore(s3, 'processed', str(tmp_path), seed=seed)
+    assert store.get('address').to_dict('records') == [
+        {'address_id': 2, 'city': 'York'},
+        {'address_id': 1, 'city': 'Hull'},
+    ]
+    seed.assert_called_once_with('address')
+    store.save()
+    saved = s3.get_object(Bucket='processed', Key='address_snapshot.parquet')
+    assert saved['ContentLength'] > 0
+
+
+@mock_s3
+def test_existing_snapshot_is_not_seeded(tmp_path):
+    """ Test whether a table that already has a snapshot in the bucket is
+        read from it without calling the seed.
+    """
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='processed')
+    store = SnapshotStore(s3, 'processed', str(tmp_path))
+    store.upsert('address', address_rows((1, 'Leeds')))
+    store.save()
+
+    seed = Mock()
+    (tmp_path / 'empty').mkdir()
+    read_back = SnapshotStore(
+        s3, 'processed', str(tmp_path / 'empty'), seed=seed)
+    assert read_back.get('address')['city'].tolist() == ['Leeds']
+    seed.assert_not_called()
+    assert read_back.changed == set()
@@ -0,0 +1,96 @@
+import datetime
+import pandas as pd
+import pyarrow as pa
+from pipeline_common.warehouse_schemas import WAREHOUSE_SCHEMAS
+from src.lambda_transformation.utils.warehouse_dtypes import (
+    WAREHOUSE_DTYPES,
+    apply_warehouse_dtypes,
+)
+
+
+def test_location_columns_are_cast_to_compact_dtypes():
+    """ Test whether 'apply_warehouse_dtypes' casts ids to nullable integers,
+        low cardinality columns to categoricals and text to arrow strings,
+        keeping missing values as nulls.
+    """
+    dim_location = pd.DataFrame({
+        'location_id': [1, 2],
+        'address_line_1': ['20 larch road', '1 oak lane'],
+        'address_line_2': [None, 'flat 2'],
+        'city': ['Leeds', 'Leeds'],
+    })
+    output = apply_warehouse_dtypes('dim_location', dim_location)
+    assert str(output['location_id'].dtype) == 'Int32'
+    assert str(output['city'].dtype) == 'category'
+    assert str(output['address_line_2'].dtype) == 'string'
+    assert output['address_line_2'].isna().tolist() == [True, False]
+
+
+def test_fact_sales_order_dates_and_times_are_typed():
+    """ Test whether 'apply_warehouse_dtypes' parses the date and time strings
+        of fact_sales_order into dates and times, and prices to floats.
+    """
+    fact_sales_order = pd.DataFrame({
+        'created_date': ['2023-08-02'],
+        'created_time': ['09:10:09.786000'],
+        'unit_price': ['3.25'],
+        'agreed_payment_date': ['2023-08-06'],
+    })
+    output = apply_warehouse_dtypes('fact_sales_order', fact_sales_order)
+    assert output['created_date'][0] == datetime.date(2023, 8, 2)
+    assert output['created_time'][0] == datetime.time(9, 10, 9, 786000)
+    assert output['unit_price'][0] == 3.25
+    assert output['agreed_payment_date'][0] == datetime.date(2023, 8, 6)
+
+
+def test_unknown_tables_and_columns_are_left_alone():
+    """ Test whether 'apply_warehouse_dtypes' leaves tables and columns that
+        are not in the registry as they are.
+    """
+    dataframe = pd.DataFrame({'currency_id': [1], 'extra': ['x']})
+    assert apply_warehouse_dtypes('unknown', dataframe).equals(dataframe)
+    output = apply_warehouse_dtypes('dim_currency', dataframe)
+    assert output['extra'].dtype == object
+
+
+def test_dtypes_are_derived_from_every_schema():
+    """ Test whether WAREHOUSE_DTYPES has the tables and columns of
+        WAREHOUSE_SCHEMAS, in the same order, with the compact pandas dtype
+        of each arrow type.
+    """
+    assert list(WAREHOUSE_DTYPES) == list(WAREHOUSE_SCHEMAS)
+    for table_name, schema in WAREHOUSE_SCHEMAS.items():
+        assert list(WAREHOUSE_DTYPES[table_name]) == schema.names
+    assert WAREHOUSE_DTYPES['dim_date'] == {
+        'date_id': pd.ArrowDtype(pa.date32()),
+        'year': 'Int16',
+        'month': 'Int8',
+        'day': 'Int8',
+        'day_of_week': 'Int8',
+        'day_name': 'category',
+        'month_name': 'category',
+        'quarter': 'Int8',
+    }
+    assert WAREHOUSE_DTYPES['fact_sales_order']['created_time'] == \
+        pd.ArrowDtype(pa.time64('us'))
+    assert WAREHOUSE_DTYPES['fact_sales_order']['unit_price'] == 'float64'
+    assert WAREHOUSE_DTYPES['dim_design']['design_name'] == 'string[pyarrow]'
+    assert WAREHOUSE_DTYPES['dim_design']['design_id'] == 'Int32'
+
+
+def test_all_null_column_keeps_its_schema_type():
+    """ Test whether a cast table converts to its arrow schema, with an
+        all-null text column still typed as a string.
+    """
+    dim_currency = apply_warehouse_dtypes('dim_currency', pd.DataFrame({
+        'currency_id': [1, 2],
+        'currency_code': ['GBP', 'XXX'],
+        'currency_name': [None, None],
+    }))
+    table = pa.Table.from_pandas(
+        dim_currency,
+        schema=WAREHOUSE_SCHEMAS['dim_currency'],
+        preserve_index=False)
+    assert table.schema.remove_metadata().equals(
+        WAREHOUSE_SCHEMAS['dim_currency'])
+    assert table.column('currency_name').to_pylist() == [None, None]
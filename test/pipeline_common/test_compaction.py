@@ -0,0 +1,128 @@
+import pyarrow as pa
+import pytest
+from datetime import datetime
+from pipeline_common.compaction import (
+    COMPACTED_MARKER,
+    COMPACTION_RUN_KEY,
+    compact_if_due,
+    compact_processed_bucket,
+    latest_by_key,
+)
+
+
+NOW = datetime(2023, 8, 4, 12)
+
+
+@pytest.fixture
+def loaded_bucket(processed_bucket, currency_parquet):
+    '''
+        Fills the processed bucket with dim_currency under five timestamps.
+        The first two of 2023-08-02 are loaded, the next two are pending, and
+        one more is pending on 2023-08-03.
+    '''
+
+    for timestamp, rows in [
+            ('2023-08-02 09:00:00.000000', [(1, 'GBP'), (2, 'USD')]),
+            ('2023-08-02 10:00:00.000000', [(2, 'EUR')]),
+            ('2023-08-02 11:00:00.000000', [(3, 'JPY'), (4, 'CHF')]),
+            ('2023-08-02 12:00:00.000000', [(3, 'AUD')]),
+            ('2023-08-03 09:00:00.000000', [(5, 'CAD')])]:
+        processed_bucket.client.put_object(
+            Bucket='processed', Key=f'{timestamp}/dim_currency.parquet',
+            Body=currency_parquet(rows))
+    processed_bucket.client.put_object(
+        Bucket='processed', Key='cache.txt',
+        Body='2023-08-02 09:00:00.000000/\n2023-08-02 10:00:00.000000/')
+    return processed_bucket
+
+
+def read_currency(s3_server, timestamp):
+    '''
+        Returns the (currency_id, currency_code) pairs of a timestamp's
+        dim_currency parquet.
+    '''
+
+    table = s3_server.read_parquet(f'{timestamp}/dim_currency.parquet')
+    return list(zip(table.column('currency_id').to_pylist(),
+                    table.column('currency_code').to_pylist()))
+
+
+def test_latest_by_key_keeps_last_row_of_each_key():
+    '''
+        Test whether 'latest_by_key' keeps the last row for each value of the
+        first column and sorts the rows by it.
+    '''
+
+    table = pa.table({'id': [2, 1, 2, 3], 'value': ['a', 'b', 'c', 'd']})
+    assert latest_by_key(table).to_pylist() == [
+        {'id': 1, 'value': 'b'}, {'id': 2, 'value': 'c'},
+        {'id': 3, 'value': 'd'}]
+
+
+def test_compact_processed_bucket_merges_runs_by_day_and_load_state(
+        loaded_bucket):
+    '''
+        Test whether 'compact_processed_bucket' merges the loaded and pending
+        runs of a day separately into their newest timestamp, keeping the
+        latest row of each key, and leaves a lone timestamp alone.
+    '''
+
+    s3 = loaded_bucket.filesystem
+    compacted = compact_processed_bucket(s3, 'processed', now=NOW)
+    assert compacted == [
+        '2023-08-02 09:00:00.000000', '2023-08-02 11:00:00.000000']
+    assert loaded_bucket.keys() == [
+        f'2023-08-02 09:00:00.000000/{COMPACTED_MARKER}',
+        '2023-08-02 10:00:00.000000/dim_currency.parquet',
+        f'2023-08-02 11:00:00.000000/{COMPACTED_MARKER}',
+        '2023-08-02 12:00:00.000000/dim_currency.parquet',
+        '2023-08-03 09:00:00.000000/dim_currency.parquet',
+        'cache.txt']
+    assert read_currency(loaded_bucket, '2023-08-02 10:00:00.000000') == [
+        (1, 'GBP'), (2, 'EUR')]
+    assert read_currency(loaded_bucket, '2023-08-02 12:00:00.000000') == [
+        (3, 'AUD'), (4, 'CHF')]
+
+
+def test_compact_processed_bucket_adds_emptied_pending_to_cache(
+        loaded_bucket):
+    '''
+        Test whether 'compact_processed_bucket' adds the emptied pending
+        timestamps to cache.txt, keeping the newest pending timestamp to be
+        loaded.
+    '''
+
+    s3 = loaded_bucket.filesystem
+    compact_processed_bucket(s3, 'processed', now=NOW)
+    assert loaded_bucket.read_text('cache.txt').split('\n') == [
+        '2023-08-02 09:00:00.000000/', '2023-08-02 10:00:00.000000/',
+        '2023-08-02 11:00:00.000000/']
+
+
+def test_compact_processed_bucket_skips_recent_timestamps(loaded_bucket):
+    '''
+        Test whether 'compact_processed_bucket' leaves timestamps younger
+        than COMPACTION_MIN_AGE_MINUTES alone.
+    '''
+
+    s3 = loaded_bucket.filesystem
+    compacted = compact_processed_bucket(
+        s3, 'processed', now=datetime(2023, 8, 2, 12, 30))
+    assert compacted == ['2023-08-02 09:00:00.000000']
+    assert read_currency(loaded_bucket, '2023-08-02 11:00:00.000000') == [
+        (3, 'JPY'), (4, 'CHF')]
+
+
+def test_compact_if_due_runs_once_per_interval(loaded_bucket):
+    '''
+        Test whether 'compact_if_due' compacts and records the time of the
+        run, then skips compaction until the interval has passed.
+    '''
+
+    s3 = loaded_bucket.filesystem
+    assert len(compact_if_due(s3, 'processed', now=NOW)) == 2
+    assert loaded_bucket.read_text(COMPACTION_RUN_KEY) == NOW.isoformat()
+    assert compact_if_due(
+        s3, 'processed', now=datetime(2023, 8, 4, 12, 30)) is None
+    assert compact_if_due(
+        s3, 'processed', now=datetime(2023, 8, 4, 13)) == []
@@ -0,0 +1,17 @@
+from pipeline_common.config import config_cache, resolve_config
+from unittest.mock import Mock
+
+
+def test_resolve_config_caches_until_ttl_expires():
+    '''
+        Test whether 'resolve_config' reuses a resolved value until it is
+        older than the ttl, and then resolves it again.
+    '''
+
+    lookup = Mock(side_effect=["first", "second"])
+    assert resolve_config("name", lookup, ttl=60) == "first"
+    assert resolve_config("name", lookup, ttl=60) == "first"
+    value, resolved_at = config_cache["name"]
+    config_cache["name"] = (value, resolved_at - 61)
+    assert resolve_config("name", lookup, ttl=60) == "second"
+    assert lookup.call_count == 2
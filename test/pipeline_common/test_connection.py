@@ -0,0 +1,95 @@
+import pytest
+import pg8000.native as pg8000
+from pipeline_common.connection import ConnectionManager
+from unittest.mock import Mock
+
+
+def test_connection_manager_reuses_healthy_connection():
+    '''
+        Test whether the 'ConnectionManager' hands out the same connection on
+        repeated use rather than opening a new one each time.
+    '''
+
+    opener = Mock()
+    manager = ConnectionManager(opener)
+    with manager.lease("ingestion") as first:
+        pass
+    with manager.lease("ingestion") as second:
+        pass
+    assert first is second
+    opener.assert_called_once_with("ingestion")
+    first.run.assert_called_with("SELECT 1;")
+
+
+def test_connection_manager_keeps_one_connection_per_db():
+    '''
+        Test whether the 'ConnectionManager' caches the ingestion and the
+        warehouse connections separately.
+    '''
+
+    opener = Mock(side_effect=lambda db: Mock(name=db))
+    manager = ConnectionManager(opener)
+    ingestion = manager.get("ingestion")
+    warehouse = manager.get("warehouse")
+    assert ingestion is not warehouse
+    assert manager.get("warehouse") is warehouse
+    assert opener.call_count == 2
+
+
+def test_connection_manager_reconnects_when_health_check_fails():
+    '''
+        Test whether the 'ConnectionManager' replaces a cached connection that
+        fails its health check.
+    '''
+
+    stale, fresh = Mock(), Mock()
+    stale.run.side_effect = pg8000.InterfaceError("network error")
+    manager = ConnectionManager(Mock(side_effect=[stale, fresh]))
+    manager.get("ingestion")
+    assert manager.get("ingestion") is fresh
+    stale.close.assert_called_once()
+
+
+def test_connection_manager_reconnects_after_idle_timeout():
+    '''
+        Test whether the 'ConnectionManager' replaces a cached connection that
+        has been idle for longer than max_idle without reusing it.
+    '''
+
+    stale, fresh = Mock(), Mock()
+    manager = ConnectionManager(
+        Mock(side_effect=[stale, fresh]), max_idle=60)
+    manager.get("ingestion")
+    manager.last_used[("ingestion", 0)] -= 61
+    assert manager.get("ingestion") is fresh
+    stale.run.assert_not_called()
+    stale.close.assert_called_once()
+
+
+def test_connection_manager_discards_connection_on_error():
+    '''
+        Test whether the 'ConnectionManager' discards a connection that was in
+        use when an error was raised, so the next lease reconnects.
+    '''
+
+    broken, fresh = Mock(), Mock()
+    manager = ConnectionManager(Mock(side_effect=[broken, fresh]))
+    with pytest.raises(ValueError):
+        with manager.lease("ingestion"):
+            raise ValueError
+    broken.close.assert_called_once()
+    with manager.lease("ingestion") as conn:
+        assert conn is fresh
+
+
+def test_connection_manager_keeps_one_connection_per_worker():
+    '''
+        Test whether the 'ConnectionManager' hands each worker its own
+        connection to the same database.
+    '''
+
+    manager = ConnectionManager(Mock(side_effect=lambda db: Mock()))
+    first = manager.get("ingestion", worker=0)
+    second = manager.get("ingestion", worker=1)
+    assert first is not second
+    assert manager.get("ingestion", worker=1) is second
@@ -0,0 +1,54 @@
+import pyarrow as pa
+from pipeline_common.warehouse_schemas import (
+    WAREHOUSE_SCHEMAS,
+    conform_to_schema,
+)
+
+
+def test_conform_to_schema_casts_and_orders_columns():
+    """ Test whether 'conform_to_schema' casts each column to the table's
+        schema type, in the schema's order, dropping the unnamed index column
+        and any column the schema does not have.
+    """
+    table = pa.table({
+        '': [0, 1],
+        'currency_name': ['Pound sterling', None],
+        'currency_code': ['GBP', 'USD'],
+        'currency_id': pa.array([1, 2], pa.int64()),
+        'extra': ['x', 'y'],
+    })
+    output = conform_to_schema(table, 'dim_currency')
+    assert output.schema.equals(WAREHOUSE_SCHEMAS['dim_currency'])
+    assert output.to_pylist() == [
+        {'currency_id': 1, 'currency_code': 'GBP',
+         'currency_name': 'Pound sterling'},
+        {'currency_id': 2, 'currency_code': 'USD', 'currency_name': None},
+    ]
+
+
+def test_conform_to_schema_skips_missing_columns():
+    """ Test whether 'conform_to_schema' leaves out schema columns the table
+        does not have rather than failing.
+    """
+    table = pa.table({'currency_id': [1], 'currency_code': ['GBP']})
+    output = conform_to_schema(table, 'dim_currency')
+    assert output.column_names == ['currency_id', 'currency_code']
+    assert output.schema.field('currency_id').type == pa.int32()
+
+
+def test_conform_to_schema_keeps_columns_that_cannot_be_cast():
+    """ Test whether 'conform_to_schema' keeps the type of a column whose
+        values cannot be cast to the schema type.
+    """
+    table = pa.table({'currency_id': ['one'], 'currency_code': ['GBP']})
+    output = conform_to_schema(table, 'dim_currency')
+    assert output.schema.field('currency_id').type == pa.string()
+    assert output.column('currency_id').to_pylist() == ['one']
+
+
+def test_conform_to_schema_leaves_unknown_tables_alone():
+    """ Test whether 'conform_to_schema' returns tables that have no schema
+        as they are.
+    """
+    table = pa.table({'': [0], 'value': [1]})
+    assert conform_to_schema(table, 'unknown') is table
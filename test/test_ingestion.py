@@ -2,6 +2,7 @@ import pytest
 import src.lambda_ingestion.ingestion_lambda as i
 from moto import mock_secretsmanager, mock_s3
 import boto3
+from unittest.mock import Mock, patch
 
 
 @mock_s3
@@ -103,15 +104,71 @@ def test_get_credentials_returns_dict():
     assert isinstance(credentials, dict)
 
 
-def test_csv_builder():
+def test_s3_multipart_writer_uploads_in_parts():
     '''
-        Test the functionality of the 'CsvBuilder' class for building CSV
-        content to ensure that it correctly builds and stores CSV content
-        as expected.
+        Test whether the 'S3MultipartWriter' sends a part each time part_size
+        bytes have been buffered and completes the upload with every part.
     '''
 
-    builder = i.CsvBuilder()
-    builder.write('first\n')
-    builder.write('second\n')
-    builder.write('third\n')
-    assert builder.as_txt() == 'first\nsecond\nthird\n'
+    s3_client = Mock()
+    s3_client.create_multipart_upload.return_value = {'UploadId': 'id'}
+    s3_client.upload_part.side_effect = [{'ETag': '1'}, {'ETag': '2'}]
+    with i.S3MultipartWriter(s3_client, 'test', 'key', part_size=4) as writer:
+        writer.write('abcde')
+        writer.write(b'f')
+    bodies = [call.kwargs['Body']
+              for call in s3_client.upload_part.call_args_list]
+    assert bodies == [b'abcde', b'f']
+    s3_client.complete_multipart_upload.assert_called_once_with(
+        Bucket='test', Key='key', UploadId='id',
+        MultipartUpload={'Parts': [
+            {'ETag': '1', 'PartNumber': 1}, {'ETag': '2', 'PartNumber': 2}
+        ]}
+    )
+
+
+def test_s3_multipart_writer_aborts_on_error():
+    '''
+        Test whether the 'S3MultipartWriter' aborts the upload rather than
+        completing it when an error is raised while writing.
+    '''
+
+    s3_client = Mock()
+    s3_client.create_multipart_upload.return_value = {'UploadId': 'id'}
+    s3_client.upload_part.return_value = {'ETag': '1'}
+    with pytest.raises(ValueError):
+        with i.S3MultipartWriter(s3_client, 'test', 'key', part_size=1) as w:
+            w.write('a')
+            raise ValueError
+    s3_client.abort_multipart_upload.assert_called_once_with(
+        Bucket='test', Key='key', UploadId='id')
+    s3_client.complete_multipart_upload.assert_not_called()
+
+
+@mock_s3
+def test_ingestion_bucket_name_is_looked_up_once():
+    '''
+        Test whether 'get_ingestion_bucket_name' only lists the buckets once
+        across repeated calls.
+    '''
+
+    prefix = 'terrific-totes-ingestion-bucket'
+    boto3.client("s3", region_name="us-east-1").create_bucket(
+        Bucket=f'{prefix}12534562576864534')
+    with patch.object(i, 'find_ingestion_bucket_name',
+                      wraps=i.find_ingestion_bucket_name) as find:
+        assert prefix in i.get_ingestion_bucket_name()
+        assert prefix in i.get_ingestion_bucket_name()
+    find.assert_called_once()
+
+
+@patch.dict('os.environ', {'INGESTION_BUCKET': 'from-environment'})
+def test_ingestion_bucket_name_prefers_environment_variable():
+    '''
+        Test whether 'get_ingestion_bucket_name' uses INGESTION_BUCKET without
+        looking the bucket up when it is set.
+    '''
+
+    with patch.object(i, 'find_ingestion_bucket_name') as find:
+        assert i.get_ingestion_bucket_name() == 'from-environment'
+    find.assert_not_called()
@@ -0,0 +1,132 @@
+import io
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import src.lambda_loading.loading_lambda as ld
+from datetime import datetime
+from unittest.mock import patch
+from pipeline_common.compaction import COMPACTION_RUN_KEY
+
+
+@pytest.fixture
+def hive_bucket(processed_bucket, currency_parquet):
+    '''
+        Fills the processed bucket with dim_currency in the hive layout, with
+        two timestamps on the same day and one on the day before.
+    '''
+
+    for key, code in [
+            ('ingest_date=2023-08-01/2023-08-01 09:00:00.000000', 'JPY'),
+            ('ingest_date=2023-08-02/2023-08-02 09:00:00.000000', 'GBP'),
+            ('ingest_date=2023-08-02/2023-08-02 10:00:00.000000', 'EUR')]:
+        processed_bucket.client.put_object(
+            Bucket='processed', Key=f'table=dim_currency/{key}.parquet',
+            Body=currency_parquet([(1, code)]))
+    return processed_bucket
+
+
+def test_read_hive_table_reads_passed_timestamps(hive_bucket):
+    '''
+        Test whether 'read_hive_table' returns the table under each passed
+        timestamp, oldest first and conformed to its schema, skipping
+        timestamps without a file.
+    '''
+
+    output = ld.read_hive_table(
+        hive_bucket.filesystem, 'processed', 'dim_currency', [
+            '2023-08-02 10:00:00.000000/', '2023-08-02 09:00:00.000000/',
+            '2023-08-03 09:00:00.000000/'])
+    assert output == [
+        [['currency_id', 'currency_code', 'currency_name'],
+         [1, 'EUR', 'Name']],
+        [['currency_id', 'currency_code', 'currency_name'],
+         [1, 'GBP', 'Name']],
+    ]
+
+
+def test_read_hive_table_lists_only_pending_partitions(hive_bucket):
+    '''
+        Test whether 'read_hive_table' only lists the ingest_date partitions
+        of the passed timestamps rather than the whole table.
+    '''
+
+    with patch.object(ld.fs, 'FileSelector',
+                      wraps=ld.fs.FileSelector) as selector:
+        output = ld.read_hive_table(
+            hive_bucket.filesystem, 'processed', 'dim_currency',
+            ['2023-08-02 09:00:00.000000/'])
+    assert [call.args[0] for call in selector.call_args_list] == [
+        'processed/table=dim_currency/ingest_date=2023-08-02']
+    assert [list_table[1][1] for list_table in output] == ['GBP']
+
+
+def test_read_hive_table_returns_nothing_for_missing_tables(hive_bucket):
+    '''
+        Test whether 'read_hive_table' returns an empty list for a table that
+        has no partitions yet.
+    '''
+
+    assert ld.read_hive_table(
+        hive_bucket.filesystem, 'processed', 'dim_staff',
+        ['2023-08-02 09:00:00.000000/']) == []
+
+
+def sales_order_parquet(rows):
+    '''
+        Builds a fact_sales_order parquet from (sales_order_id, units_sold,
+        last_updated) tuples.
+    '''
+
+    table = pa.table({
+        'sales_order_id': [row[0] for row in rows],
+        'last_updated_date': [row[2].date() for row in rows],
+        'last_updated_time': [row[2].time() for row in rows],
+        'units_sold': [row[1] for row in rows],
+    })
+    sink = io.BytesIO()
+    pq.write_table(table, sink)
+    return sink.getvalue()
+
+
+@patch.dict('os.environ', {'LOADING_COALESCE': 'true'})
+def test_handler_coalesces_pending_timestamps(
+        processed_bucket, currency_parquet):
+    '''
+        Test whether the handler with LOADING_COALESCE inserts each table
+        once across the pending timestamps, keeping the newest version of
+        each row by last_updated, or by timestamp for tables without it, then
+        records the timestamps in cache.txt and runs compaction.
+    '''
+
+    first, second = '2023-08-02 09:00:00.000000', '2023-08-02 10:00:00.000000'
+    for key, body in [
+            (f'{first}/dim_currency.parquet',
+             currency_parquet([(1, 'GBP'), (2, 'USD')])),
+            (f'{second}/dim_currency.parquet', currency_parquet([(1, 'EUR')])),
+            (f'{first}/fact_sales_order.parquet', sales_order_parquet([
+                (1, 10, datetime(2023, 8, 2, 8, 30)),
+                (2, 20, datetime(2023, 8, 2, 8, 0))])),
+            (f'{second}/fact_sales_order.parquet', sales_order_parquet([
+                (1, 11, datetime(2023, 8, 2, 8, 0)),
+                (2, 21, datetime(2023, 8, 2, 9, 30))])),
+            ('cache.txt', '')]:
+        processed_bucket.client.put_object(
+            Bucket='processed', Key=key, Body=body)
+    with patch.object(ld.boto3, 'client',
+                      return_value=processed_bucket.client), \
+            patch.object(ld, 'connect') as connect, \
+            patch.object(ld, 'insert_rows') as insert_rows:
+        connect.return_value.__enter__.return_value.run.return_value = [[1]]
+        ld.loading_lambda_handler({}, None)
+
+    inserted = {call.args[0]: call.args[1:] for call in
+                insert_rows.call_args_list}
+    assert insert_rows.call_count == 2
+    assert inserted['dim_currency'][1] == [[1, 'EUR', 'Name'],
+                                           [2, 'USD', 'Name']]
+    headers, rows = inserted['fact_sales_order']
+    units_sold = {row[0]: row[headers.index('units_sold')] for row in rows}
+    assert units_sold == {1: 10, 2: 21}
+    assert processed_bucket.read_text('cache.txt').split('\n') == [
+        f'{first}/', f'{second}/']
+    assert COMPACTION_RUN_KEY in processed_bucket.keys()
@@ -0,0 +1,226 @@
+import json
+import os
+import boto3
+import pytest
+import pg8000.native as pg8000
+from moto import mock_s3
+from unittest.mock import Mock, patch
+from src.lambda_ingestion.ingestion_lambda import (
+    REPLICATION_DELETES_KEY,
+    collect_changes,
+    get_replication_checkpoint,
+    lsn_to_int,
+    peek_transactions,
+    replicate_changes_to_s3,
+)
+
+
+def change(action, table, **values):
+    """ Builds a wal2json format-version 2 change for the passed values."""
+    columns = [{'name': name, 'type': 'text', 'value': value}
+               for name, value in values.items()]
+    if action == 'D':
+        return {'action': 'D', 'table': table, 'identity': columns[:1]}
+    return {'action': action, 'table': table, 'columns': columns}
+
+
+def slot_rows(transactions):
+    """ Builds the rows pg_logical_slot_peek_changes returns for the passed
+        list of (commit_lsn, changes) tuples."""
+    rows = []
+    for commit_lsn, changes in transactions:
+        rows.append([commit_lsn, json.dumps({'action': 'B'})])
+        rows.extend([commit_lsn, json.dumps(item)] for item in changes)
+        rows.append([commit_lsn, json.dumps({'action': 'C'})])
+    return rows
+
+
+def test_lsn_to_int_orders_log_sequence_numbers():
+    '''
+        Test whether 'lsn_to_int' orders log sequence numbers by both halves.
+    '''
+
+    assert lsn_to_int('0/16B3748') == 0x16B3748
+    assert lsn_to_int('1/0') > lsn_to_int('0/FFFFFFFF')
+
+
+def test_collect_changes_keeps_latest_version_of_each_row():
+    '''
+        Test whether 'collect_changes' keeps only the latest version of a row
+        changed several times, and moves rows between upserts and deletes.
+    '''
+
+    transactions = [
+        ('0/10', [
+            change('I', 'currency', currency_id=1, currency_code='GBP'),
+            change('I', 'currency', currency_id=2, currency_code='USD'),
+        ]),
+        ('0/20', [
+            change('U', 'currency', currency_id=1, currency_code='EUR'),
+            change('D', 'currency', currency_id=2),
+        ]),
+    ]
+    upserts, deletes, truncated = collect_changes(transactions)
+    assert upserts == {
+        'currency': {1: {'currency_id': 1, 'currency_code': 'EUR'}}
+    }
+    assert deletes == {'currency': {2: {'currency_id': 2}}}
+    assert truncated == {}
+
+
+def test_collect_changes_skips_transactions_up_to_checkpoint():
+    '''
+        Test whether 'collect_changes' skips whole transactions committed at
+        or before the checkpoint.
+    '''
+
+    transactions = [
+        ('0/10', [change('I', 'design', design_id=1, design_name='a')]),
+        ('0/20', [change('I', 'design', design_id=2, design_name='b')]),
+    ]
+    upserts, deletes, truncated = collect_changes(
+        transactions, checkpoint='0/10')
+    assert list(upserts['design']) == [2]
+    assert deletes == {}
+
+
+def test_peek_transactions_groups_changes_by_commit():
+    '''
+        Test whether 'peek_transactions' groups the changes read from the slot
+        into transactions keyed by their commit lsn.
+    '''
+
+    transactions = [
+        ('0/10', [change('I', 'design', design_id=1, design_name='a')]),
+        ('0/20', [change('D', 'design', design_id=1)]),
+    ]
+    mock_db = Mock()
+    mock_db.run.side_effect = [[[1]], slot_rows(transactions)]
+    assert peek_transactions(mock_db, 'slot', ['design'], 10) == transactions
+
+
+@mock_s3
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_replicate_changes_writes_tables_and_checkpoint(mock_connection):
+    '''
+        Test whether 'replicate_changes_to_s3' writes the changed rows of each
+        table under one timestamp prefix, then records the checkpoint and
+        advances the slot to the last commit.
+    '''
+
+    transactions = [
+        ('0/10', [
+            change('I', 'currency', currency_id=1, currency_code='GBP'),
+            change('U', 'design', design_id=7, design_name='a'),
+        ]),
+    ]
+    mock_db = Mock()
+    mock_connection.return_value.__enter__.return_value = mock_db
+    mock_db.run.side_effect = [[[1]], slot_rows(transactions), []]
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    written = replicate_changes_to_s3('test', ['currency', 'design'])
+    assert [key.split('/')[1] for key in written] == [
+        'currency.csv', 'design.csv'
+    ]
+    assert len({key.split('/')[0] for key in written}) == 1
+    body = s3_client.get_object(Bucket='test', Key=written[0])['Body']
+    assert body.read().decode().splitlines() == [
+        'currency_id,currency_code', '1,GBP'
+    ]
+    assert get_replication_checkpoint('test') == '0/10'
+    advance = mock_db.run.call_args_list[-1]
+    assert 'pg_replication_slot_advance' in advance.args[0]
+    assert advance.kwargs['lsn'] == '0/10'
+
+
+def test_collect_changes_records_truncates():
+    '''
+        Test whether 'collect_changes' records the commit lsn of a truncated
+        table, dropping its earlier changes but keeping the rows inserted
+        after the truncate.
+    '''
+
+    transactions = [
+        ('0/10', [change('I', 'design', design_id=1, design_name='a')]),
+        ('0/20', [{'action': 'T', 'table': 'design'}]),
+        ('0/30', [change('I', 'design', design_id=2, design_name='b')]),
+    ]
+    upserts, deletes, truncated = collect_changes(transactions)
+    assert list(upserts['design']) == [2]
+    assert truncated == {'design': '0/20'}
+
+
+@mock_s3
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_replicate_changes_records_deleted_rows(mock_connection, caplog):
+    '''
+        Test whether 'replicate_changes_to_s3' still writes the upserts and
+        advances the slot when rows were deleted or a table truncated,
+        recording them in REPLICATION_DELETES_KEY and logging the error the
+        alarm is raised on.
+    '''
+
+    transactions = [
+        ('0/10', [
+            change('I', 'currency', currency_id=1, currency_code='GBP'),
+            change('D', 'design', design_id=7),
+        ]),
+        ('0/20', [{'action': 'T', 'table': 'staff'}]),
+    ]
+    mock_db = Mock()
+    mock_connection.return_value.__enter__.return_value = mock_db
+    mock_db.run.side_effect = [[[1]], slot_rows(transactions), []]
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    written = replicate_changes_to_s3('test', ['currency', 'design', 'staff'])
+    assert [key.split('/')[1] for key in written] == ['currency.csv']
+    records = json.loads(s3_client.get_object(
+        Bucket='test', Key=REPLICATION_DELETES_KEY)['Body'].read())
+    assert records == [{
+        'lsn': '0/20', 'deleted': {'design': [7]}, 'truncated': ['staff'],
+    }]
+    assert 'Unreplicated Delete Error: 1 deleted from design' in caplog.text
+    assert get_replication_checkpoint('test') == '0/20'
+    assert 'pg_replication_slot_advance' in mock_db.run.call_args.args[0]
+
+
+@pytest.mark.skipif(
+    'CDC_TEST_HOST' not in os.environ,
+    reason="Needs a postgres with wal_level=logical and wal2json, set "
+           "CDC_TEST_HOST, CDC_TEST_PORT, CDC_TEST_USER, CDC_TEST_PASSWORD "
+           "and CDC_TEST_DB to run."
+)
+def test_peek_transactions_against_local_postgres():
+    '''
+        Test whether 'peek_transactions' and 'collect_changes' decode real
+        inserts, updates and deletes from a local postgres.
+    '''
+
+    db = pg8000.Connection(
+        host=os.environ['CDC_TEST_HOST'],
+        port=int(os.environ.get('CDC_TEST_PORT', 5432)),
+        user=os.environ['CDC_TEST_USER'],
+        password=os.environ['CDC_TEST_PASSWORD'],
+        database=os.environ['CDC_TEST_DB'],
+    )
+    slot = 'cdc_test_slot'
+    try:
+        db.run('DROP TABLE IF EXISTS cdc_test;')
+        db.run('CREATE TABLE cdc_test (cdc_test_id int PRIMARY KEY, '
+               'name text, last_updated timestamp DEFAULT now());')
+        assert peek_transactions(db, slot, ['cdc_test'], 100) == []
+        db.run("INSERT INTO cdc_test (cdc_test_id, name) "
+               "VALUES (1, 'a'), (2, 'b');")
+        db.run("UPDATE cdc_test SET name = 'c' WHERE cdc_test_id = 1;")
+        db.run('DELETE FROM cdc_test WHERE cdc_test_id = 2;')
+        transactions = peek_transactions(db, slot, ['cdc_test'], 100)
+        assert len(transactions) == 3
+        upserts, deletes, truncated = collect_changes(transactions)
+        assert upserts['cdc_test'][1]['name'] == 'c'
+        assert list(deletes['cdc_test']) == [2]
+    finally:
+        db.run('SELECT pg_drop_replication_slot(slot_name) FROM '
+               'pg_replication_slots WHERE slot_name = :slot;', slot=slot)
+        db.run('DROP TABLE IF EXISTS cdc_test;')
+        db.close()
@@ -1,14 +1,32 @@
 from datetime import datetime as dt
+from datetime import timedelta
 import boto3
 import pytest
 from moto import mock_s3
 from src.lambda_ingestion.ingestion_lambda import (
     get_last_ingestion_timestamp,
-    extract_table_to_csv,
-    csv_to_s3,
-    NonTimestampedCSVError
+    get_watermarks,
+    update_watermarks,
+    extract_tables_to_s3,
+    stream_table_to_s3,
+    query_table_to_s3,
+    copy_table_to_s3,
+    incremental_query,
+    changed_tables,
+    plan_backfill,
+    backfill_tables_to_s3,
+    get_backfill_checkpoint,
+    ingestion_lambda_handler,
+    NonTimestampedCSVError,
+    TableIngestionError
 )
+from decimal import Decimal
 from unittest.mock import Mock, patch
+import gzip
+import io
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pg8000.native import DatabaseError
 
 # Function returning a sample csv string for testing
 current_timestamp = dt.now().isoformat()
@@ -89,10 +107,9 @@ def test_gets_most_recent_timestamp_from_all_file_names():
 @mock_s3
 def test_raises_NonTimeStampedCSVError_when_file_without_timestamp_exists():
     '''
-        Test whether the function 'extract_table_to_csv' correctly
-        concatenates the query result to a CSV string, to verify that
-        the function correctly concatenates the query result to a CSV
-        string when extracting data from a table.
+        Test whether the function 'get_last_ingestion_timestamp' raises a
+        NonTimestampedCSVError when there is a csv outside a timestamp
+        prefix.
     '''
 
     # Create s3 bucket
@@ -108,82 +125,124 @@ def test_raises_NonTimeStampedCSVError_when_file_without_timestamp_exists():
         get_last_ingestion_timestamp("test")
 
 
-@patch('src.lambda_ingestion.ingestion_lambda.connect')
-def test_extract_table_to_csv_concats_query_result_to_csv(mock_connection):
+@mock_s3
+def test_skips_manifest_and_checkpoints_at_top_of_bucket():
+    '''
+        Test whether 'get_last_ingestion_timestamp' ignores the json objects
+        ingestion keeps at the top of the bucket, such as the backfill
+        checkpoint, which sort after the timestamp prefixes.
+    '''
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket="test")
+    timestamp = dt(2023, 1, 1).isoformat()
+    s3_client.put_object(Body="", Bucket="test", Key=f'{timestamp}/a.csv')
+    for key in ['backfill_checkpoint.json', 'replication_checkpoint.json']:
+        s3_client.put_object(Body="{}", Bucket="test", Key=key)
+    assert get_last_ingestion_timestamp("test") == dt(2023, 1, 1)
+
+
+@mock_s3
+def test_reads_timestamps_beyond_first_page_of_listing():
     '''
-        Test whether the function 'extract_table_to_csv' returns an
-        empty dictionary when there is no return from the SQL query,
-        to verify that the function handles cases where there is
-        no return from the SQL query by returning an empty dictionary.
+        Test whether 'get_last_ingestion_timestamp' pages through listings
+        of more than 1000 prefixes.
     '''
 
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket="test")
+    for minutes in range(1005):
+        timestamp = (dt(2023, 1, 1) + timedelta(minutes=minutes)).isoformat()
+        s3_client.put_object(
+            Body="", Bucket="test", Key=f'{timestamp}/a.csv')
+    assert get_last_ingestion_timestamp("test") == \
+        dt(2023, 1, 1) + timedelta(minutes=1004)
+
+
+def mock_query_db(rows):
+    """ Returns a fake db whose incremental query returns the passed rows of
+        a transaction table."""
     mock_db = Mock()
-    mock_connection.return_value.__enter__.return_value = mock_db
-    mock_db.run.return_value = [
+    mock_db.run.return_value = rows
+    mock_db.columns = [{'name': "transaction_id"}, {
+        'name': "transaction_type"}, {'name': "last_updated"}]
+    return mock_db
+
+
+@mock_s3
+def test_query_engine_writes_query_result_to_csv():
+    '''
+        Test whether 'query_table_to_s3' writes the query result, headed by
+        its column names, as a csv to the passed key and returns the most
+        recent last_updated value written.
+    '''
+
+    mock_db = mock_query_db([
         ["434", "SALE", current_timestamp],
         ["435", "PURCHASE", current_timestamp],
         ["436", "SALE", current_timestamp],
         ["437", "PURCHASE", current_timestamp],
-    ]
-    mock_db.columns = [{'name': "transaction_id"}, {
-        'name': "transaction_type"}, {'name': "last_updated"}]
-    res = extract_table_to_csv(["test_table"], dt(1970, 1, 1))
-    expected = "transaction_id,transaction_type,last_updated\r\n"
-    expected += f"434,SALE,{current_timestamp}\r\n"
-    expected += f"435,PURCHASE,{current_timestamp}\r\n"
-    expected += f"436,SALE,{current_timestamp}\r\n"
-    expected += f"437,PURCHASE,{current_timestamp}\r\n"
-    assert list(res.keys()) == ["test_table"]
-    assert res["test_table"] == expected
+    ])
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    latest = query_table_to_s3(
+        mock_db, s3_client, 'test', 'stamp/fake.csv', 'fake', dt(1970, 1, 1))
+    assert latest == current_timestamp
+    body = s3_client.get_object(Bucket='test', Key='stamp/fake.csv')['Body']
+    assert body.read().decode() == generate_csv_string()
 
 
 @mock_s3
-@patch('src.lambda_ingestion.ingestion_lambda.connect')
-def test_return_empty_dict_when_no_return_from_SQL(mock_connection):
+def test_query_engine_writes_nothing_when_no_return_from_SQL():
     '''
-        Test whether the function 'extract_table_to_csv' returns an empty
-        dictionary when there is no return from the SQL query, to verify
-        that the function handles cases where there is no return from the
-        SQL query by returning an empty dictionary.
+        Test whether 'query_table_to_s3' returns None and leaves the bucket
+        empty when there is no return from the SQL query.
     '''
 
-    mock_db = Mock()
-    mock_connection.return_value.__enter__.return_value = mock_db
-    new_timestamp = dt.now()
-    mock_db.run.return_value = []
-    mock_db.columns = [{'name': "transaction_id"}, {
-        'name': "transaction_type"}, {'name': "last_updated"}]
-    res = extract_table_to_csv("test_table", new_timestamp)
-    assert res == {}
+    mock_db = mock_query_db([])
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    latest = query_table_to_s3(
+        mock_db, s3_client, 'test', 'stamp/fake.csv', 'fake', dt.now())
+    assert latest is None
+    assert s3_client.list_objects_v2(Bucket="test").get('Contents') is None
 
 
 @mock_s3
-def test_adds_new_csv_to_s3_when_passed_new_data():
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_extraction_adds_new_csv_to_s3_when_there_is_new_data(
+        mock_connection):
     '''
-        Test whether the function 'csv_to_s3' adds a new CSV to the S3
-        bucket when new data is provided.
+        Test whether 'extract_tables_to_s3' adds a new csv of a table's new
+        data to the S3 bucket under a timestamp prefix.
     '''
 
-    fake_csv = generate_csv_string()
+    mock_connection.return_value.__enter__.return_value = mock_query_db([
+        ["434", "SALE", current_timestamp],
+        ["435", "PURCHASE", current_timestamp],
+        ["436", "SALE", current_timestamp],
+        ["437", "PURCHASE", current_timestamp],
+    ])
     s3_client = boto3.client('s3', region_name='us-east-1')
     s3_client.create_bucket(Bucket='test')
-    csv_to_s3('test', {"fake": fake_csv})
-    res = s3_client.list_objects_v2(Bucket="test")
-    object_list = [obj['Key'] for obj in res['Contents']]
-    new_csv = "/fake.csv"
-    present = False
-    for item in object_list:
-        if new_csv in item:
-            present = True
-            new_csv = item
-    assert present
-    new_csv_contents = s3_client.get_object(Bucket="test", Key=new_csv)['Body']
-    new_csv_contents = new_csv_contents.read().decode()
-    assert new_csv_contents == fake_csv
+    written = extract_tables_to_s3('test', ["fake"], {"fake": dt(1970, 1, 1)})
+    key = written["fake"]["Key"]
+    assert key.endswith("/fake.csv")
+    assert isinstance(dt.fromisoformat(key.split("/")[0]), dt)
+    body = s3_client.get_object(Bucket="test", Key=key)['Body']
+    assert body.read().decode() == generate_csv_string()
 
 
 @mock_s3
-def test_does_not_add_new_csv_when_not_passed_new_data():
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_extraction_does_not_add_new_csv_when_there_is_no_new_data(
+        mock_connection):
+    '''
+        Test whether 'extract_tables_to_s3' writes nothing and returns an
+        empty dict when no table has new data.
+    '''
+
+    mock_connection.return_value.__enter__.return_value = mock_query_db([])
     old_timestamp = dt(1970, 1, 1).isoformat()
     s3_client = boto3.client('s3', region_name='us-east-1')
     s3_client.create_bucket(Bucket='test')
@@ -193,7 +252,607 @@ def test_does_not_add_new_csv_when_not_passed_new_data():
         Key=f'{old_timestamp}/fake.csv',
         ContentType='application/text',
     )
-    csv_to_s3('test', {})
+    written = extract_tables_to_s3('test', ["fake"], {"fake": dt.now()})
+    assert written == {}
     res = s3_client.list_objects_v2(Bucket="test")
     object_list = [obj['Key'] for obj in res.get('Contents')]
     assert object_list == [f'{old_timestamp}/fake.csv']
+
+
+def mock_table_queries(mock_connection, failing_table=None):
+    """ Points the patched connect at a fake db that returns one row for any
+        table, raising instead if the query is for failing_table."""
+    def run(query_str):
+        if failing_table and f'FROM {failing_table} ' in query_str:
+            raise Exception("query failed")
+        return [["434", "SALE", current_timestamp]]
+
+    mock_db = Mock()
+    mock_connection.return_value.__enter__.return_value = mock_db
+    mock_db.run.side_effect = run
+    mock_db.columns = [{'name': "transaction_id"}, {
+        'name': "transaction_type"}, {'name': "last_updated"}]
+
+
+@mock_s3
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_concurrent_extraction_writes_one_timestamp_prefix(mock_connection):
+    '''
+        Test whether 'extract_tables_to_s3' writes a csv for
+        every table under a single shared timestamp prefix.
+    '''
+
+    mock_table_queries(mock_connection)
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    tables = ["address", "currency", "design", "staff"]
+    watermarks = {table: dt(1970, 1, 1) for table in tables}
+    written = extract_tables_to_s3('test', tables, watermarks, 3)
+    res = s3_client.list_objects_v2(Bucket="test")
+    object_list = sorted(obj['Key'] for obj in res['Contents'])
+    assert sorted(item['Key'] for item in written.values()) == object_list
+    assert sorted(written.keys()) == tables
+    assert len({key.split("/")[0] for key in object_list}) == 1
+    workers = {call.kwargs['worker'] for call in mock_connection.mock_calls
+               if call[0] == ''}
+    assert workers <= {0, 1, 2}
+
+
+@mock_s3
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_concurrent_extraction_removes_partial_run_on_failure(
+        mock_connection):
+    '''
+        Test whether 'extract_tables_to_s3' raises a
+        TableIngestionError and leaves nothing in the bucket when one of the
+        tables fails.
+    '''
+
+    mock_table_queries(mock_connection, failing_table="design")
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    tables = ["address", "currency", "design", "staff"]
+    watermarks = {table: dt(1970, 1, 1) for table in tables}
+    with pytest.raises(TableIngestionError):
+        extract_tables_to_s3('test', tables, watermarks, 2)
+    res = s3_client.list_objects_v2(Bucket="test")
+    assert res.get('Contents') is None
+
+
+@mock_s3
+def test_stream_engine_writes_every_chunk_to_one_csv():
+    '''
+        Test whether 'stream_table_to_s3' fetches rows in chunks from a
+        cursor and writes them all, with a single header, to one csv.
+    '''
+
+    chunks = [
+        [["434", "SALE", current_timestamp], ["435", "PURCHASE",
+                                              current_timestamp]],
+        [["436", "SALE", current_timestamp], ["437", "PURCHASE",
+                                              current_timestamp]],
+        [],
+    ]
+
+    def run(query_str):
+        if query_str.startswith("FETCH"):
+            return chunks.pop(0)
+        return []
+
+    mock_db = Mock()
+    mock_db.run.side_effect = run
+    mock_db.columns = [{'name': "transaction_id"}, {
+        'name': "transaction_type"}, {'name': "last_updated"}]
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    written = stream_table_to_s3(
+        mock_db, s3_client, 'test', 'stamp/fake.csv', 'fake',
+        dt(1970, 1, 1), chunk_size=2)
+    assert written
+    body = s3_client.get_object(Bucket='test', Key='stamp/fake.csv')['Body']
+    assert body.read().decode() == generate_csv_string()
+    queries = [call.args[0] for call in mock_db.run.call_args_list]
+    assert queries[-1] == 'COMMIT;'
+    assert queries.count('FETCH FORWARD 2 FROM ingestion_cursor;') == 3
+
+
+@mock_s3
+def test_stream_engine_writes_nothing_when_no_new_data():
+    '''
+        Test whether 'stream_table_to_s3' leaves the bucket empty and returns
+        False when the cursor has no rows.
+    '''
+
+    mock_db = Mock()
+    mock_db.run.return_value = []
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    written = stream_table_to_s3(
+        mock_db, s3_client, 'test', 'stamp/fake.csv', 'fake', dt(1970, 1, 1))
+    assert not written
+    assert s3_client.list_objects_v2(Bucket="test").get('Contents') is None
+
+
+@mock_s3
+def test_watermarks_fall_back_to_timestamp_prefix_without_manifest():
+    '''
+        Test whether 'get_watermarks' gives every table the most recent
+        timestamp prefix in the bucket when there is no manifest yet.
+    '''
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket="test")
+    timestamp = dt(1980, 3, 1)
+    s3_client.put_object(
+        Body="", Bucket="test", Key=f'{timestamp.isoformat()}/address.csv')
+    output = get_watermarks("test", ["address", "staff"])
+    assert output == {"address": timestamp, "staff": timestamp}
+
+
+@mock_s3
+def test_watermarks_round_trip_through_manifest():
+    '''
+        Test whether 'update_watermarks' advances only the tables that had
+        new data, and 'get_watermarks' reads them back per table, defaulting
+        to 1st Jan 1970 for tables the manifest does not know about.
+    '''
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket="test")
+    start = {"address": dt(1980, 1, 1), "staff": dt(1980, 1, 1)}
+    written = {"staff": {
+        "Key": "stamp/staff.csv", "LastUpdated": dt(1990, 5, 6, 7, 8, 9)
+    }}
+    update_watermarks("test", start, written)
+    output = get_watermarks("test", ["address", "staff", "design"])
+    assert output == {
+        "address": dt(1980, 1, 1),
+        "staff": dt(1990, 5, 6, 7, 8, 9),
+        "design": dt(1970, 1, 1),
+    }
+    res = s3_client.list_objects_v2(Bucket="test")
+    assert [obj['Key'] for obj in res['Contents']] == ['watermarks.json']
+
+
+@mock_s3
+def test_parquet_output_is_typed_from_column_oids():
+    '''
+        Test whether 'query_table_to_s3' writes parquet typed from the
+        postgres column types when asked for the parquet format.
+    '''
+
+    updated = dt(2023, 8, 2, 9, 10, 9, 786000)
+    mock_db = Mock()
+    mock_db.run.return_value = [
+        [3539, Decimal("3.25"), "2023-08-06", updated],
+        [3540, None, None, updated],
+    ]
+    mock_db.columns = [
+        {'name': "sales_order_id", 'type_oid': 23, 'type_modifier': -1},
+        {'name': "unit_price", 'type_oid': 1700,
+         'type_modifier': (10 << 16 | 2) + 4},
+        {'name': "agreed_payment_date", 'type_oid': 1043,
+         'type_modifier': -1},
+        {'name': "last_updated", 'type_oid': 1114, 'type_modifier': -1},
+    ]
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    latest = query_table_to_s3(
+        mock_db, s3_client, 'test', 'stamp/sales_order.parquet',
+        'sales_order', dt(1970, 1, 1), 'parquet')
+    assert latest == updated
+    body = s3_client.get_object(
+        Bucket='test', Key='stamp/sales_order.parquet')['Body'].read()
+    table = pq.read_table(io.BytesIO(body))
+    assert table.schema.types == [
+        pa.int32(), pa.decimal128(10, 2), pa.string(), pa.timestamp('us')
+    ]
+    assert table.column('unit_price').to_pylist() == [Decimal("3.25"), None]
+
+
+def mock_copy_db(copied_csv, row_count, latest=None):
+    """ Returns a fake db that writes copied_csv to the stream of a COPY
+        query and returns latest from a max query."""
+    mock_db = Mock()
+
+    def run(query_str, stream=None):
+        if query_str.startswith("COPY"):
+            stream.write(copied_csv.encode())
+            mock_db.row_count = row_count
+        elif query_str.startswith("SELECT max"):
+            return [[latest]]
+        return []
+
+    mock_db.run.side_effect = run
+    return mock_db
+
+
+@mock_s3
+def test_copy_engine_pipes_server_csv_to_s3():
+    '''
+        Test whether 'copy_table_to_s3' writes the csv produced by COPY to
+        the bucket unchanged and returns the high-water mark from the same
+        transaction.
+    '''
+
+    latest = dt(2023, 8, 2, 9, 10, 9)
+    mock_db = mock_copy_db(generate_csv_string(), 4, latest)
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    output = copy_table_to_s3(
+        mock_db, s3_client, 'test', 'stamp/fake.csv', 'fake', dt(1970, 1, 1))
+    assert output == latest
+    body = s3_client.get_object(Bucket='test', Key='stamp/fake.csv')['Body']
+    assert body.read().decode() == generate_csv_string()
+    queries = [call.args[0] for call in mock_db.run.call_args_list]
+    assert 'REPEATABLE READ' in queries[0]
+    assert queries[-1] == 'COMMIT;'
+
+
+@mock_s3
+def test_copy_engine_writes_nothing_when_no_rows_copied():
+    '''
+        Test whether 'copy_table_to_s3' discards the header-only output and
+        returns None when COPY returns no rows.
+    '''
+
+    mock_db = mock_copy_db("transaction_id,last_updated\n", 0)
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    output = copy_table_to_s3(
+        mock_db, s3_client, 'test', 'stamp/fake.csv', 'fake', dt(1970, 1, 1))
+    assert output is None
+    assert s3_client.list_objects_v2(Bucket="test").get('Contents') is None
+
+
+@mock_s3
+@patch('src.lambda_ingestion.ingestion_lambda.query_table_to_s3')
+def test_copy_engine_falls_back_to_query_engine(mock_query_engine):
+    '''
+        Test whether 'copy_table_to_s3' hands the table to the query engine
+        when the database refuses the COPY.
+    '''
+
+    def run(query_str, stream=None):
+        if query_str.startswith("COPY"):
+            raise DatabaseError("permission denied")
+        return []
+
+    mock_db = Mock()
+    mock_db.run.side_effect = run
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    output = copy_table_to_s3(
+        mock_db, s3_client, 'test', 'stamp/fake.csv', 'fake', dt(1970, 1, 1))
+    assert output == mock_query_engine.return_value
+    mock_query_engine.assert_called_once()
+    assert s3_client.list_objects_v2(Bucket="test").get('Contents') is None
+
+
+@mock_s3
+def test_query_engine_compresses_csv_with_codec():
+    '''
+        Test whether 'query_table_to_s3' gzips the csv and records the codec
+        in the object metadata when passed a codec.
+    '''
+
+    mock_db = Mock()
+    mock_db.run.return_value = [["434", "SALE", current_timestamp]]
+    mock_db.columns = [{'name': "transaction_id"}, {
+        'name': "transaction_type"}, {'name': "last_updated"}]
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    query_table_to_s3(mock_db, s3_client, 'test', 'stamp/fake.csv.gz',
+                      'fake', dt(1970, 1, 1), 'csv', 'gzip')
+    response = s3_client.get_object(Bucket='test', Key='stamp/fake.csv.gz')
+    assert response['Metadata'] == {'codec': 'gzip'}
+    text = gzip.decompress(response['Body'].read()).decode()
+    assert text.splitlines()[1] == f"434,SALE,{current_timestamp}"
+
+
+@mock_s3
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_compressed_tables_get_codec_suffix(mock_connection):
+    '''
+        Test whether 'extract_tables_to_s3' adds the codec suffix to the keys
+        of compressed csvs, and whether the streamed zstd objects decompress
+        back to the csv.
+    '''
+
+    mock_table_queries(mock_connection)
+    mock_connection.return_value.__enter__.return_value.run.side_effect = [
+        [], [], [["434", "SALE", current_timestamp]], [], [], []]
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    written = extract_tables_to_s3(
+        'test', ["fake"], {"fake": dt(1970, 1, 1)}, engine='stream',
+        codec='zstd')
+    key = written["fake"]["Key"]
+    assert key.endswith("/fake.csv.zst")
+    response = s3_client.get_object(Bucket='test', Key=key)
+    assert response['Metadata'] == {'codec': 'zstd'}
+    stream = pa.CompressedInputStream(
+        pa.BufferReader(response['Body'].read()), 'zstd')
+    assert stream.read().decode().splitlines()[1] == (
+        f"434,SALE,{current_timestamp}")
+
+
+@mock_s3
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_codec_is_ignored_for_parquet(mock_connection):
+    '''
+        Test whether 'extract_tables_to_s3' leaves parquet, which compresses
+        itself, without a codec suffix.
+    '''
+
+    mock_table_queries(mock_connection)
+    for column in mock_connection.return_value.__enter__.return_value.columns:
+        column.update({'type_oid': 25, 'type_modifier': -1})
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    written = extract_tables_to_s3(
+        'test', ["fake"], {"fake": dt(1970, 1, 1)}, output_format='parquet',
+        codec='gzip')
+    assert written["fake"]["Key"].endswith("/fake.parquet")
+
+
+def test_incremental_query_selects_only_consumed_columns():
+    '''
+        Test whether 'incremental_query' selects only the columns the
+        transformation utils consume, plus last_updated, for known tables and
+        every column for unknown tables.
+    '''
+
+    output = incremental_query("currency", dt(1970, 1, 1))
+    assert output == (
+        "SELECT currency_id, currency_code, last_updated FROM currency "
+        "WHERE last_updated > '1970-01-01T00:00:00'"
+    )
+    output = incremental_query("test_table", dt(1970, 1, 1))
+    assert output.startswith("SELECT * FROM test_table WHERE")
+
+
+@patch.dict('os.environ', {'INGESTION_FULL_TABLES': 'design,currency'})
+def test_incremental_query_extracts_full_tables_when_overridden():
+    '''
+        Test whether tables named in INGESTION_FULL_TABLES are extracted with
+        every column, while other tables stay projected.
+    '''
+
+    assert incremental_query("currency", dt(1970, 1, 1)).startswith(
+        "SELECT * FROM currency")
+    assert incremental_query("staff", dt(1970, 1, 1)).startswith(
+        "SELECT staff_id, ")
+
+
+@patch.dict('os.environ', {'INGESTION_FULL_TABLES': '*'})
+def test_incremental_query_extracts_every_table_in_full_with_wildcard():
+    '''
+        Test whether INGESTION_FULL_TABLES set to * extracts every table with
+        every column.
+    '''
+
+    assert incremental_query("staff", dt(1970, 1, 1)).startswith(
+        "SELECT * FROM staff")
+
+
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_changed_tables_skips_tables_not_updated_since_watermark(
+        mock_connection):
+    '''
+        Test whether 'changed_tables' checks every table in one query and
+        returns only those updated since their watermark.
+    '''
+
+    mock_db = Mock()
+    mock_connection.return_value.__enter__.return_value = mock_db
+    mock_db.run.return_value = [
+        ['currency', dt(2023, 1, 1)],
+        ['design', dt(2023, 3, 1)],
+        ['staff', None],
+    ]
+    watermarks = {
+        'currency': dt(2023, 2, 1),
+        'design': dt(2023, 2, 1),
+        'staff': dt(1970, 1, 1),
+    }
+    assert changed_tables(['currency', 'design', 'staff'], watermarks) == [
+        'design'
+    ]
+    mock_db.run.assert_called_once()
+    assert mock_db.run.call_args.args[0].count('UNION ALL') == 2
+
+
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_changed_tables_extracts_everything_when_check_fails(
+        mock_connection):
+    '''
+        Test whether 'changed_tables' falls back to every table when the
+        change detection query fails.
+    '''
+
+    mock_db = Mock()
+    mock_connection.return_value.__enter__.return_value = mock_db
+    mock_db.run.side_effect = DatabaseError('relation does not exist')
+    watermarks = {'currency': dt(2023, 2, 1), 'design': dt(2023, 2, 1)}
+    assert changed_tables(['currency', 'design'], watermarks) == [
+        'currency', 'design'
+    ]
+
+
+def test_incremental_query_bounds_range_with_until():
+    '''
+        Test whether 'incremental_query' closes the range at until when it is
+        passed.
+    '''
+
+    query_str = incremental_query(
+        'currency', dt(2023, 1, 1), until=dt(2023, 2, 1))
+    assert query_str.endswith(
+        "last_updated > '2023-01-01T00:00:00' "
+        "AND last_updated <= '2023-02-01T00:00:00'"
+    )
+
+
+def mock_backfill_db(mock_connection, oldest, newest, failing_table=None):
+    """ Points the patched connect at a fake db whose tables span oldest to
+        newest, returning one row for any range of any table and raising
+        instead if the query is for failing_table."""
+    def run(query_str):
+        if 'AS bounds' in query_str:
+            return [[oldest, newest]]
+        if failing_table and f'FROM {failing_table} ' in query_str:
+            raise Exception("query failed")
+        return [["434", "SALE", newest]]
+
+    mock_db = Mock()
+    mock_connection.return_value.__enter__.return_value = mock_db
+    mock_db.run.side_effect = run
+    mock_db.columns = [{'name': "transaction_id"}, {
+        'name': "transaction_type"}, {'name': "last_updated"}]
+    return mock_db
+
+
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_plan_backfill_splits_tables_into_ranges(mock_connection):
+    '''
+        Test whether 'plan_backfill' splits the span of last_updated values
+        into ranges of the passed width, ending at the newest value.
+    '''
+
+    mock_backfill_db(mock_connection, dt(2023, 1, 1), dt(2023, 3, 15))
+    assert plan_backfill(['currency', 'design'], 30) == [
+        dt(2023, 1, 31), dt(2023, 3, 2), dt(2023, 3, 15)
+    ]
+
+
+@mock_s3
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_backfill_writes_each_range_under_its_own_prefix(mock_connection):
+    '''
+        Test whether 'backfill_tables_to_s3' writes every range of every
+        table under a prefix named after the end of the range, then sets the
+        watermarks and removes its checkpoint.
+    '''
+
+    mock_backfill_db(mock_connection, dt(2023, 1, 1), dt(2023, 2, 15))
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    tables = ['currency', 'design']
+    assert backfill_tables_to_s3('test', tables, 2) is True
+    res = s3_client.list_objects_v2(Bucket="test")
+    object_list = sorted(obj['Key'] for obj in res['Contents'])
+    assert object_list == [
+        '2023-01-31T00:00:00.000000/currency.csv',
+        '2023-01-31T00:00:00.000000/design.csv',
+        '2023-02-15T00:00:00.000000/currency.csv',
+        '2023-02-15T00:00:00.000000/design.csv',
+        'watermarks.json',
+    ]
+    assert get_backfill_checkpoint('test') is None
+    assert get_watermarks('test', tables) == {
+        'currency': dt(2023, 2, 15), 'design': dt(2023, 2, 15)
+    }
+
+
+@mock_s3
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_backfill_resumes_from_checkpoint(mock_connection):
+    '''
+        Test whether 'backfill_tables_to_s3' checkpoints the ranges written
+        before a failure and only extracts the remaining ranges when it is
+        run again.
+    '''
+
+    mock_backfill_db(
+        mock_connection, dt(2023, 1, 1), dt(2023, 2, 15), 'design')
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    tables = ['currency', 'design']
+    with pytest.raises(TableIngestionError):
+        backfill_tables_to_s3('test', tables)
+    completed = get_backfill_checkpoint('test')['completed']
+    assert '2023-01-31T00:00:00.000000/design' not in completed
+
+    mock_db = mock_backfill_db(
+        mock_connection, dt(2023, 1, 1), dt(2023, 2, 15))
+    assert backfill_tables_to_s3('test', tables) is True
+    assert mock_db.run.call_count == 4 - len(completed)
+
+
+@mock_s3
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_backfill_pauses_when_out_of_time(mock_connection):
+    '''
+        Test whether 'backfill_tables_to_s3' stops starting ranges near the
+        end of the invocation after its first range, leaving its checkpoint
+        for the next one.
+    '''
+
+    mock_db = mock_backfill_db(
+        mock_connection, dt(2023, 1, 1), dt(2023, 2, 15))
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    assert backfill_tables_to_s3(
+        'test', ['currency'], time_left=lambda: 1000) is False
+    assert get_backfill_checkpoint('test') == {
+        'windows': [
+            '2023-01-31T00:00:00.000000', '2023-02-15T00:00:00.000000'
+        ],
+        'completed': ['2023-01-31T00:00:00.000000/currency'],
+    }
+    assert mock_db.run.call_count == 2
+
+
+@mock_s3
+@patch.dict('os.environ', {'INGESTION_BUCKET': 'test'})
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_handler_resumes_paused_initial_backfill(mock_connection):
+    '''
+        Test whether 'ingestion_lambda_handler' resumes an initial backfill
+        that paused before any watermarks were written, rather than failing
+        on the checkpoint at the top of the bucket.
+    '''
+
+    mock_db = mock_backfill_db(
+        mock_connection, dt(2023, 1, 1), dt(2023, 2, 15))
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    out_of_time = Mock(get_remaining_time_in_millis=lambda: 1000)
+    ingestion_lambda_handler({}, out_of_time)
+    assert get_backfill_checkpoint('test')['completed'] == [
+        '2023-01-31T00:00:00.000000/address']
+    assert mock_db.run.call_count == 2
+
+    plenty_of_time = Mock(get_remaining_time_in_millis=lambda: 170000)
+    ingestion_lambda_handler({}, plenty_of_time)
+    assert get_backfill_checkpoint('test') is None
+    assert set(get_watermarks('test', ['currency', 'staff']).values()) == {
+        dt(2023, 2, 15)
+    }
+    keys = [obj['Key'] for obj in s3_client.list_objects_v2(
+        Bucket='test')['Contents']]
+    assert '2023-01-31T00:00:00.000000/currency.csv' in keys
+    assert '2023-02-15T00:00:00.000000/staff.csv' in keys
+
+
+@mock_s3
+@patch.dict('os.environ', {'INGESTION_BUCKET': 'test'})
+@patch('src.lambda_ingestion.ingestion_lambda.connect')
+def test_handler_backfills_within_a_60_second_invocation(mock_connection):
+    '''
+        Test whether 'ingestion_lambda_handler' completes the initial
+        backfill of a fresh bucket when the invocation starts with just
+        under 60 seconds left, as with a 60 second Lambda timeout.
+    '''
+
+    mock_backfill_db(mock_connection, dt(2023, 1, 1), dt(2023, 2, 15))
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test')
+    remaining = iter(range(59000, 0, -1000))
+    context = Mock(get_remaining_time_in_millis=lambda: next(remaining))
+    ingestion_lambda_handler({}, context)
+    assert get_backfill_checkpoint('test') is None
+    assert set(get_watermarks('test', ['currency', 'staff']).values()) == {
+        dt(2023, 2, 15)
+    }
@@ -0,0 +1,391 @@
+import boto3
+import io
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import src.lambda_transformation.transformation_lambda as t
+from concurrent.futures import ThreadPoolExecutor
+from moto import mock_s3
+from unittest.mock import Mock, patch
+from pipeline_common.warehouse_schemas import WAREHOUSE_SCHEMAS
+from src.lambda_transformation.utils.warehouse_dtypes import (
+    apply_warehouse_dtypes,
+)
+
+
+def test_back_to_parquet_writes_warehouse_schema():
+    '''
+        Test whether 'back_to_parquet' writes a warehouse table with its
+        schema, keeping an all-null text column as a string and leaving out
+        the DataFrame's index.
+    '''
+
+    dim_currency = apply_warehouse_dtypes('dim_currency', pd.DataFrame({
+        'currency_id': [1, 2],
+        'currency_code': ['GBP', 'XXX'],
+        'currency_name': [None, None],
+    }, index=[5, 6]))
+    key, body = t.back_to_parquet(
+        {'Key': '2023-08-02 09:10:09.786000/dim_currency.csv',
+         'Body': dim_currency})
+    assert key == '2023-08-02 09:10:09.786000/dim_currency.parquet'
+    table = pq.read_table(io.BytesIO(body))
+    assert table.schema.remove_metadata().equals(
+        WAREHOUSE_SCHEMAS['dim_currency'])
+    assert table.column('currency_name').to_pylist() == [None, None]
+
+
+def test_back_to_parquet_infers_types_of_other_tables():
+    '''
+        Test whether 'back_to_parquet' keeps the DataFrame's column types for
+        tables that have no warehouse schema.
+    '''
+
+    key, body = t.back_to_parquet(
+        {'Key': 'other.csv', 'Body': pd.DataFrame({'value': [1, 2]})})
+    assert key == 'other.parquet'
+    table = pq.read_table(io.BytesIO(body))
+    assert table.schema.field('value').type == pa.int64()
+
+
+@patch.dict('os.environ', {'PARQUET_WRITER_CODEC': 'gzip',
+                           'PARQUET_WRITER_ROW_GROUP_ROWS': '2'})
+def test_back_to_parquet_uses_parquet_writer_settings():
+    '''
+        Test whether 'back_to_parquet' writes with the codec and row group
+        size set by the PARQUET_WRITER environment variables.
+    '''
+
+    _, body = t.back_to_parquet(
+        {'Key': 'other.csv', 'Body': pd.DataFrame({'value': [1, 2, 3]})})
+    metadata = pq.ParquetFile(io.BytesIO(body)).metadata
+    assert metadata.num_row_groups == 2
+    assert metadata.row_group(0).column(0).compression == 'GZIP'
+
+
+def test_check_raw_keys_warns_about_unknown_tables(caplog):
+    '''
+        Test whether 'check_raw_keys' logs a warning for a key that is not one
+        of the transformed tables.
+    '''
+
+    keys = [['2023-08-02/design.csv'], ['2023-08-03/payment.csv']]
+    t.check_raw_keys(keys, ['design'])
+    assert 'Skipping 2023-08-03/payment.csv' in caplog.text
+    assert 'design.csv' not in caplog.text
+
+
+def get_object_response(body, codec=None):
+    '''
+        Builds a get_object response for the passed body, with the codec
+        metadata ingestion writes when it compresses an object.
+    '''
+
+    return {
+        'Body': io.BytesIO(body),
+        'Metadata': {'codec': codec} if codec else {},
+    }
+
+
+ADDRESS_CSV = (
+    b'address_id,address_line_1,phone,last_updated\n'
+    b'1,6826 Herzog Via,01803 637401,2022-11-03 14:20:49.962000\n'
+)
+
+
+def test_response_to_data_frame_reads_csv_with_table_types():
+    '''
+        Test whether 'response_to_data_frame' reads a raw csv with the column
+        types of its table, keeping phone numbers as strings.
+    '''
+
+    dataframe = t.response_to_data_frame(
+        get_object_response(ADDRESS_CSV), 'address')
+    assert str(dataframe['address_id'].dtype) == 'int32'
+    assert dataframe['phone'][0] == '01803 637401'
+    assert dataframe['last_updated'][0] == pd.Timestamp(
+        '2022-11-03 14:20:49.962')
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'zstd'])
+def test_response_to_data_frame_decompresses_csv(codec):
+    '''
+        Test whether 'response_to_data_frame' decompresses a csv with the
+        codec named in its metadata before reading it.
+    '''
+
+    sink = pa.BufferOutputStream()
+    with pa.CompressedOutputStream(sink, codec) as compressed:
+        compressed.write(ADDRESS_CSV)
+    dataframe = t.response_to_data_frame(
+        get_object_response(sink.getvalue().to_pybytes(), codec), 'address')
+    assert dataframe['address_line_1'].tolist() == ['6826 Herzog Via']
+    assert dataframe['phone'][0] == '01803 637401'
+
+
+def test_response_to_data_frame_detects_parquet():
+    '''
+        Test whether 'response_to_data_frame' reads a body that starts with
+        the parquet magic bytes as a parquet, whatever its table.
+    '''
+
+    sink = pa.BufferOutputStream()
+    pq.write_table(pa.table({'address_id': [1], 'phone': ['01803']}), sink)
+    dataframe = t.response_to_data_frame(
+        get_object_response(sink.getvalue().to_pybytes()), 'address')
+    assert dataframe.to_dict('records') == [
+        {'address_id': 1, 'phone': '01803'}]
+
+
+def test_response_to_data_frame_reads_empty_body():
+    '''
+        Test whether 'response_to_data_frame' returns an empty DataFrame for
+        an empty object.
+    '''
+
+    assert t.response_to_data_frame(get_object_response(b''), 'address').empty
+
+
+CURRENCY_CSV = (
+    'currency_id,currency_code,created_at,last_updated\n'
+    '1,GBP,2022-11-03 14:20:49.962000,2022-11-03 14:20:49.962000\n'
+)
+
+
+@pytest.fixture
+def buckets():
+    '''
+        Creates a raw bucket holding one timestamp of currency data and an
+        empty processed bucket, named by the environment variables.
+    '''
+
+    with mock_s3(), patch.dict('os.environ', {
+            'INGESTION_BUCKET': 'raw', 'PROCESSED_BUCKET': 'processed'}):
+        s3_client = boto3.client('s3', region_name='eu-west-2')
+        for bucket in ('raw', 'processed'):
+            s3_client.create_bucket(Bucket=bucket, CreateBucketConfiguration={
+                'LocationConstraint': 'eu-west-2'})
+        s3_client.put_object(
+            Bucket='raw', Key='2023-08-02 09:10:09.786000/currency.csv',
+            Body=CURRENCY_CSV)
+        yield s3_client
+
+
+def processed_keys(s3_client):
+    '''
+        Lists the keys of the processed bucket, leaving out the snapshots.
+    '''
+
+    contents = s3_client.list_objects_v2(Bucket='processed')['Contents']
+    return sorted(item['Key'] for item in contents
+                  if not item['Key'].endswith('_snapshot.parquet'))
+
+
+def test_handler_writes_csvs_by_default(buckets):
+    '''
+        Test whether the handler writes the transformed tables as csvs for
+        stage 2 when PROCESSED_FORMAT is not set.
+    '''
+
+    t.transformation_lambda_handler({}, None)
+    assert processed_keys(buckets) == [
+        '2023-08-02 09:10:09.786000/dim_currency.csv', 'dim_date.csv']
+
+
+@patch.dict('os.environ', {'PROCESSED_FORMAT': 'parquet'})
+def test_handler_writes_parquets_when_format_is_parquet(buckets):
+    '''
+        Test whether the handler writes the transformed tables, and dim_date,
+        as parquets with their warehouse schema when PROCESSED_FORMAT is
+        parquet.
+    '''
+
+    t.transformation_lambda_handler({}, None)
+    key = '2023-08-02 09:10:09.786000/dim_currency.parquet'
+    assert processed_keys(buckets) == [key, 'dim_date.parquet']
+    body = buckets.get_object(Bucket='processed', Key=key)['Body'].read()
+    table = pq.read_table(io.BytesIO(body))
+    assert table.schema.remove_metadata().equals(
+        WAREHOUSE_SCHEMAS['dim_currency'])
+    assert table.column('currency_code').to_pylist() == ['GBP']
+
+
+@patch.dict('os.environ', {'PROCESSED_FORMAT': 'json'})
+def test_handler_rejects_unknown_format(buckets):
+    '''
+        Test whether the handler fails before writing anything when
+        PROCESSED_FORMAT names a format it cannot write.
+    '''
+
+    with pytest.raises(KeyError):
+        t.transformation_lambda_handler({}, None)
+    assert 'Contents' not in buckets.list_objects_v2(Bucket='processed')
+
+
+@patch.dict('os.environ', {'PROCESSED_LAYOUT': 'hive'})
+def test_handler_rejects_hive_layout_without_parquet(buckets):
+    '''
+        Test whether the handler fails before writing anything when
+        PROCESSED_LAYOUT is hive but the tables would be written as csvs.
+    '''
+
+    with pytest.raises(ValueError, match='needs PROCESSED_FORMAT parquet'):
+        t.transformation_lambda_handler({}, None)
+    assert 'Contents' not in buckets.list_objects_v2(Bucket='processed')
+
+
+@patch.dict('os.environ', {'PROCESSED_FORMAT': 'parquet',
+                           'PROCESSED_LAYOUT': 'hive'})
+def test_handler_writes_hive_partitions(buckets):
+    '''
+        Test whether the handler writes each table to its ingest_date
+        partition in the hive layout, marking the timestamp as processed.
+    '''
+
+    t.transformation_lambda_handler({}, None)
+    timestamp = '2023-08-02 09:10:09.786000'
+    assert processed_keys(buckets) == [
+        f'{timestamp}/{t.PROCESSED_MARKER}', 'dim_date.parquet',
+        f'table=dim_currency/ingest_date=2023-08-02/{timestamp}.parquet']
+
+
+def test_hive_key_moves_tables_to_their_partition():
+    '''
+        Test whether 'hive_key' moves a timestamp prefixed key to its table
+        and ingest_date partition, keeping the extension.
+    '''
+
+    assert t.hive_key('2023-08-02 09:10:09.786000/dim_staff.parquet') == (
+        'table=dim_staff/ingest_date=2023-08-02/'
+        '2023-08-02 09:10:09.786000.parquet')
+
+
+@patch.dict('os.environ', {'TRANSFORMATION_COALESCE': 'true'})
+def test_handler_coalesces_pending_prefixes(buckets):
+    '''
+        Test whether the handler with TRANSFORMATION_COALESCE transforms the
+        newest version of each row by last_updated once, under the newest
+        pending prefix, marking the older prefixes as coalesced.
+    '''
+
+    first, second = '2023-08-02 09:10:09.786000', '2023-08-03 09:10:09.786000'
+    buckets.put_object(
+        Bucket='raw', Key=f'{second}/currency.csv',
+        Body='currency_id,currency_code,created_at,last_updated\n'
+             '1,USD,2022-11-03 14:20:49.962000,2022-11-01 14:20:49.962000\n'
+             '2,EUR,2022-11-03 14:20:49.962000,2022-11-03 14:20:49.962000\n')
+    t.transformation_lambda_handler({}, None)
+    assert processed_keys(buckets) == [
+        f'{first}/{t.COALESCED_MARKER}', f'{second}/dim_currency.csv',
+        'dim_date.csv']
+    body = buckets.get_object(
+        Bucket='processed', Key=f'{second}/dim_currency.csv')['Body']
+    table = pd.read_csv(body, index_col=0)
+    assert table[['currency_id', 'currency_code']].values.tolist() == [
+        [1, 'GBP'], [2, 'EUR']]
+
+
+def test_fetch_group_downloads_known_tables_on_the_pool(buckets):
+    '''
+        Test whether 'fetch_group' starts downloading each object of a known
+        table on the pool, keyed by table name, skipping other tables.
+    '''
+
+    buckets.put_object(
+        Bucket='raw', Key='2023-08-02 09:10:09.786000/payment.csv',
+        Body='payment_id\n1\n')
+    keys = ['2023-08-02 09:10:09.786000/currency.csv',
+            '2023-08-02 09:10:09.786000/payment.csv']
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        fetched = t.fetch_group(pool, buckets, 'raw', keys, ['currency'])
+        assert list(fetched) == ['currency']
+        csv_dict = fetched['currency'].result()
+    assert csv_dict['Key'] == keys[0]
+    assert csv_dict['Body']['currency_code'].tolist() == ['GBP']
+
+
+def test_apply_transformations_uses_fetched_group():
+    '''
+        Test whether 'apply_transformations_to_group' transforms the objects
+        already fetched for the group rather than downloading them again.
+    '''
+
+    s3_client = Mock()
+    fetched = {'currency': Mock(**{'result.return_value': {
+        'Key': '2023-08-02 09:10:09.786000/currency.csv',
+        'Body': pd.DataFrame({'currency_id': [1], 'currency_code': ['GBP']}),
+        'Timestamp': '2023-08-02 09:10:09.786000',
+    }})}
+    output = t.apply_transformations_to_group(
+        s3_client, [], ['currency'], fetched)
+    assert list(output) == ['dim_currency']
+    s3_client.get_object.assert_not_called()
+
+
+def test_handler_prefetches_the_next_group(buckets):
+    '''
+        Test whether the handler starts fetching the next timestamp's objects
+        before transforming the current one.
+    '''
+
+    buckets.put_object(
+        Bucket='raw', Key='2023-08-03 09:10:09.786000/currency.csv',
+        Body=CURRENCY_CSV)
+    calls = Mock()
+    with patch.object(t, 'fetch_group', wraps=t.fetch_group) as fetch, \
+            patch.object(t, 'apply_transformations_to_group',
+                         wraps=t.apply_transformations_to_group) as apply:
+        calls.attach_mock(fetch, 'fetch')
+        calls.attach_mock(apply, 'apply')
+        t.transformation_lambda_handler({}, None)
+    assert [name for name, args, kwargs in calls.mock_calls] == [
+        'fetch', 'fetch', 'apply', 'apply']
+    assert fetch.call_args_list[1].args[3] == [
+        '2023-08-03 09:10:09.786000/currency.csv']
+    assert '2023-08-03 09:10:09.786000/dim_currency.csv' in processed_keys(
+        buckets)
+
+
+def test_snapshot_seed_reads_processed_prefixes_oldest_first(buckets):
+    '''
+        Test whether 'snapshot_seed' reads a table's objects from the passed
+        prefixes only, oldest first, leaving out pending prefixes.
+    '''
+
+    for timestamp, code in [('2023-08-03 09:10:09.786000', 'EUR'),
+                            ('2023-08-04 09:10:09.786000', 'USD')]:
+        buckets.put_object(
+            Bucket='raw', Key=f'{timestamp}/currency.csv',
+            Body=CURRENCY_CSV.replace('GBP', code))
+    seed = t.snapshot_seed(buckets, 'raw', [
+        '2023-08-03 09:10:09.786000/', '2023-08-02 09:10:09.786000/'])
+    assert seed('currency')['currency_code'].tolist() == ['GBP', 'EUR']
+    assert seed('address').empty
+
+
+def test_handler_seeds_snapshots_from_processed_prefixes(buckets):
+    '''
+        Test whether the handler joins a counterparty to an address that was
+        transformed before the snapshots existed, seeding the address
+        snapshot from the raw bucket.
+    '''
+
+    first = '2023-08-02 09:10:09.786000'
+    buckets.put_object(
+        Bucket='raw', Key=f'{first}/address.csv',
+        Body='address_id,address_line_1,address_line_2,district,city,'
+             'postal_code,country,phone\n'
+             '1,6826 Herzog Via,,Avon,Leeds,28441,UK,1803 637401\n')
+    buckets.put_object(Bucket='processed', Key=f'{first}/processed.txt',
+                       Body='')
+    buckets.put_object(
+        Bucket='raw', Key='2023-08-03 09:10:09.786000/counterparty.csv',
+        Body='counterparty_id,counterparty_legal_name,legal_address_id\n'
+             '5,Fahey and Sons,1\n')
+    t.transformation_lambda_handler({}, None)
+    key = '2023-08-03 09:10:09.786000/dim_counterparty.csv'
+    assert key in processed_keys(buckets)
+    body = buckets.get_object(Bucket='processed', Key=key)['Body'].read()
+    assert 'Fahey and Sons' in body.decode()
+    assert '6826 Herzog Via' in body.decode()
@@ -0,0 +1,155 @@
+import io
+import pyarrow.parquet as pq
+import pytest
+from pyarrow import fs
+from unittest.mock import patch
+import src.lambda_transformation_stage_2.transformation_lambda_stage_2 as s2
+from pipeline_common.parquet_writer import PARQUET_PROFILE
+from pipeline_common.warehouse_schemas import WAREHOUSE_SCHEMAS
+
+
+def test_process_file_to_parquet_reads_csv_with_warehouse_schema(tmp_path):
+    '''
+        Test whether 'process_file_to_parquet' reads a warehouse table's csv
+        with its schema, dropping the unnamed index column, keeping empty
+        text as nulls and deleting the csv once converted.
+    '''
+
+    (tmp_path / 'dim_currency.csv').write_text(
+        ',currency_id,currency_code,currency_name\n'
+        '0,1,GBP,Pound sterling\n'
+        '1,2,XXX,\n')
+    local = fs.LocalFileSystem()
+    file = local.get_file_info(str(tmp_path / 'dim_currency.csv'))
+    stats = s2.process_file_to_parquet(local, file)
+    table = pq.read_table(tmp_path / 'dim_currency.parquet')
+    assert table.schema.remove_metadata().equals(
+        WAREHOUSE_SCHEMAS['dim_currency'])
+    assert table.column('currency_name').to_pylist() == [
+        'Pound sterling', None]
+    assert not (tmp_path / 'dim_currency.csv').exists()
+    assert stats['bytes_out'] > 0
+
+
+def currency_csv(rows):
+    '''
+        Builds a dim_currency csv as the transformation lambda writes it,
+        with the unnamed index column first.
+    '''
+
+    lines = [',currency_id,currency_code,currency_name']
+    lines += [f'{index},{index + 1},GBP,Pound sterling'
+              for index in range(rows)]
+    return '\n'.join(lines) + '\n'
+
+
+# Timestamp folders written by the transformation lambda.
+FIRST = '2023-08-02 09:10:09.786000'
+SECOND = '2023-08-03 09:10:09.786000'
+
+
+def test_process_file_to_parquet_streams_row_groups(processed_bucket):
+    '''
+        Test whether 'process_file_to_parquet' converts a csv read in several
+        blocks into whole row groups of the profile's size, keeping every
+        row and dropping the unnamed index column.
+    '''
+
+    s3_client, s3 = processed_bucket
+    s3_client.put_object(Bucket='processed', Key='2023/dim_currency.csv',
+                         Body=currency_csv(10))
+    profile = dict(PARQUET_PROFILE, row_group_rows=4)
+    with patch.object(s2, 'CSV_BLOCK_SIZE', 64):
+        s2.process_file_to_parquet(
+            s3, s3.get_file_info('processed/2023/dim_currency.csv'), profile)
+    body = s3_client.get_object(
+        Bucket='processed', Key='2023/dim_currency.parquet')['Body'].read()
+    parquet = pq.ParquetFile(io.BytesIO(body))
+    assert [parquet.metadata.row_group(index).num_rows
+            for index in range(parquet.num_row_groups)] == [4, 4, 2]
+    table = parquet.read()
+    assert table.column_names == ['currency_id', 'currency_code',
+                                  'currency_name']
+    assert table.column('currency_id').to_pylist() == list(range(1, 11))
+    assert processed_bucket.keys() == ['2023/dim_currency.parquet']
+
+
+def test_handler_converts_timestamp_folders_only(processed_bucket):
+    '''
+        Test whether the handler converts the csvs of each timestamp folder
+        and dim_date, leaves other files at the top of the bucket alone, and
+        records the folders as converted.
+    '''
+
+    s3_client, s3 = processed_bucket
+    for key, body in [
+            (f'{FIRST}/dim_currency.csv', currency_csv(2)),
+            (f'{SECOND}/dim_currency.csv', currency_csv(3)),
+            ('dim_date.csv', ',date_id,year,month,day,day_of_week,'
+                             'day_name,month_name,quarter\n'
+                             '0,2023-08-02,2023,8,2,2,Wednesday,August,3\n'),
+            ('cache.txt', '2023-08-01/'),
+            ('notes.csv', 'a\n1\n')]:
+        s3_client.put_object(Bucket='processed', Key=key, Body=body)
+    s2.transformation_lambda_handler_stage_2({}, None)
+    assert processed_bucket.keys() == [
+        f'{FIRST}/dim_currency.parquet',
+        f'{SECOND}/dim_currency.parquet',
+        'cache.txt', 'converted.txt', 'dim_date.parquet', 'notes.csv']
+    assert processed_bucket.read_text('converted.txt').split('\n') == [
+        FIRST, SECOND]
+
+
+def test_handler_leaves_folders_without_csvs_pending(processed_bucket):
+    '''
+        Test whether the handler only records a folder as converted once it
+        has held csvs, so that csvs written to it later are still converted.
+    '''
+
+    s3_client, s3 = processed_bucket
+    s3_client.put_object(Bucket='processed', Key=f'{FIRST}/notes.txt',
+                         Body='')
+    s2.transformation_lambda_handler_stage_2({}, None)
+    assert 'converted.txt' not in processed_bucket.keys()
+
+    s3_client.put_object(Bucket='processed', Key=f'{FIRST}/dim_currency.csv',
+                         Body=currency_csv(2))
+    s2.transformation_lambda_handler_stage_2({}, None)
+    assert f'{FIRST}/dim_currency.parquet' in processed_bucket.keys()
+    assert processed_bucket.read_text('converted.txt').split('\n') == [FIRST]
+
+
+def test_handler_skips_converted_folders(processed_bucket):
+    '''
+        Test whether the handler leaves the folders recorded as converted
+        without converting them again.
+    '''
+
+    s3_client, s3 = processed_bucket
+    s3_client.put_object(Bucket='processed', Key='converted.txt', Body=FIRST)
+    s3_client.put_object(Bucket='processed', Key=f'{FIRST}/dim_currency.csv',
+                         Body=currency_csv(2))
+    with patch.object(s2, 'list_folder_csvs') as list_folder_csvs:
+        s2.transformation_lambda_handler_stage_2({}, None)
+    list_folder_csvs.assert_not_called()
+    assert f'{FIRST}/dim_currency.csv' in processed_bucket.keys()
+
+
+def test_handler_raises_conversion_error_from_workers(processed_bucket):
+    '''
+        Test whether a csv that fails to convert on a worker makes the
+        handler raise a 'ConversionError' once the other csvs are converted,
+        leaving its folder to be checked again next run.
+    '''
+
+    s3_client, s3 = processed_bucket
+    s3_client.put_object(Bucket='processed', Key=f'{FIRST}/dim_currency.csv',
+                         Body=currency_csv(2))
+    s3_client.put_object(Bucket='processed', Key=f'{SECOND}/dim_currency.csv',
+                         Body=',currency_id,currency_code\n0,one,GBP\n')
+    with pytest.raises(s2.ConversionError, match='1 csvs failed'):
+        s2.transformation_lambda_handler_stage_2({}, None)
+    assert processed_bucket.keys() == [
+        f'{FIRST}/dim_currency.parquet', f'{SECOND}/dim_currency.csv',
+        'converted.txt']
+    assert processed_bucket.read_text('converted.txt').split('\n') == [FIRST]